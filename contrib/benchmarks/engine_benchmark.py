@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the organize state engine's event throughput and latency with
+synthetic peer populations.
+
+This runs entirely in memory: triggers go to a no-op target and the state is
+never saved, so it needs neither netlink nor DBus nor root. The results are
+printed (or written to a file) as JSON, to be compared between releases.
+
+Usage:
+
+    python3 contrib/benchmarks/engine_benchmark.py --peers 10,100 -o out.json
+
+Each population is loaded from its serialized form (as the state file is), and
+the time that takes is reported as load_seconds. With --budget, each event type
+is measured for at most that many seconds, which keeps large populations
+practical; the number of events actually measured is part of the results.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import json
+import platform
+import random
+import time
+from base64 import b64encode
+from ipaddress import ip_address
+
+import click
+
+from vula.__version__ import __version__
+from vula.organize import OrganizeState, SystemState
+from vula.peer import Descriptor
+
+_SUBNET_V4 = '10.0.0.0/16'
+_SUBNET_V6 = 'fe80::/64'
+
+
+def key(kind, i, length=32):
+    """
+    Returns a deterministic base64 key-shaped string.
+    """
+    digest = hashlib.sha512(b'%s %d' % (kind.encode(), i)).digest()
+    return b64encode(digest[:length]).decode()
+
+
+def synthetic_descriptor(i, vf=1):
+    """
+    Returns the descriptor of synthetic peer number i.
+    """
+    return Descriptor(
+        pk=key('pk', i),
+        c=key('c', i, 64),
+        s=key('s', i, 64),
+        vk=key('vk', i),
+        hostname='peer%d.local' % (i,),
+        port=5354,
+        dt=86400,
+        vf=vf,
+        e=False,
+        r='',
+        p=str(ip_address('fdff:ffff:ffdf::') + i + 2),
+        v4a=str(ip_address('10.0.0.0') + i + 2),
+        v6a=str(ip_address('fe80::') + i + 2),
+    )
+
+
+def synthetic_system_state(gateway='10.0.0.1'):
+    """
+    Returns a system state with a LAN and an IPv6 link-local subnet.
+    """
+    return SystemState(
+        current_subnets={
+            _SUBNET_V4: ['10.0.255.254'],
+            _SUBNET_V6: ['fe80::1'],
+        },
+        current_interfaces={'eth0': ['10.0.255.254', 'fe80::1']},
+        gateways=[gateway],
+        has_v6=True,
+    )
+
+
+def synthetic_peer(i):
+    """
+    Returns the serialized peer which synthetic peer number i becomes when its
+    descriptor is accepted.
+    """
+    desc = synthetic_descriptor(i)
+    return dict(
+        petname='',
+        pinned=False,
+        enabled=True,
+        verified=False,
+        use_as_gateway=False,
+        descriptor=desc._dict(),
+        nicknames={desc.hostname: True},
+        IPv4addrs={str(desc.v4a): True},
+        IPv6addrs={str(desc.v6a): True},
+    )
+
+
+def synthetic_state(peers):
+    """
+    Returns an OrganizeState with a number of synthetic peers, and the number
+    of seconds it took to load it.
+
+    The state is loaded from its serialized form, the same way the organize
+    daemon loads its state file, rather than by processing one event per peer.
+    """
+    state = OrganizeState()
+    state.event_NEW_SYSTEM_STATE(synthetic_system_state())
+    state.event_USER_EDIT('SET', 'prefs.local_domains', ['local'])
+    serialized = dict(
+        state._dict(),
+        peers={key('vk', i): synthetic_peer(i) for i in range(peers)},
+    )
+    start = time.perf_counter()
+    state = OrganizeState(serialized)
+    load_seconds = time.perf_counter() - start
+    state.trigger_target = NoopTarget()
+    return state, load_seconds
+
+
+class NoopTarget(object):
+    """
+    A trigger target which ignores all triggers.
+    """
+
+    def __getattr__(self, name):
+        return lambda *a, **kw: None
+
+
+def percentile(sorted_values, p):
+    return sorted_values[
+        min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))
+    ]
+
+
+def measure(calls, budget=None):
+    """
+    Runs the calls, which should return Results, and returns the throughput
+    and latency percentiles (in microseconds).
+
+    If a budget (in seconds) is given, no further calls are made once it has
+    been used up, so the number of events measured may be lower than asked.
+    """
+    latencies = []
+    deadline = None if budget is None else time.perf_counter() + budget
+    for call in calls:
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+        start = time.perf_counter_ns()
+        res = call()
+        latencies.append(time.perf_counter_ns() - start)
+        assert res.ok, res
+    latencies.sort()
+    return dict(
+        events=len(latencies),
+        events_per_sec=round(len(latencies) / (sum(latencies) / 1e9), 1),
+        latency_us={
+            'p50': percentile(latencies, 50) / 1000,
+            'p90': percentile(latencies, 90) / 1000,
+            'p99': percentile(latencies, 99) / 1000,
+            'max': latencies[-1] / 1000,
+        },
+    )
+
+
+def benchmark(peers, events, seed=0, budget=None):
+    """
+    Returns the measurements for a population of synthetic peers.
+    """
+    rng = random.Random(seed)
+    state, load_seconds = synthetic_state(peers)
+    existing = [rng.randrange(peers) for _ in range(events)]
+    measured = {}
+    run = functools.partial(measure, budget=budget)
+
+    # a known peer announces itself again, with a newer vf
+    measured['INCOMING_DESCRIPTOR (update)'] = run(
+        (
+            lambda i=i, n=n: state.event_INCOMING_DESCRIPTOR(
+                synthetic_descriptor(i, vf=n + 2)
+            )
+        )
+        for n, i in enumerate(existing)
+    )
+    new = run(
+        (lambda i=i: state.event_INCOMING_DESCRIPTOR(synthetic_descriptor(i)))
+        for i in range(peers, peers + events)
+    )
+    measured['INCOMING_DESCRIPTOR (new)'] = new
+    measured['USER_REMOVE_PEER'] = run(
+        (lambda i=i: state.event_USER_REMOVE_PEER(key('vk', i)))
+        for i in range(peers, peers + new['events'])
+    )
+    measured['USER_EDIT'] = run(
+        (
+            lambda i=i, n=n: state.event_USER_EDIT(
+                'SET', ['peers', key('vk', i), 'pinned'], n % 2 == 0
+            )
+        )
+        for n, i in enumerate(existing)
+    )
+    # the default gateway changes back and forth
+    measured['NEW_SYSTEM_STATE'] = run(
+        (
+            lambda n=n: state.event_NEW_SYSTEM_STATE(
+                synthetic_system_state('10.0.0.1' if n % 2 else '10.0.255.1')
+            )
+        )
+        for n in range(max(1, events // 10))
+    )
+    return dict(load_seconds=round(load_seconds, 6), events=measured)
+
+
+@click.command()
+@click.option(
+    '--peers',
+    default='10,100,1000,5000',
+    show_default=True,
+    help="Comma-separated peer population sizes",
+)
+@click.option(
+    '--events',
+    default=200,
+    show_default=True,
+    help="Events of each type per population (NEW_SYSTEM_STATE gets 1/10)",
+)
+@click.option(
+    '--budget',
+    type=float,
+    default=None,
+    help="Maximum seconds to spend measuring each event type",
+)
+@click.option('--seed', default=0, show_default=True)
+@click.option(
+    '-o', '--output', type=click.File('w'), default='-', help="JSON output"
+)
+def main(peers, events, budget, seed, output):
+    results = dict(
+        benchmark='engine',
+        vula_version=__version__,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        events=events,
+        budget=budget,
+        seed=seed,
+        populations={},
+    )
+    for n in map(int, peers.split(',')):
+        click.echo("benchmarking %d peers" % (n,), err=True)
+        results['populations'][n] = benchmark(n, events, seed, budget)
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
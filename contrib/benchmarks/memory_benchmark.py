@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the memory used by the organize state's peers, with synthetic
+peer populations.
+
+The memory is measured with tracemalloc, in steps: the peers as they are after
+loading the state file, then also their serialized form (which the state
+engine keeps for copying the state in each event), then the derived
+properties which sync and the hosts file use, and then the indexes which
+peer lookups use. The results are printed (or written to a file) as JSON.
+
+Usage:
+
+    python3 contrib/benchmarks/memory_benchmark.py --peers 1000,10000
+"""
+
+from __future__ import annotations
+
+import gc
+import json
+import platform
+import tracemalloc
+from ipaddress import ip_address
+
+import click
+from engine_benchmark import key, synthetic_peer
+
+from vula.__version__ import __version__
+from vula.peer import Peers
+
+
+def traced():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def benchmark(peers):
+    """
+    Returns the bytes per peer used after each step.
+    """
+    serialized = {key('vk', i): synthetic_peer(i) for i in range(peers)}
+    steps = {}
+    tracemalloc.start()
+    try:
+        start = traced()
+        state = Peers(serialized)
+        steps['loaded'] = traced()
+        state._dict()
+        steps['serialized'] = traced()
+        for peer in state.values():
+            peer.name, peer.enabled_names, peer.endpoint_addr
+            peer.routes, peer._wg_allowed_ips
+        steps['derived'] = traced()
+        state.query('peer0.local'), state.with_ip(ip_address('10.0.0.2'))
+        steps['indexed'] = traced()
+    finally:
+        tracemalloc.stop()
+    return dict(
+        total_mib=round((steps['indexed'] - start) / 2**20, 1),
+        bytes_per_peer={
+            step: round((used - start) / peers) for step, used in steps.items()
+        },
+    )
+
+
+@click.command()
+@click.option(
+    '--peers',
+    default='1000,10000',
+    show_default=True,
+    help="Comma-separated peer population sizes",
+)
+@click.option(
+    '-o', '--output', type=click.File('w'), default='-', help="JSON output"
+)
+def main(peers, output):
+    results = dict(
+        benchmark='memory',
+        vula_version=__version__,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        populations={},
+    )
+    for n in map(int, peers.split(',')):
+        click.echo("benchmarking %d peers" % (n,), err=True)
+        results['populations'][n] = benchmark(n)
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-peer work done by a full sync and by writing the hosts
+file, with synthetic peer populations.
+
+Both are run against stand-ins for netlink and WireGuard which report no
+existing links, routes or WireGuard peers, so sync is a dry run which plans
+every peer's config and routes, and needs neither root nor a WireGuard
+interface.
+The hosts file is written to a temporary directory; as the peers don't change,
+only the first measurement writes it, and the rest measure the work of finding
+that it is unchanged.
+
+Each is measured on fresh peer objects (as after an event replaced them, or
+the state was loaded) and again on the same objects, whose derived properties
+are then already computed. The results are printed (or written to a file) as
+JSON.
+
+Usage:
+
+    python3 contrib/benchmarks/peer_benchmark.py --peers 100,1000 -o out.json
+"""
+
+from __future__ import annotations
+
+import copy
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+from unittest.mock import patch
+
+import click
+from engine_benchmark import synthetic_state
+
+from vula.__version__ import __version__
+from vula.common import attrdict
+from vula.organize import Organize
+from vula.sys_pyroute2 import Sys
+from vula.wg import Interface as WgInterface
+
+
+class SyntheticIPRoute(object):
+    """
+    Stands in for pyroute2's IPRoute, with no links, addresses, rules or
+    routes.
+    """
+
+    def link_lookup(self, ifname):
+        return [1]
+
+    def get_links(self, *a, **kw):
+        return []
+
+    def get_addr(self, *a, **kw):
+        return []
+
+    def get_rules(self, *a, **kw):
+        return []
+
+    def link(self, *a, **kw):
+        pass
+
+    def addr(self, *a, **kw):
+        pass
+
+    def rule(self, *a, **kw):
+        pass
+
+    def route(self, *a, **kw):
+        return []
+
+    def get_routes(self):
+        return []
+
+
+class SyntheticWgInterface(WgInterface):
+    """
+    Stands in for vula.wg.Interface, with no peers.
+    """
+
+    def __init__(self, name, ipr):
+        self.log = logging.getLogger('peer_benchmark')
+        self.name = name
+        self.round_trips = 0
+
+    def query(self):
+        return self
+
+
+class BenchmarkOrganize(object):
+    """
+    The parts of Organize which sync and _write_hosts_file use.
+    """
+
+    interface = 'vula'
+    table = 666
+    hostname = 'benchmark.local'
+    port = 5354
+    fwmark = 555
+    ip_rule_priority = 666
+    _keys = attrdict(wg_Curve25519_sec_key='A' * 44)
+    log = logging.getLogger('peer_benchmark')
+    _hosts_written = None
+
+    def __init__(self, state):
+        self.state = state
+        self.peers = state.peers
+        self.prefs = state.prefs
+        with patch('vula.sys_pyroute2.IPRoute', SyntheticIPRoute), patch(
+            'vula.sys_pyroute2.WgInterface', SyntheticWgInterface
+        ):
+            self.sys = Sys(self)
+
+    def ctidh_dh(self, pk):
+        return 'A' * 44
+
+    def _hosts_file_text(self):
+        return Organize._hosts_file_text(self)
+
+
+def timed(organize, call, repeat):
+    """
+    Returns the mean milliseconds per call, for fresh peer objects and for
+    peer objects which have been used before.
+    """
+    cold = 0
+    for _ in range(repeat):
+        organize.peers = copy.deepcopy(organize.state.peers)
+        start = time.perf_counter()
+        call()
+        cold += time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    warm = time.perf_counter() - start
+    return dict(
+        fresh_ms=round(cold / repeat * 1e3, 3),
+        reused_ms=round(warm / repeat * 1e3, 3),
+    )
+
+
+def benchmark(peers, repeat):
+    state, _ = synthetic_state(peers)
+    organize = BenchmarkOrganize(state)
+    with tempfile.TemporaryDirectory() as tmp, patch(
+        'vula.organize._ORGANIZE_HOSTS_FILE', os.path.join(tmp, 'hosts')
+    ), patch('vula.organize.chown_like_dir_if_root'):
+        return dict(
+            sync=timed(
+                organize,
+                lambda: Organize.sync(organize, dryrun=True),
+                repeat,
+            ),
+            hosts_file=timed(
+                organize,
+                lambda: Organize._write_hosts_file(organize),
+                repeat,
+            ),
+        )
+
+
+@click.command()
+@click.option(
+    '--peers',
+    default='10,100,1000',
+    show_default=True,
+    help="Comma-separated peer population sizes",
+)
+@click.option(
+    '--repeat',
+    default=10,
+    show_default=True,
+    help="Repetitions of each measurement",
+)
+@click.option(
+    '-o', '--output', type=click.File('w'), default='-', help="JSON output"
+)
+def main(peers, repeat, output):
+    results = dict(
+        benchmark='peer',
+        vula_version=__version__,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        repeat=repeat,
+        populations={},
+    )
+    for n in map(int, peers.split(',')):
+        click.echo("benchmarking %d peers" % (n,), err=True)
+        results['populations'][n] = benchmark(n, repeat)
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark of schema validation, comparing the compiled validators with the
+schema library's own validation.
+
+This measures Descriptor.parse, and Interface.query for an interface with a
+large number of WireGuard peers. The interface's netlink replies are
+synthetic, so it needs neither root nor a WireGuard interface. The results are
+printed (or written to a file) as JSON.
+
+Usage:
+
+    python3 contrib/benchmarks/schema_benchmark.py --peers 100,1000 -o out.json
+"""
+
+from __future__ import annotations
+
+import json
+import platform
+import time
+from base64 import b64encode
+from unittest.mock import patch
+
+import click
+
+from vula.__version__ import __version__
+from vula.compiled_schema import CompiledSchema
+from vula.constants import _TEST_DESC_UNSIGNED
+from vula.peer import Descriptor
+from vula.wg import Interface
+
+
+def netlink_peer(i):
+    """
+    Returns a WireGuard peer in the form pyroute2 produces.
+    """
+    return {
+        'attrs': [
+            ('WGPEER_A_PUBLIC_KEY', b64encode(i.to_bytes(32, 'big'))),
+            ('WGPEER_A_PRESHARED_KEY', b64encode(bytes(32))),
+            (
+                'WGPEER_A_ENDPOINT',
+                {'addr': '10.0.%d.%d' % divmod(i, 256), 'port': 5354},
+            ),
+            ('WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL', 0),
+            ('WGPEER_A_LAST_HANDSHAKE_TIME', {'tv_sec': i}),
+            ('WGPEER_A_RX_BYTES', i),
+            ('WGPEER_A_TX_BYTES', i),
+            ('WGPEER_A_PROTOCOL_VERSION', 1),
+            (
+                'WGPEER_A_ALLOWEDIPS',
+                [
+                    {
+                        'attrs': [
+                            (
+                                'WGALLOWEDIP_A_IPADDR',
+                                '0a:00:%02x:%02x' % divmod(i, 256),
+                            ),
+                            ('WGALLOWEDIP_A_CIDR_MASK', 32),
+                        ]
+                    }
+                ],
+            ),
+        ]
+    }
+
+
+class SyntheticWireGuard(object):
+    """
+    Stands in for pyroute2's WireGuard, with a number of peers.
+    """
+
+    peers = 0
+
+    def info(self, name):
+        return (
+            {
+                'attrs': [
+                    ('WGDEVICE_A_IFNAME', name),
+                    (
+                        'WGDEVICE_A_PEERS',
+                        [netlink_peer(i) for i in range(self.peers)],
+                    ),
+                ]
+            },
+        )
+
+
+def timed(call, repeat):
+    """
+    Returns the mean time per call, in microseconds.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call()
+    return round((time.perf_counter() - start) / repeat * 1e6, 1)
+
+
+def compare(call, repeat):
+    """
+    Times the call with the schema library's validation and with the compiled
+    validators.
+    """
+    results = {}
+    for name, enabled in (('interpreted', False), ('compiled', True)):
+        with patch.object(CompiledSchema, 'enabled', enabled):
+            results[name + '_us'] = timed(call, repeat)
+    results['speedup'] = round(
+        results['interpreted_us'] / results['compiled_us'], 1
+    )
+    return results
+
+
+@click.command()
+@click.option(
+    '--peers',
+    default='10,100,1000',
+    show_default=True,
+    help="Comma-separated numbers of WireGuard peers for Interface.query",
+)
+@click.option(
+    '--repeat',
+    default=100,
+    show_default=True,
+    help="Repetitions of each measurement",
+)
+@click.option(
+    '-o', '--output', type=click.File('w'), default='-', help="JSON output"
+)
+def main(peers, repeat, output):
+    results = dict(
+        benchmark='schema',
+        vula_version=__version__,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        repeat=repeat,
+        descriptor_parse=compare(
+            lambda: Descriptor.parse(_TEST_DESC_UNSIGNED), repeat * 10
+        ),
+        interface_query={},
+    )
+    with patch('vula.wg.PyRoute2WireGuard', SyntheticWireGuard):
+        interface = Interface('vula', ipr=object())
+        for n in map(int, peers.split(',')):
+            click.echo("benchmarking %d WireGuard peers" % (n,), err=True)
+            SyntheticWireGuard.peers = n
+            interface.query()
+            assert len(interface['peers']) == n
+            results['interface_query'][n] = compare(
+                interface.query, max(1, repeat * 10 // n)
+            )
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import threading
 from unittest.mock import MagicMock
 
 from vula.constants import _TEST_DESC
@@ -129,3 +130,33 @@ class TestDiscover:
         browser1.cancel.assert_called_once()
         browser2.cancel.assert_called_once()
         browser3.cancel.assert_called_once()
+
+
+class TestDescriptorBatcher:
+    def test_burst_is_passed_together(self):
+        callback = MagicMock()
+        batcher = vula.discover.DescriptorBatcher(callback, delay=60)
+        descriptors = [Descriptor.parse(_TEST_DESC)] * 3
+
+        for descriptor in descriptors:
+            batcher.add(descriptor)
+
+        callback.assert_not_called()
+        batcher.flush()
+        callback.assert_called_once_with(descriptors)
+        batcher.flush()
+        callback.assert_called_once()
+
+    def test_timer_flushes(self):
+        batches = []
+        done = threading.Event()
+        batcher = vula.discover.DescriptorBatcher(
+            lambda ds: batches.append(ds) or done.set(), delay=0.01
+        )
+        descriptor = Descriptor.parse(_TEST_DESC)
+
+        batcher.add(descriptor)
+        batcher.add(descriptor)
+
+        assert done.wait(5)
+        assert batches == [[descriptor, descriptor]]
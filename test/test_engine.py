@@ -1,9 +1,14 @@
+import copy
+import threading
 import unittest
+from unittest.mock import MagicMock, PropertyMock
 
 import schema
 
 from vula.common import raw
+from vula.engine import EventQueue, TriggerExecutor
 from vula.organize import OrganizeState, SystemState
+from vula.peer import Peers
 
 from .test_peer import desc, mkk
 
@@ -362,6 +367,450 @@ class TestOrganizeEngine(unittest.TestCase):
         ] = False
         OrganizeState(sd)
 
+    def test_writes_do_not_mutate_committed_state(self):
+        self._add_alice_ok()
+        before = self.state._dict()
+        snapshot = copy.deepcopy(before)
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'petname'], 'alice2.local'
+            )
+        )
+        self._assert_res_no_error(
+            self.state.event_USER_PEER_ADDR_DEL(mkk('alicevk'), '10.0.0.1')
+        )
+        self.assertEqual(before, snapshot)
+        self.assertEqual(self.state.peers[mkk('alicevk')].IPv4addrs, {})
+
+    def test_failed_event_leaves_state_untouched(self):
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        snapshot = copy.deepcopy(self.state._dict())
+        res = self.state.event_USER_EDIT(
+            'SET', ['peers', mkk('bobvk'), 'petname'], 'alice.local'
+        )
+        self.assertIsNotNone(res.error)
+        self.assertEqual(self.state._dict(), snapshot)
+        self.assertEqual(self.state.peers[mkk('bobvk')].petname, '')
+
+    def test_unwritten_peers_are_not_revalidated(self):
+        self._add_alice_ok()
+        alice = self.state.peers[mkk('alicevk')]
+        prefs = self.state.prefs
+        self._add_bob_maybe()
+        self.assertIs(self.state.peers[mkk('alicevk')], alice)
+        self.assertIs(self.state.prefs, prefs)
+
+    def test_peer_indexes_follow_writes(self):
+        self._add_alice_ok()
+        self.assertEqual(
+            self.state.peers.with_hostname('alice.local').id, mkk('alicevk')
+        )
+        indexes = self.state.peers._indexes
+        self._add_bob_maybe()
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'enabled'], False
+            )
+        )
+        peers = self.state.peers
+        self.assertEqual(set(peers._indexes), set(indexes))
+        self.assertIsNone(peers.query('alice.local'))
+        self.assertIsNone(peers.query('10.0.0.1'))
+        self.assertEqual(peers.query('10.0.0.2').id, mkk('bobvk'))
+        self.assertEqual(peers.query(mkk('alicevk')).id, mkk('alicevk'))
+        # the updated indexes are the same as newly built ones
+        fresh = type(peers)(peers._dict())
+        for attr in peers.indexed:
+            self.assertEqual(
+                {k: list(v) for k, v in peers._index(attr).items()},
+                {k: list(v) for k, v in fresh._index(attr).items()},
+            )
+        # and the indexes of the previous state were not changed
+        self.assertEqual(
+            list(indexes['nicknames']['alice.local']), [mkk('alicevk')]
+        )
+
+    def test_serialization_is_incremental(self):
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        before = self.state._dict()
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'pinned'], True
+            )
+        )
+        after = self.state._dict()
+        self.assertEqual(after, OrganizeState(after)._dict())
+        self.assertEqual(
+            [after['peers'][vk]['pinned'] for vk in after['peers']],
+            [True, False],
+        )
+        self.assertIs(after['prefs'], before['prefs'])
+        self.assertIs(
+            after['peers'][mkk('bobvk')], before['peers'][mkk('bobvk')]
+        )
+        self.assertFalse(before['peers'][mkk('alicevk')]['pinned'])
+
+    def test_derived_peer_properties_follow_writes(self):
+        self._add_alice_ok()
+        alice = self.state.peers[mkk('alicevk')]
+        self.assertEqual(alice.enabled_names, ['alice.local'])
+        self.assertIs(alice.routes, alice.routes)
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'petname'], 'alison'
+            )
+        )
+        new = self.state.peers[mkk('alicevk')]
+        self.assertEqual(new.name, 'alison')
+        self.assertEqual(new.enabled_names, ['alice.local', 'alison'])
+        self.assertEqual(alice.name, 'alice.local')
+        self.assertEqual(new.routes, alice.routes)
+
+    def test_copies_are_not_revalidated(self):
+        self._add_alice_ok()
+        self.state.trigger_target = MagicMock()
+        with unittest.mock.patch.object(
+            schema.Schema, 'validate', side_effect=AssertionError
+        ):
+            state = copy.deepcopy(self.state)
+            system_state = self.state.system_state.copy()
+        self.assertEqual(state._dict(), self.state._dict())
+        self.assertIsNot(state.peers, self.state.peers)
+        self.assertEqual(type(state.peers[mkk('alicevk')]).__name__, 'Peer')
+        self.assertEqual(system_state, self.state.system_state)
+        self.assertIsNone(state.trigger_target)
+        self._assert_res_no_error(state.event_USER_REMOVE_PEER(mkk('alicevk')))
+        self.assertIn(mkk('alicevk'), self.state.peers)
+
+    def test_full_validation_mode(self):
+        incremental = OrganizeState(self.state._dict())
+        full = OrganizeState(self.state._dict())
+        full.full_validation = True
+        for state in (incremental, full):
+            self.state = state
+            self._add_alice_bob_same_ip_and_hostname()
+            res = state.event_USER_EDIT(
+                'SET', ['peers', mkk('bobvk'), 'petname'], 'carol.local'
+            )
+            self._assert_res_no_error(res)
+        self.assertEqual(incremental._dict(), full._dict())
+
+    def test_unchanged_state_is_not_saved(self):
+        self._process_descriptor(
+            hostname='alice.local',
+            vk=mkk('alicevk'),
+            vf=2,
+            v4a='10.0.0.1',
+            actions=['ACCEPT_NEW_PEER'],
+        )
+        self.state.save = MagicMock()
+        self._process_descriptor(
+            hostname='alice.local',
+            vk=mkk('alicevk'),
+            vf=1,
+            v4a='10.0.0.1',
+            actions=['IGNORE'],
+        )
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'pinned'], False
+            )
+        )
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT('ADD', 'prefs.local_domains', 'local')
+        )
+        self.state.save.assert_not_called()
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT(
+                'SET', ['peers', mkk('alicevk'), 'pinned'], True
+            )
+        )
+        self.state.save.assert_called_once()
+
+    def test_batch_saves_once(self):
+        self.state.save = MagicMock()
+        res = self._assert_res_no_error(
+            self.state.batch(
+                [
+                    (
+                        'INCOMING_DESCRIPTOR',
+                        desc(
+                            vk=mkk('alicevk'),
+                            pk=mkk('alicepk'),
+                            v4a='10.0.0.1',
+                            hostname='alice.local',
+                        ),
+                    ),
+                    (
+                        'INCOMING_DESCRIPTOR',
+                        desc(
+                            vk=mkk('bobvk'),
+                            pk=mkk('bobpk'),
+                            v4a='10.0.0.2',
+                            hostname='bob.local',
+                        ),
+                    ),
+                    (
+                        'USER_EDIT',
+                        'SET',
+                        ['peers', mkk('bobvk'), 'petname'],
+                        'alice.local',
+                    ),
+                ]
+            )
+        )
+        self.assertEqual([r.ok for r in res.results], [True, True, False])
+        self.assertEqual(
+            [r.actions[0][0] for r in res.results[:2]],
+            ['ACCEPT_NEW_PEER', 'ACCEPT_NEW_PEER'],
+        )
+        self.assertEqual(len(self.state.peers), 2)
+        self.assertEqual(self.state.peers[mkk('bobvk')].petname, '')
+        self.state.save.assert_called_once()
+
+    def test_atomic_batch_rolls_back(self):
+        self._add_alice_ok()
+        self.state.save = MagicMock()
+        snapshot = copy.deepcopy(self.state._dict())
+        res = self.state.batch(
+            [
+                (
+                    'INCOMING_DESCRIPTOR',
+                    desc(
+                        vk=mkk('bobvk'), v4a='10.0.0.2', hostname='bob.local'
+                    ),
+                ),
+                (
+                    'USER_EDIT',
+                    'SET',
+                    ['peers', mkk('bobvk'), 'petname'],
+                    'alice.local',
+                ),
+                ('USER_EDIT', 'SET', ['prefs', 'pin_new_peers'], True),
+            ],
+            atomic=True,
+        )
+        self.assertIsNotNone(res.error)
+        self.assertEqual(len(res.results), 2)
+        self.assertEqual(res.triggers, [])
+        self.assertEqual(self.state._dict(), snapshot)
+        self.state.save.assert_not_called()
+
+    def test_batch_runs_triggers_once(self):
+        target = self.state.trigger_target = MagicMock()
+        target.get_new_system_state.return_value = None
+        target.remove_unknown.return_value = None
+        res = self._assert_res_no_error(
+            self.state.batch(
+                [
+                    ('USER_EDIT', 'SET', ['prefs', 'pin_new_peers'], True),
+                    ('USER_EDIT', 'SET', ['prefs', 'pin_new_peers'], False),
+                ]
+            )
+        )
+        self.assertEqual(
+            [name for name, args in res.triggers],
+            ['get_new_system_state', 'remove_unknown'],
+        )
+        target.get_new_system_state.assert_called_once_with()
+        target.remove_unknown.assert_called_once_with()
+
+    def test_triggers_are_merged(self):
+        self._add_alice_ok()
+        self._assert_res_no_error(
+            self.state.event_USER_PEER_ADDR_ADD(mkk('alicevk'), '10.0.0.3')
+        )
+        target = self.state.trigger_target = MagicMock()
+        res = self._assert_res_no_error(
+            self.state.batch(
+                [
+                    ('USER_PEER_ADDR_DEL', mkk('alicevk'), '10.0.0.1'),
+                    (
+                        'USER_EDIT',
+                        'SET',
+                        ['peers', mkk('alicevk'), 'pinned'],
+                        True,
+                    ),
+                    ('USER_PEER_ADDR_DEL', mkk('alicevk'), '10.0.0.3'),
+                ]
+            )
+        )
+        self.assertEqual(
+            raw(res.triggers),
+            [
+                ['sync_peer', [mkk('alicevk')]],
+                ['remove_routes', [['10.0.0.1/32', '10.0.0.3/32']]],
+                ['remove_unknown', []],
+            ],
+        )
+        target.sync_peer.assert_called_once_with(mkk('alicevk'))
+        target.remove_routes.assert_called_once_with(
+            ['10.0.0.1/32', '10.0.0.3/32']
+        )
+        target.remove_unknown.assert_called_once_with()
+
+    def test_trigger_executor(self):
+        release = threading.Event()
+        calls = []
+
+        def sync_peer(vk):
+            release.wait()
+            return vk
+
+        target = MagicMock()
+        target.sync_peer.side_effect = sync_peer
+        target.remove_unknown.side_effect = lambda: calls.append('rm')
+        self.state.record = lambda res: calls.append(res.event[0])
+        executor = TriggerExecutor(target, maxsize=2)
+        self.state.trigger_executor = executor
+        self._add_alice_ok()
+        res = self.state.event_USER_EDIT(
+            'SET', ['peers', mkk('alicevk'), 'pinned'], True
+        )
+        self.assertTrue(res.pending)
+        self.assertFalse(res.wait(0.01))
+        self.assertEqual(executor.backlog, 2)
+        self.assertEqual(calls, [])
+        release.set()
+        self.assertTrue(res.wait(5))
+        self.assertFalse(res.pending)
+        self.assertEqual(res.trigger_results, [mkk('alicevk'), None])
+        self.assertEqual(calls, ['INCOMING_DESCRIPTOR', 'rm', 'USER_EDIT'])
+        self.assertTrue(executor.join(5))
+        executor.stop()
+
+    def test_trigger_executor_call(self):
+        release = threading.Event()
+        calls = []
+        target = MagicMock()
+        target.sync_peer.side_effect = lambda vk: release.wait()
+        executor = TriggerExecutor(target)
+        self.state.trigger_executor = executor
+        self._add_alice_ok()
+        res = self.state.event_USER_EDIT(
+            'SET', ['peers', mkk('alicevk'), 'pinned'], True
+        )
+        thread = threading.Thread(
+            target=lambda: calls.append(
+                executor.call(lambda: threading.current_thread())
+            )
+        )
+        thread.start()
+        thread.join(0.01)
+
+        # the call waits for the triggers which were submitted before it
+        self.assertEqual(calls, [])
+        release.set()
+        thread.join(5)
+        self.assertTrue(res.wait(5))
+        self.assertEqual(calls, [executor._thread])
+        with self.assertRaises(ZeroDivisionError):
+            executor.call(lambda: 1 / 0)
+        executor.stop()
+
+    def test_event_queue(self):
+        queue = self.state.event_queue = EventQueue(self.state)
+        started, release = threading.Event(), threading.Event()
+        queue.submit('BLOCK', lambda: started.set() or release.wait())
+        self.assertTrue(started.wait(5))
+        threads = []
+        self.state.record = lambda res: threads.append(
+            (res.event[0], threading.current_thread())
+        )
+        descriptor = queue.submit(
+            'INCOMING_DESCRIPTOR',
+            OrganizeState.event_INCOMING_DESCRIPTOR,
+            self.state,
+            desc(hostname='alice.local', vk=mkk('alicevk'), v4a='10.0.0.1'),
+        )
+        edit = queue.submit(
+            'USER_EDIT',
+            OrganizeState.event_USER_EDIT,
+            self.state,
+            'SET',
+            'prefs.pin_new_peers',
+            True,
+        )
+        self.assertEqual(queue.depth, 2)
+        release.set()
+        self._assert_res_no_error(descriptor.result(5))
+        self._assert_res_no_error(edit.result(5))
+        # the user edit jumped the queue, so alice got pinned
+        self.assertEqual(
+            [name for name, thread in threads],
+            ['USER_EDIT', 'INCOMING_DESCRIPTOR'],
+        )
+        self.assertTrue(self.state.peers[mkk('alicevk')].pinned)
+        # events called from other threads run on the queue's thread too
+        self._assert_res_no_error(
+            self.state.event_USER_EDIT('SET', 'prefs.pin_new_peers', False)
+        )
+        self._assert_res_no_error(
+            self.state.batch([('USER_EDIT', 'SET', 'prefs.expire_time', 5)])
+        )
+        self.assertEqual(len(threads), 4)
+        self.assertEqual(
+            set(thread for name, thread in threads), {queue._thread}
+        )
+        stats = queue.stats()
+        self.assertEqual((stats['depth'], stats['max_depth']), (0, 2))
+        self.assertEqual(
+            {p: s['events'] for p, s in stats['priorities'].items()},
+            {0: 3, 1: 1, 2: 1},
+        )
+        queue.stop()
+
+    def test_event_timings(self):
+        self.state.trigger_target = MagicMock()
+        res = self._add_alice_ok()
+        self.assertEqual(
+            list(res.timings),
+            ['copy', 'actions', 'validate', 'commit', 'save', 'triggers'],
+        )
+        self.assertTrue(all(ns >= 0 for ns in res.timings.values()))
+        res = self.state.event_USER_EDIT('SET', 'prefs.pin_new_peers', False)
+        self.assertEqual(list(res.timings), ['copy', 'actions', 'triggers'])
+        stats = self.state.timings.stats()
+        self.assertEqual(stats['INCOMING_DESCRIPTOR']['save']['count'], 1)
+        self.assertEqual(stats['USER_EDIT']['copy']['count'], 2)
+        # only the edit in setUp changed and saved the state
+        self.assertEqual(stats['USER_EDIT']['save']['count'], 1)
+
+    def test_batch_unknown_event(self):
+        with self.assertRaises(ValueError):
+            self.state.batch([('NO_SUCH_EVENT',)])
+
+    def test_replay_writes(self):
+        saved = []
+        self.state.save = lambda *results: saved.extend(results)
+        initial = OrganizeState(self.state._dict())
+        self._add_alice_bob_same_ip_and_hostname()
+        self._assert_res_no_error(
+            self.state.event_USER_PEER_ADDR_ADD(mkk('bobvk'), '10.0.0.3')
+        )
+        self.state.batch(
+            [
+                ('USER_EDIT', 'SET', ['prefs', 'pin_new_peers'], True),
+                ('USER_REMOVE_PEER', 'alice.local'),
+            ]
+        )
+        for res in saved:
+            initial.replay(raw(res.writes))
+        self.assertEqual(initial._dict(), self.state._dict())
+
+    def test_replay_invalid_writes(self):
+        snapshot = copy.deepcopy(self.state._dict())
+        with self.assertRaises(schema.SchemaError):
+            self.state.replay(
+                [
+                    ['SET', ['prefs', 'pin_new_peers'], True],
+                    ['SET', ['prefs', 'expire_time'], 'never'],
+                ]
+            )
+        self.assertEqual(self.state._dict(), snapshot)
+
     def test_remove_nonlocal_unpinned(self):
         self._add_alice_ok()
         _ = self._assert_res_actions(
@@ -371,6 +820,32 @@ class TestOrganizeEngine(unittest.TestCase):
             ['ADJUST_TO_NEW_SYSTEM_STATE', 'REMOVE_PEER'],
         )
 
+    def test_conflicts_are_checked_incrementally(self):
+        self._add_alice_ok()
+        self._add_bob_maybe()
+        with unittest.mock.patch.object(
+            Peers, 'conflicts', PropertyMock(side_effect=AssertionError)
+        ):
+            self._process_descriptor(
+                hostname='carol.local',
+                vk=mkk('carolvk'),
+                pk=mkk('carolpk'),
+                v4a='10.0.0.3',
+                actions=['ACCEPT_NEW_PEER'],
+            )
+            self._assert_res_no_error(
+                self.state.event_USER_EDIT(
+                    'SET', ['peers', mkk('bobvk'), 'petname'], 'robert.local'
+                )
+            )
+        # conflicts with peers which weren't written to are found both ways
+        for vk, name in (('bobvk', 'alice.local'), ('alicevk', 'carol.local')):
+            res = self.state.event_USER_EDIT(
+                'SET', ['peers', mkk(vk), 'petname'], name
+            )
+            self.assertIsInstance(res.error, schema.SchemaError)
+        self.assertEqual(self.state.peers.conflicts, '')
+
     def test_user_edit_hostname_collision(self):
         self._add_alice_ok()
         self._assert_res_actions(
@@ -8,7 +8,7 @@ from click.globals import push_context, pop_context
 from highctidh import ctidh  # type: ignore
 
 from vula.csidh import ctidh_parameters
-from vula.organize import Organize
+from vula.organize import Organize, SystemState
 
 
 class TestOrganize(unittest.TestCase):
@@ -102,3 +102,188 @@ class TestOrganize(unittest.TestCase):
 
         # Assert - first and second result must be identical
         assert result_one_first == result_one_third
+
+    @patch("vula.organize.Organize._write_hosts_file")
+    @patch("vula.organize.Sys")
+    def test_state_journal(
+        self,
+        mocked_sys: MagicMock,
+        mocked_write_hosts_file: MagicMock,
+    ) -> None:
+        # Arrange
+        keys_file = self.tmp_path.joinpath("keys.json")
+        keys_file.touch()
+        state_file = self.tmp_path.joinpath("state.yaml")
+        journal_file = self.tmp_path.joinpath("state.journal")
+
+        def load() -> Organize:
+            push_context(MagicMock())
+            organize = Organize(
+                keys_file=keys_file.as_posix(),
+                state_file=state_file.as_posix(),
+                interface=MagicMock(),
+            )  # type: ignore[call-arg]
+            pop_context()
+            return organize
+
+        organize = load()
+
+        # Act - the first save writes a snapshot
+        organize.state.event_USER_EDIT('SET', 'prefs.pin_new_peers', True)
+        snapshot = state_file.read_text()
+
+        # Act - the following saves only append to the journal
+        organize.state.event_USER_EDIT('SET', 'prefs.expire_time', 10)
+        organize.state.event_USER_EDIT('ADD', 'prefs.local_domains', 'lan')
+
+        # Assert
+        assert state_file.read_text() == snapshot
+        assert len(journal_file.read_text().splitlines()) == 3
+
+        # Act - load the snapshot and replay the journal
+        reloaded = load()
+
+        # Assert
+        assert reloaded.state._dict() == organize.state._dict()
+        assert reloaded.prefs.expire_time == 10
+
+        # Act - reach the snapshot interval
+        reloaded._journal.snapshot_interval = 2
+        reloaded.state.event_USER_EDIT('SET', 'prefs.expire_time', 20)
+
+        # Assert
+        assert state_file.read_text() != snapshot
+        assert len(journal_file.read_text().splitlines()) == 1
+        assert load().state._dict() == reloaded.state._dict()
+
+    @patch("vula.organize.chown_like_dir_if_root")
+    @patch("vula.organize.Sys")
+    def test_coalesced_saves(
+        self,
+        mocked_sys: MagicMock,
+        mocked_chown: MagicMock,
+    ) -> None:
+        # Arrange
+        keys_file = self.tmp_path.joinpath("keys.json")
+        keys_file.touch()
+        state_file = self.tmp_path.joinpath("state.yaml")
+        journal_file = self.tmp_path.joinpath("state.journal")
+        hosts_file = self.tmp_path.joinpath("hosts")
+        patcher = patch("vula.organize._ORGANIZE_HOSTS_FILE", str(hosts_file))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        push_context(MagicMock())
+        organize = Organize(
+            keys_file=keys_file.as_posix(),
+            state_file=state_file.as_posix(),
+            interface=MagicMock(),
+        )  # type: ignore[call-arg]
+        pop_context()
+        saver = organize._coalesce_saves()
+
+        # Act - user edits are saved right away
+        organize.state.event_USER_EDIT('SET', 'prefs.save_delay', 60)
+        organize.state.event_USER_EDIT('SET', 'prefs.save_fsync', False)
+
+        # Assert
+        assert len(journal_file.read_text().splitlines()) == 2
+
+        # Act - other events wait to be saved together
+        for gateway in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            organize.state.event_NEW_SYSTEM_STATE(
+                SystemState(gateways=[gateway])
+            )
+
+        # Assert
+        assert len(journal_file.read_text().splitlines()) == 2
+        assert saver.stats()['pending'] == 3
+        hosts_file.unlink()
+
+        # Act
+        saver.flush()
+
+        # Assert
+        assert len(journal_file.read_text().splitlines()) == 3
+        assert saver.stats() == dict(
+            requested=5, written=3, avoided=2, pending=0
+        )
+        assert hosts_file.exists()
+
+    @patch("vula.organize.chown_like_dir_if_root")
+    @patch("vula.organize.Sys")
+    def test_hosts_file_written_when_changed(
+        self,
+        mocked_sys: MagicMock,
+        mocked_chown: MagicMock,
+    ) -> None:
+        # Arrange
+        keys_file = self.tmp_path.joinpath("keys.json")
+        keys_file.touch()
+        state_file = self.tmp_path.joinpath("state.yaml")
+        hosts_file = self.tmp_path.joinpath("hosts")
+        patcher = patch("vula.organize._ORGANIZE_HOSTS_FILE", str(hosts_file))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        push_context(MagicMock())
+        organize = Organize(
+            keys_file=keys_file.as_posix(),
+            state_file=state_file.as_posix(),
+            interface=MagicMock(),
+        )  # type: ignore[call-arg]
+        pop_context()
+
+        # Act & Assert - written the first time
+        assert organize._write_hosts_file() is True
+        text = hosts_file.read_text()
+
+        # Act & Assert - not rewritten while the names and IPs are the same
+        organize.state.event_USER_EDIT('SET', 'prefs.pin_new_peers', True)
+        assert organize._write_hosts_file() is False
+        assert hosts_file.read_text() == text
+
+        # Act & Assert - rewritten if it was removed
+        hosts_file.unlink()
+        assert organize._write_hosts_file() is True
+        assert hosts_file.read_text() == text
+
+        # Act & Assert - rewritten by the save when our address changes
+        organize.state.event_NEW_SYSTEM_STATE(
+            SystemState(current_subnets={'10.0.0.0/24': ['10.0.0.5']})
+        )
+        assert '10.0.0.5 ' in hosts_file.read_text()
+        assert organize._write_hosts_file() is False
+
+    @patch("vula.organize.Sys")
+    def test_stats_are_authorized(self, mocked_sys: MagicMock) -> None:
+        # Arrange
+        keys_file = self.tmp_path.joinpath("keys.json")
+        keys_file.touch()
+        state_file = self.tmp_path.joinpath("state.yaml")
+        push_context(MagicMock())
+        organize = Organize(
+            keys_file=keys_file.as_posix(),
+            state_file=state_file.as_posix(),
+            interface=MagicMock(),
+        )  # type: ignore[call-arg]
+        pop_context()
+        organize.sys.netlink_event_stats.return_value = dict(received=1)
+        organize.sys.last_sync = None
+        dbus_context = MagicMock()
+
+        # Act & Assert - DBus callers need authorization
+        dbus_context.is_authorized.return_value = False
+        assert organize.stats(False, dbus_context) == "Forbidden"
+        assert organize.event_timings(False, dbus_context) == "Forbidden"
+        dbus_context.is_authorized.assert_called_with(
+            'local.vula.organize1.Debug.event_timings',
+            details={},
+            interactive=False,
+        )
+        dbus_context.is_authorized.return_value = True
+        assert 'received: 1' in organize.stats(False, dbus_context)
+
+        # Act & Assert - the command line asks the running organize
+        with patch("vula.organize.organize_dbus_if_active") as mocked_dbus:
+            mocked_dbus.return_value.stats.return_value = "stats"
+            assert organize.stats() == "stats"
+            mocked_dbus.return_value.stats.assert_called_once_with(True)
@@ -4,7 +4,7 @@ from ipaddress import IPv4Address, IPv6Address
 
 import schema
 
-from vula.peer import Descriptor
+from vula.peer import Descriptor, Peer
 
 
 def desc(vk, v4a, hostname, **kw):
@@ -64,6 +64,52 @@ class TestDescriptor(unittest.TestCase):
         with self.assertRaises(schema.SchemaError):
             desc(hostname='alice.local', vk=mkk('1'), v4a='10.0.0.256')
 
+    def test_compiled_schema(self):
+        valid = desc(hostname='alice.local', vk=mkk('1'), v4a='10.0.0.1')
+        data = {k: str(v) for k, v in valid.items()}
+        self.assertIsNotNone(Descriptor.schema.compiled)
+        for change in (
+            {},
+            dict(e='yes', v6a='fe80::1,fdff::2'),
+            dict(port='0'),
+            dict(hostname='alice local'),
+            dict(vk='x'),
+            dict(unknown='key'),
+            dict(e=None),
+        ):
+            test = {k: v for k, v in dict(data, **change).items() if v}
+            try:
+                expected = Descriptor.schema.interpreted.validate(test)
+            except schema.SchemaError as ex:
+                with self.assertRaises(schema.SchemaError) as cm:
+                    Descriptor.schema.validate(test)
+                self.assertEqual(cm.exception.args, ex.args)
+            else:
+                result = Descriptor.schema.validate(test)
+                self.assertEqual(list(result), list(expected))
+                self.assertEqual(repr(result), repr(expected))
+
+
+class TestPeer(unittest.TestCase):
+    def test_compact_representation(self):
+        peer = desc(
+            hostname='alice.local', vk=mkk('1'), v4a='10.0.0.1', v6a='fe80::1'
+        ).make_peer()
+        loaded = Peer(peer._dict())
+        self.assertEqual(loaded._dict(), peer._dict())
+        self.assertEqual(loaded.enabled_ips, peer.enabled_ips)
+        # the addresses are the descriptor's address objects
+        for key, addrs in (('IPv4addrs', 'v4a'), ('IPv6addrs', 'v6a')):
+            self.assertEqual(
+                [id(a) for a in loaded[key]],
+                [id(a) for a in loaded.descriptor[addrs]],
+            )
+        # flags are shared, keys are bytes, and none of these has a __dict__
+        self.assertIs(loaded.enabled, peer.enabled)
+        self.assertEqual(bytes(loaded.descriptor.vk), b64decode(mkk('1')))
+        for value in (loaded.enabled, loaded.descriptor.v4a):
+            self.assertFalse(hasattr(value, '__dict__'))
+
 
 class TestPeerShow(unittest.TestCase):
     """
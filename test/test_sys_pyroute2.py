@@ -1,7 +1,16 @@
 import time
+from ipaddress import ip_address, ip_network
 from unittest.mock import MagicMock, patch
 
 import vula.sys_pyroute2
+from vula.organize import SystemState
+
+
+class Msg(dict):
+    """A stand-in for a pyroute2 netlink message."""
+
+    def get_attr(self, name):
+        return dict(self.get('attrs', ())).get(name)
 
 
 class TestSys:
@@ -68,3 +77,399 @@ class TestSys:
 
             sys.get_new_system_state.assert_not_called()
             assert mock_organize.log.info.call_count == 2
+
+    def test_sync_routes_uses_longest_prefix_source(self):
+        mock_organize = MagicMock()
+        mock_organize.state.system_state = SystemState(
+            current_subnets={
+                '10.0.0.0/8': ['10.0.0.1'],
+                '10.1.0.0/16': ['10.1.0.1'],
+            }
+        )
+        with patch("vula.sys_pyroute2.IPRoute") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ):
+            mock_ipr.return_value.route.return_value = []
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            res = sys.sync_routes(
+                ['10.1.2.3/32', '10.2.0.1/32', '192.168.0.1/32'],
+                1000,
+                dryrun=True,
+            )
+        assert [
+            line.split(' src ')[-1].split()[0]
+            for line in res.split('\n')
+            if ' src ' in line
+        ] == ['10.1.0.1', '10.0.0.1']
+        assert len(res.split('\n')) == 3
+
+    def test_reconcile_plans_from_one_snapshot(self):
+        def link(index, name, kind):
+            return Msg(
+                index=index,
+                state='up',
+                attrs=[
+                    ('IFLA_IFNAME', name),
+                    ('IFLA_LINKINFO', Msg(attrs=[('IFLA_INFO_KIND', kind)])),
+                ],
+            )
+
+        def route(table, dst, dst_len):
+            return Msg(
+                dst_len=dst_len,
+                scope=0,
+                attrs=[('RTA_TABLE', table), ('RTA_DST', dst)],
+            )
+
+        peer = MagicMock(use_as_gateway=False)
+        peer.descriptor.pk = 'alicepk'
+        peer.routes = ['10.0.0.2/32', '10.0.0.3/32']
+        peer.wg_config.return_value = dict(public_key='alicepk')
+        # a peer whose config can't be made doesn't stop the others' sync
+        bad_peer = MagicMock(use_as_gateway=False, routes=[])
+        bad_peer.descriptor.pk = 'carolpk'
+        bad_peer.wg_config.side_effect = ValueError('bad key')
+        mock_organize = MagicMock(table=666, fwmark=555, ip_rule_priority=666)
+        mock_organize.interface = 'vula'
+        mock_organize.port = 5354
+        mock_organize._keys.wg_Curve25519_sec_key = 'sk'
+        mock_organize.prefs.primary_ip = ip_address('fdff:ffff:ffdf::1')
+        mock_organize.peers.limit.side_effect = lambda **kw: (
+            {}
+            if kw.get('use_as_gateway')
+            else {'alicevk': peer, 'carolvk': bad_peer}
+        )
+        mock_organize.state.system_state = SystemState()
+        with patch("vula.sys_pyroute2.IPRoute") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ) as mock_wgi:
+            ipr = mock_ipr.return_value
+            ipr.get_links.return_value = [
+                link(1, 'vula', 'wireguard'),
+                link(2, 'vula-net', 'dummy'),
+            ]
+            ipr.get_addr.return_value = [
+                Msg(index=2, attrs=[('IFA_ADDRESS', 'fdff:ffff:ffdf::1')])
+            ]
+            ipr.get_rules.return_value = [
+                Msg(
+                    flags=0x02,
+                    attrs=[
+                        ('FRA_TABLE', 666),
+                        ('FRA_FWMARK', 555),
+                        ('FRA_PRIORITY', 666),
+                    ],
+                )
+            ]
+            ipr.get_routes.return_value = [
+                route(666, '10.0.0.2', 32),
+                route(666, '10.0.0.9', 32),
+            ]
+            wgi = mock_wgi.return_value
+            wgi.query.return_value = dict(
+                private_key=b'sk', listen_port=5354, fwmark=555
+            )
+            wgi.peers = [dict(public_key='alicepk'), dict(public_key='bobpk')]
+            wgi.peerconfig_changes.return_value = ([], None)
+            wgi.round_trips = 0
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+
+            dryrun = sys.reconcile(dryrun=True)
+            ipr.route.assert_not_called()
+            wgi.set_peers.assert_not_called()
+            res = sys.reconcile()
+
+        assert (
+            dryrun
+            == res
+            == [
+                "ValueError('bad key')",
+                'wg set vula peer bobpk remove',
+                'ip route del 10.0.0.9/32 table 666 scope global',
+                'ip route add 10.0.0.3/32 dev vula proto static scope link '
+                'table 666',
+            ]
+        )
+        assert ipr.get_routes.call_count == wgi.query.call_count == 2
+        wgi.set_peers.assert_called_once_with(
+            [dict(public_key='bobpk', remove=True)]
+        )
+        assert sys.last_sync['operations'] == 4
+        assert [c.args[0] for c in ipr.route.call_args_list] == ['del', 'add']
+        wgi.peerconfig_changes.assert_called_with(
+            dict(public_key='alicepk'), dict(public_key='alicepk')
+        )
+
+    def test_remove_unknown_dumps_only_peers_and_routes(self):
+        def route(table, dst):
+            return Msg(
+                dst_len=32,
+                scope=0,
+                attrs=[('RTA_TABLE', table), ('RTA_DST', dst)],
+            )
+
+        peer = MagicMock(routes=['10.0.0.2/32'])
+        peer.descriptor.pk = 'alicepk'
+        mock_organize = MagicMock(table=666)
+        mock_organize.interface = 'vula'
+        mock_organize.peers.limit.side_effect = lambda **kw: (
+            {} if kw.get('use_as_gateway') else {'alicevk': peer}
+        )
+        with patch("vula.sys_pyroute2.IPRoute") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ) as mock_wgi:
+            ipr = mock_ipr.return_value
+            ipr.get_routes.return_value = [
+                route(666, '10.0.0.2'),
+                route(666, '10.0.0.9'),
+                route(254, '10.0.0.9'),
+                route(255, '10.0.0.9'),
+            ]
+            wgi = mock_wgi.return_value
+            wgi.query.return_value = {}
+            wgi.peers = [dict(public_key='alicepk'), dict(public_key='bobpk')]
+            res = vula.sys_pyroute2.Sys(mock_organize).remove_unknown(
+                dryrun=True
+            )
+
+        assert res == [
+            'wg set vula peer bobpk remove',
+            'ip route del 10.0.0.9/32 table 666 scope global',
+        ]
+        ipr.get_links.assert_not_called()
+        ipr.get_addr.assert_not_called()
+        ipr.get_rules.assert_not_called()
+        assert ipr.get_routes.call_count == wgi.query.call_count == 1
+
+    def test_link_table_follows_link_events(self):
+        def link(event, index, name):
+            return Msg(event=event, index=index, attrs=[('IFLA_IFNAME', name)])
+
+        events = [
+            link('RTM_NEWLINK', 2, 'eth0'),
+            link('RTM_NEWLINK', 2, 'lan0'),
+            link('RTM_DELLINK', 3, 'wlan0'),
+        ]
+
+        def get():
+            sys._stop_monitor = len(events) == 1
+            return [events.pop(0)]
+
+        mock_organize = MagicMock()
+        mock_organize.prefs.iface_prefix_allowed = ['']
+        mock_organize.prefs.subnets_forbidden_matcher = []
+        with patch("vula.sys_pyroute2.IPRSocket") as mock_iprsocket, patch(
+            "vula.sys_pyroute2.IPRoute"
+        ) as mock_ipr, patch("vula.sys_pyroute2.WgInterface"):
+            ipr = mock_ipr.return_value
+            ipr.get_routes.return_value = []
+            ipr.get_links.return_value = [
+                link(None, 1, 'lo'),
+                link(None, 3, 'wlan0'),
+            ]
+            ipr.get_addr.return_value = [
+                Msg(
+                    index=1, prefixlen=8, attrs=[('IFA_ADDRESS', '127.0.0.1')]
+                ),
+                Msg(
+                    index=2, prefixlen=24, attrs=[('IFA_ADDRESS', '10.0.0.1')]
+                ),
+            ]
+            mock_iprsocket.return_value.get.side_effect = get
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+
+            # Act - fill the table, then follow the link events
+            assert sys.link_index('wlan0') == 3
+            sys._monitor()
+
+            # Assert
+            assert list(sys._get_system_state()[1]) == ['lo', 'lan0']
+            assert sys.link_index('lan0') == 2
+            ipr.link_lookup.return_value = []
+            assert sys.link_index('eth0') is None
+            assert sys.link_index('wlan0') is None
+            assert ipr.get_links.call_count == 1
+            sys.get_new_system_state.assert_not_called()
+
+            # the table which the projection reads isn't changed by events
+            links = sys.idx_to_link_name
+            sys._link_event('RTM_DELLINK', link('RTM_DELLINK', 2, 'lan0'))
+            assert links[2] == 'lan0'
+            assert sys.link_index('lan0') is None
+
+    def test_system_state_follows_netlink_events(self):
+        def addr(event, address):
+            return Msg(
+                event=event,
+                index=2,
+                prefixlen=24,
+                attrs=[('IFA_ADDRESS', address)],
+            )
+
+        def route(event, dst, gateway=None):
+            attrs = [('RTA_TABLE', 254), ('RTA_DST', dst), ('RTA_OIF', 2)]
+            if gateway:
+                attrs.append(('RTA_GATEWAY', gateway))
+            return Msg(event=event, family=2, dst_len=24, attrs=attrs)
+
+        events = [
+            # a route for one of our peers
+            route('RTM_NEWROUTE', '10.0.1.0'),
+            addr('RTM_NEWADDR', '10.0.2.1'),
+            # another route through the same gateway
+            route('RTM_NEWROUTE', '10.0.3.0', '10.0.0.254'),
+            route('RTM_DELROUTE', '10.0.4.0', '10.0.0.254'),
+            route('RTM_DELROUTE', '10.0.3.0', '10.0.0.254'),
+        ]
+
+        def get():
+            sys._stop_monitor = len(events) == 1
+            return [events.pop(0)]
+
+        mock_organize = MagicMock(v4_enabled=True, v6_enabled=True)
+        mock_organize.prefs.iface_prefix_allowed = ['eth']
+        mock_organize.prefs.subnets_forbidden_matcher = []
+        mock_organize.prefs.netlink_debounce = 0
+        with patch("vula.sys_pyroute2.IPRSocket") as mock_iprsocket, patch(
+            "vula.sys_pyroute2.IPRoute"
+        ) as mock_ipr, patch("vula.sys_pyroute2.WgInterface"):
+            ipr = mock_ipr.return_value
+            ipr.get_links.return_value = [
+                Msg(index=2, attrs=[('IFLA_IFNAME', 'eth0')])
+            ]
+            ipr.get_addr.return_value = [addr(None, '10.0.0.1')]
+            ipr.get_routes.return_value = [
+                route(None, '10.0.4.0', '10.0.0.254')
+            ]
+            mock_iprsocket.return_value.get.side_effect = get
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            reasons = []
+            sys.get_new_system_state = lambda reason: (
+                reasons.append(reason),
+                sys._get_system_state(),
+            )
+            subnets, interfaces, gateways, has_v6 = sys._get_system_state()
+
+            # Act
+            sys._monitor()
+
+        # Assert
+        assert gateways == [ip_address('10.0.0.254')]
+        assert reasons == [
+            'RTM_NEWADDR netlink event',
+            'RTM_DELROUTE netlink event',
+        ]
+        subnets, interfaces, gateways, has_v6 = sys._projection
+        assert interfaces == {
+            'eth0': [ip_address('10.0.0.1'), ip_address('10.0.2.1')]
+        }
+        assert gateways == []
+        assert ipr.get_addr.call_count == ipr.get_routes.call_count == 1
+
+    def test_netlink_events_are_debounced(self):
+        def route(event, dst, gateway=None):
+            attrs = [('RTA_TABLE', 254), ('RTA_DST', dst), ('RTA_OIF', 2)]
+            if gateway:
+                attrs.append(('RTA_GATEWAY', gateway))
+            return Msg(event=event, family=2, dst_len=24, attrs=attrs)
+
+        mock_organize = MagicMock(v4_enabled=True, v6_enabled=True)
+        mock_organize.prefs.iface_prefix_allowed = ['eth']
+        mock_organize.prefs.subnets_forbidden_matcher = []
+        mock_organize.prefs.netlink_debounce = 60
+        with patch("vula.sys_pyroute2.IPRoute") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ):
+            ipr = mock_ipr.return_value
+            ipr.get_links.return_value = [
+                Msg(index=2, attrs=[('IFLA_IFNAME', 'eth0')])
+            ]
+            ipr.get_addr.return_value = []
+            ipr.get_routes.return_value = []
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+            sys._get_system_state()
+
+            # Act - a route we add ourselves
+            sys._route_add(ip_network('10.0.5.0/24'), 254, None)
+            sys._netlink_event(
+                'RTM_NEWROUTE', route('RTM_NEWROUTE', '10.0.5.0', '10.0.0.9')
+            )
+
+            # Assert
+            sys.get_new_system_state.assert_not_called()
+            assert sys._refresh_timer is None
+
+            # Act - a burst of events from elsewhere
+            for dst in ('10.0.6.0', '10.0.7.0', '10.0.8.0'):
+                sys._netlink_event(
+                    'RTM_NEWROUTE', route('RTM_NEWROUTE', dst, '10.0.0.254')
+                )
+            sys._netlink_event(
+                'RTM_NEWROUTE', route('RTM_NEWROUTE', '10.0.9.0')
+            )
+
+            # Assert - one refresh is waiting for the window to pass
+            sys.get_new_system_state.assert_not_called()
+            sys._refresh_timer.cancel()
+            sys._refresh()
+            sys.get_new_system_state.assert_called_once_with(
+                'RTM_NEWROUTE netlink event and 2 more'
+            )
+            assert sys._get_system_state()[2] == [
+                ip_address('10.0.0.9'),
+                ip_address('10.0.0.254'),
+            ]
+            assert sys.netlink_event_stats() == dict(
+                received=5,
+                suppressed=1,
+                unchanged=1,
+                coalesced=2,
+                refreshes=1,
+            )
+
+    def test_periodic_redump(self):
+        mock_organize = MagicMock(v4_enabled=True, v6_enabled=True)
+        mock_organize.prefs.iface_prefix_allowed = ['eth']
+        mock_organize.prefs.subnets_forbidden_matcher = []
+        with patch("vula.sys_pyroute2.IPRoute") as mock_ipr, patch(
+            "vula.sys_pyroute2.WgInterface"
+        ):
+            ipr = mock_ipr.return_value
+            ipr.get_links.return_value = [
+                Msg(index=2, attrs=[('IFLA_IFNAME', 'eth0')])
+            ]
+            ipr.get_addr.return_value = []
+            ipr.get_routes.return_value = []
+            sys = vula.sys_pyroute2.Sys(mock_organize)
+            sys.get_new_system_state = MagicMock()
+            sys._get_system_state()
+
+            # Act - a dump which matches the model
+            sys._redump()
+
+            # Assert
+            sys.get_new_system_state.assert_not_called()
+
+            # Act - a gateway whose event was missed
+            ipr.get_routes.return_value = [
+                Msg(
+                    family=2,
+                    dst_len=0,
+                    attrs=[
+                        ('RTA_TABLE', 254),
+                        ('RTA_OIF', 2),
+                        ('RTA_GATEWAY', '10.0.0.254'),
+                    ],
+                )
+            ]
+            sys._redump()
+
+            # Assert
+            sys.get_new_system_state.assert_called_once_with(
+                "periodic re-dump"
+            )
+            assert sys._redump_timer.is_alive()
+            sys.stop_monitor()
+            assert sys._redump_timer is None
@@ -1,7 +1,11 @@
+from base64 import b64encode
+from socket import AF_INET, AF_INET6
 from unittest import mock
 from unittest.mock import Mock
 
 from nacl.signing import SigningKey
+from pyroute2.netlink import NLM_F_ACK, NLM_F_REQUEST
+from pyroute2.netlink.generic.wireguard import WG_CMD_SET_DEVICE
 
 import vula.wg
 from vula.common import attrdict
@@ -303,6 +307,169 @@ class TestInterface:
             peer=attrdict(public_key=existing_peer_pubkey, remove=True),
         )
 
+    def test_peerconfig_changes_compares_with_cur(self):
+        """
+        The config is compared with the given current config, not with the
+        peers which the interface last queried.
+        """
+        with mock.patch("vula.wg.PyRoute2WireGuard"):
+            interface = vula.wg.Interface("vula")
+        interface.update(popluated_interface())
+        existing_peer_pubkey = 'hDzSznlwlq9mk07QpNk+AcsfprrLg2DxSv3JAOLXhFQ='
+        other_pubkey = "Rbt3m34X1PPIEd/LvW9G0tbImDfcQW0MyvGikM7ayio="
+
+        # a peer which the interface has, but the snapshot doesn't
+        res, new = interface.peerconfig_changes(
+            attrdict(
+                public_key=existing_peer_pubkey,
+                allowed_ips=['10.89.0.3/32'],
+            ),
+            None,
+        )
+        assert res[0] == (
+            f'# configure new wireguard peer {existing_peer_pubkey}'
+        )
+        assert new == dict(
+            public_key=existing_peer_pubkey, allowed_ips=['10.89.0.3/32']
+        )
+
+        # a peer which the snapshot has, but the interface doesn't
+        cur = dict(
+            public_key=other_pubkey,
+            allowed_ips=['10.89.0.4/32'],
+            persistent_keepalive=0,
+        )
+        res, new = interface.peerconfig_changes(
+            attrdict(public_key=other_pubkey, persistent_keepalive=0), cur
+        )
+        assert res == []
+        assert new is None
+        res, new = interface.peerconfig_changes(
+            attrdict(public_key=other_pubkey, allowed_ips=['10.89.0.5/32']),
+            cur,
+        )
+        assert res[-2] == f'# reconfigure wireguard peer {other_pubkey}'
+        assert new == dict(
+            public_key=other_pubkey, allowed_ips=['10.89.0.5/32']
+        )
+
+    def test_apply_peerconfigs(self):
+        """
+        Several peers are compared with one query, and set together.
+        """
+        with mock.patch("vula.wg.PyRoute2WireGuard") as wg_cls:
+            interface = vula.wg.Interface("vula")
+        wg_mock = wg_cls.return_value
+        wg_mock.info.return_value = mock_wg_info_return()
+        existing_peer_pubkey = 'hDzSznlwlq9mk07QpNk+AcsfprrLg2DxSv3JAOLXhFQ='
+        new_pubkeys = [
+            "Rbt3m34X1PPIEd/LvW9G0tbImDfcQW0MyvGikM7ayio=",
+            "9dzFSWq40tAXr4gIp/CyDl5Xw4xu6q9xnh7dYQ2uAl0=",
+        ]
+        configs = [
+            attrdict(public_key=pk, allowed_ips=['10.89.0.%d/32' % i])
+            for i, pk in enumerate(new_pubkeys)
+        ] + [attrdict(public_key=existing_peer_pubkey, remove=True)]
+
+        res = interface.apply_peerconfigs(configs)
+
+        assert res.count('# configure new wireguard peer') == 2
+        assert f'# removing wireguard peer {existing_peer_pubkey}' in res
+        assert wg_mock.info.call_count == 2
+        wg_mock.set.assert_not_called()
+        wg_mock.nlm_request.assert_called_once()
+        (msg,) = wg_mock.nlm_request.call_args.args
+        assert wg_mock.nlm_request.call_args.kwargs == dict(
+            msg_type=wg_mock.prid, msg_flags=NLM_F_REQUEST | NLM_F_ACK
+        )
+        assert [
+            peer.get_attr('WGPEER_A_PUBLIC_KEY').decode()
+            for peer in decoded(msg).get_attr('WGDEVICE_A_PEERS')
+        ] == new_pubkeys + [existing_peer_pubkey]
+        assert interface.round_trips == 3
+
+    def test_set_peers_splits_large_batches(self):
+        with mock.patch("vula.wg.PyRoute2WireGuard") as wg_cls:
+            interface = vula.wg.Interface("vula")
+        peers = [
+            dict(
+                public_key=b64encode(b'%32d' % i).decode(),
+                allowed_ips=['10.0.0.1/32'] * 3,
+            )
+            for i in range(300)
+        ]
+
+        assert interface.set_peers(peers) == 3
+        messages = [
+            decoded(c.args[0])
+            for c in wg_cls.return_value.nlm_request.call_args_list
+        ]
+        assert [
+            peer.get_attr('WGPEER_A_PUBLIC_KEY').decode()
+            for msg in messages
+            for peer in msg.get_attr('WGDEVICE_A_PEERS')
+        ] == [peer['public_key'] for peer in peers]
+        assert all(
+            len(msg.data) <= vula.wg._WG_SET_MESSAGE_SIZE for msg in messages
+        )
+
+    def test_set_peers_message(self):
+        """
+        The set message configures each peer as WireGuard.set would.
+        """
+        pubkeys = [
+            "Rbt3m34X1PPIEd/LvW9G0tbImDfcQW0MyvGikM7ayio=",
+            "9dzFSWq40tAXr4gIp/CyDl5Xw4xu6q9xnh7dYQ2uAl0=",
+            "hDzSznlwlq9mk07QpNk+AcsfprrLg2DxSv3JAOLXhFQ=",
+        ]
+        peers = [
+            dict(public_key=pubkeys[0], allowed_ips=['10.89.0.3/32']),
+            dict(
+                public_key=pubkeys[1],
+                allowed_ips=['10.89.0.4/32', 'fdff::4/128'],
+                endpoint_addr='192.168.1.4',
+                endpoint_port=5354,
+                persistent_keepalive=25,
+            ),
+            dict(public_key=pubkeys[2], remove=True),
+        ]
+
+        msg = decoded(vula.wg._set_peers_message('vula', peers))
+
+        assert msg['cmd'] == WG_CMD_SET_DEVICE
+        assert msg.get_attr('WGDEVICE_A_IFNAME') == 'vula'
+        sent = msg.get_attr('WGDEVICE_A_PEERS')
+        assert [peer.get_attr('WGPEER_A_PUBLIC_KEY') for peer in sent] == [
+            pk.encode() for pk in pubkeys
+        ]
+        assert [
+            [
+                (
+                    a.get_attr('WGALLOWEDIP_A_FAMILY'),
+                    a.get_attr('WGALLOWEDIP_A_CIDR_MASK'),
+                )
+                for a in peer.get_attr('WGPEER_A_ALLOWEDIPS') or ()
+            ]
+            for peer in sent
+        ] == [[(AF_INET, 32)], [(AF_INET, 32), (AF_INET6, 128)], []]
+        assert sent[0].get_attr('WGPEER_A_ALLOWEDIPS')[0]['addr'] == (
+            '10.89.0.3/32'
+        )
+        endpoint = sent[1].get_attr('WGPEER_A_ENDPOINT')
+        assert (endpoint['addr'], endpoint['port']) == ('192.168.1.4', 5354)
+        assert sent[1].get_attr('WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL') == 25
+        assert [peer.get_attr('WGPEER_A_FLAGS') for peer in sent] == [0, 0, 1]
+
+
+def decoded(msg):
+    """
+    Returns a message as the kernel will see it.
+    """
+    msg.encode()
+    res = vula.wg.wgmsg(msg.data)
+    res.decode()
+    return res
+
 
 def popluated_interface():
     return {
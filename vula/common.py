@@ -21,6 +21,7 @@ import pydbus
 import yaml
 from schema import And, Or, Schema, SchemaError, Use
 
+from .compiled_schema import CompiledSchema
 from .constants import _ORGANIZE_DBUS_NAME, _ORGANIZE_DBUS_PATH
 from .notclick import DualUse, Exit  # noqa: F401
 
@@ -54,6 +55,18 @@ def chown_like_dir_if_root(path):
         os.chown(path, dirstat.st_uid, dirstat.st_gid)
 
 
+def fsync_dir(path):
+    """
+    Syncs the directory containing path to disk, so that a file which was
+    just created or renamed there is durable.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 def _safer_load(
     yaml_file: str,
     schema: Schema,
@@ -298,17 +311,55 @@ class schemadict(ro_dict, serializable):
     # the schema definition, but IDK the schema library and this
     # could become a rather complex task
     default: Optional[dict[str, Any]] = None
+    # the serialized form, made by _dict when it is first needed. (This is a
+    # class attribute so that instances don't get a __dict__ until then.)
+    _as_dict = None
+
+    def __init_subclass__(cls, **kw):
+        """
+        Compiles the schema of each subclass which defines one.
+        """
+        super(schemadict, cls).__init_subclass__(**kw)
+        schema = cls.__dict__.get('schema')
+        if type(schema) is Schema:
+            cls.schema = CompiledSchema(schema)
 
     def __init__(self, *a, **kw):
-        self._as_dict = None
         data = copy.deepcopy(self.default) or {}
         kw = {k: v for k, v in kw.items() if v is not None}
         data.update(*a, **kw)
         assert type(data) == dict
         super(schemadict, self).__init__(self.schema.validate(data))
 
+    @classmethod
+    def _from_validated(cls, data):
+        """
+        Instantiate without validation. This must only be called with data
+        which is known to already satisfy the schema, such as the items of
+        another instance.
+
+        >>> class d(schemadict):
+        ...     schema = Schema({'a': Use(int)})
+        >>> d._from_validated(d(a='1'))
+        {'a': 1}
+        """
+        self = cls.__new__(cls)
+        dict.__init__(self, data)
+        return self
+
     def __deepcopy__(self, memo):
-        return type(self)(copy.deepcopy(dict(self)))
+        """
+        Returns a deep copy. As the data of an instance has already been
+        validated, the copy is made without validating it again.
+
+        >>> class d(schemadict):
+        ...     schema = Schema({'a': Use(int), 'b': [int]})
+        >>> x = d(a='1', b=[2])
+        >>> y = x.copy()
+        >>> y, type(y) is d, y['b'] is x['b']
+        ({'a': 1, 'b': [2]}, True, False)
+        """
+        return self._from_validated(copy.deepcopy(dict(self), memo))
 
     def copy(self):
         return self.__deepcopy__(None)
@@ -318,13 +369,43 @@ class schemadict(ro_dict, serializable):
             self._as_dict = super(schemadict, self)._dict()
         return self._as_dict
 
+    def _update_dict(self, old, keys):
+        """
+        Sets our serialized form, given the serialized form of an object which
+        had the same items as this one except for those with the given keys.
+        Only the values of those keys are serialized again; old itself is not
+        modified. If old is None, the serialized form is left to be made by
+        _dict when it is needed.
+
+        >>> class d(schemadict):
+        ...     schema = Schema({str: [int]})
+        >>> x = d(a=[1], b=[2], c=[3])
+        >>> y = d._from_validated(dict(x, b=[4], d=[5]))
+        >>> dict.pop(y, 'c') and y._update_dict(x._dict(), ['b', 'c', 'd'])
+        >>> y._dict(), y._dict()['a'] is x._dict()['a'], x._dict()
+        ({'a': [1], 'b': [4], 'd': [5]}, True, {'a': [1], 'b': [2], 'c': [3]})
+        """
+        if old is None:
+            return
+        new = dict(old)
+        for key in keys:
+            if key in self:
+                new[raw(key)] = raw(self[key])
+            else:
+                new.pop(raw(key), None)
+        self._as_dict = new
+
 
 class schemattrdict(attrdict, schemadict):
     pass
 
 
 class yamlfile(serializable):
-    def write_yaml_file(self, path, mode=None, autochown=False):
+    def write_yaml_file(self, path, mode=None, autochown=False, fsync=False):
+        """
+        Writes the YAML file atomically. If fsync is true, the file's contents
+        and then its directory are synced to disk before this returns.
+        """
         if mode:
             Path(path).touch(mode=mode)
 
@@ -334,6 +415,11 @@ class yamlfile(serializable):
             fh.write(
                 yaml.safe_dump(self._dict(), default_style='', sort_keys=False)
             )
+            if fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+        if fsync:
+            fsync_dir(path)
         if autochown:
             chown_like_dir_if_root(path)
 
@@ -459,6 +545,8 @@ class ConsistencyError(Exception):
 
 
 class comma_separated_IPs(object):
+    __slots__ = ('_str', '_items')
+
     addr_cls: Callable[[Any, Any], IPv4Address | IPv6Address] | type[
         IPv4Address
     ] | type[IPv6Address] = lambda _, a: ip_address(a)
@@ -614,6 +702,8 @@ class comma_separated_IPs(object):
 class IPs(comma_separated_IPs):
     "TODO: rename comma_separated_IPs to IPs"
 
+    __slots__ = ()
+
     @property
     def v4s(self) -> list[IPv4Address]:
         return [a for a in self if a.version == 4]
@@ -633,6 +723,7 @@ class comma_separated_IPv4s(comma_separated_IPs):
     <comma_separated_IPv4s('127.0.0.1')>
     """
 
+    __slots__ = ()
     addr_cls = IPv4Address
     size = 4
 
@@ -647,6 +738,7 @@ class comma_separated_IPv6s(comma_separated_IPs):
     <comma_separated_IPv6s('fe80::1')>
     """
 
+    __slots__ = ()
     addr_cls = IPv6Address
     size = 16
 
@@ -689,6 +781,8 @@ class comma_separated_Nets(comma_separated_IPs):
     <comma_separated_Nets('fe80::/10,fe80::/10')>
     """
 
+    __slots__ = ()
+
     def __init__(self, _str):
         self._str = str(_str)
         self._items = tuple(
@@ -890,6 +984,8 @@ class b64_bytes(bytes):
     repr which shows the first six bytes of its base64 encoding.
     """
 
+    __slots__ = ()
+
     def __str__(self):
         """
         Function to return a string representation of entered bytes.
@@ -978,8 +1074,25 @@ class IntBool(int):
 
     This class exists so that these values can be identified in the 'raw'
     function, which will convert them to normal bools.
+
+    As every peer has several of these, there is only one instance of each of
+    the values 0 and 1:
+
+    >>> IntBool(True) is IntBool(1) is copy.deepcopy(IntBool(1))
+    True
     """
 
+    __slots__ = ()
+
+    def __new__(cls, value=0):
+        try:
+            return cls._instances[value]
+        except (KeyError, TypeError):
+            return super(IntBool, cls).__new__(cls, value)
+
+
+IntBool._instances = {n: int.__new__(IntBool, n) for n in (0, 1)}
+
 
 Flexibool = And(
     Or(
@@ -1008,6 +1121,13 @@ Flexibool = And(
 
 
 class queryable(dict):
+    def _subset(self, items):
+        """
+        Returns an object of our type containing the given (name, item) pairs,
+        which are some of our own.
+        """
+        return type(self)(items)
+
     def limit(self, **kw):
         """
         >>> d = {1:{"enabled":True},2:{"enabled":False}}
@@ -1021,7 +1141,7 @@ class queryable(dict):
         >>> q.limit()
         {1: {'enabled': True}, 2: {'enabled': False}}
         """
-        return type(self)(
+        return self._subset(
             (name, item)
             for name, item in self.items()
             if all(
@@ -1035,7 +1155,7 @@ class queryable(dict):
         )
 
     def limit_attr(self, **kw):
-        return type(self)(
+        return self._subset(
             (name, item)
             for name, item in self.items()
             if all(
@@ -1150,12 +1270,92 @@ def addrs_in_subnets(addrs, subnets):
     >>> addrs_in_subnets(addrs, current_subnets)
     ['fe80::/10', 'fe80::2:0/10']
 
+    Subnets can also be a SubnetMatcher, which is faster for many subnets:
+
+    >>> addrs = [ip_address('10.0.0.1'), ip_address('10.0.14.1')]
+    >>> addrs_in_subnets(addrs, SubnetMatcher(['10.0.0.0/24']))
+    [IPv4Address('10.0.0.1')]
     """
+    if isinstance(subnets, SubnetMatcher):
+        return [addr for addr in addrs if addr in subnets]
     return [
         addr for addr in addrs if any(addr in subnet for subnet in subnets)
     ]
 
 
+class SubnetMatcher(object):
+    """
+    This finds the longest-prefix match for an address (or network) among a
+    collection of networks.
+
+    The networks are grouped by IP version and prefix length, in dictionaries
+    keyed by the integer value of their network addresses, so a lookup masks
+    the address once for each prefix length present (which is usually only a
+    few) rather than comparing it to every network.
+
+    >>> m = SubnetMatcher(['10.0.0.0/8', '10.1.0.0/16', 'fe80::/64'])
+    >>> m.longest_match(ip_address('10.1.2.3'))
+    IPv4Network('10.1.0.0/16')
+    >>> m.longest_match(ip_address('10.2.0.1'))
+    IPv4Network('10.0.0.0/8')
+    >>> m.longest_match(ip_network('10.1.2.0/24'))
+    IPv4Network('10.1.0.0/16')
+    >>> m.longest_match(ip_network('10.0.0.0/7')) is None
+    True
+    >>> ip_address('fe80::1') in m, ip_address('fe81::1') in m
+    (True, False)
+    >>> ip_address('::ffff:10.1.2.3') in m
+    False
+    >>> len(m), bool(SubnetMatcher([]))
+    (3, False)
+    """
+
+    def __init__(self, networks):
+        self.networks = [ip_network(net) for net in networks]
+        tables = {4: {}, 6: {}}
+        for net in self.networks:
+            prefix = tables[net.version].setdefault(
+                net.prefixlen, (int(net.netmask), {})
+            )
+            prefix[1].setdefault(int(net.network_address), net)
+        # for each version, the prefix lengths from longest to shortest, with
+        # their masks and networks
+        self._tables = {
+            version: [
+                (prefixlen, mask, table)
+                for prefixlen, (mask, table) in sorted(
+                    tables[version].items(), reverse=True
+                )
+            ]
+            for version in tables
+        }
+
+    def longest_match(self, addr):
+        """
+        Returns the network with the longest prefix which contains addr, which
+        is an IP address or network, or None if there isn't one.
+        """
+        if hasattr(addr, 'network_address'):
+            value, maxlen = int(addr.network_address), addr.prefixlen
+        else:
+            value, maxlen = int(addr), addr.max_prefixlen
+        for prefixlen, mask, table in self._tables[addr.version]:
+            if prefixlen <= maxlen:
+                net = table.get(value & mask)
+                if net is not None:
+                    return net
+        return None
+
+    def __contains__(self, addr):
+        return self.longest_match(addr) is not None
+
+    def __len__(self):
+        return len(self.networks)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, list(map(str, self.networks)))
+
+
 def sort_LL_first(ips):
     """
     This sorts a list of IPs to put the link-local ones (if any) first, and to
@@ -0,0 +1,300 @@
+"""
+Compiled validators for schema objects.
+
+The schema library interprets its schemas on every validation: for each
+(nested) value it instantiates Schema objects, works out what kind of schema
+each part is, and sorts dictionary keys by priority. The objects we construct
+most often (descriptors, peers, prefs, and WireGuard peer configs) have fixed
+schemas, so we compile each of them once, when its class is defined, into a
+tree of closures which do only the checks and conversions.
+
+The compiled validators don't produce errors themselves. If one fails for any
+reason, the data is validated again by the schema library, which raises the
+same SchemaError it always would have (or returns the validated data, if the
+compiled validator was stricter than necessary). Valid data thus gets the
+same result, and invalid data the same error, only faster in the first case.
+
+Parts of a schema which the compiler doesn't know how to specialize (such as
+Hook keys, exclusive Or objects, or custom validator objects) are validated
+by calling their own validate methods.
+"""
+
+from __future__ import annotations
+
+from schema import And, Hook, Literal, Optional, Or, Regex, Schema, Use
+
+COMPARABLE, CALLABLE, VALIDATOR, TYPE, DICT, ITERABLE = range(6)
+
+
+class _Invalid(Exception):
+    pass
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _flavor(s):
+    """
+    Returns the kind of schema s is, as the schema library determines it.
+
+    >>> [_flavor(s) for s in ('a', len, Use(int), int, {}, [int])]
+    [0, 1, 2, 3, 4, 5]
+    """
+    if type(s) in (list, tuple, set, frozenset):
+        return ITERABLE
+    if isinstance(s, dict):
+        return DICT
+    if issubclass(type(s), type):
+        return TYPE
+    if isinstance(s, Literal):
+        return COMPARABLE
+    if hasattr(s, "validate"):
+        return VALIDATOR
+    if callable(s):
+        return CALLABLE
+    return COMPARABLE
+
+
+def _key_priority(s):
+    if isinstance(s, Hook):
+        return _flavor(s._schema) - 0.5
+    if isinstance(s, Optional):
+        return _flavor(s._schema) + 0.5
+    return _flavor(s)
+
+
+def _dict_last(item):
+    return isinstance(item[1], dict)
+
+
+def _compile(s, ignore_extra_keys=False):
+    """
+    Returns a function which validates data like
+    Schema(s, ignore_extra_keys=ignore_extra_keys).validate does, except that
+    it raises an arbitrary exception when the data is invalid.
+    """
+    if isinstance(s, Literal):
+        s = s.schema
+    flavor = _flavor(s)
+    if flavor == ITERABLE:
+        return _compile_iterable(s, ignore_extra_keys)
+    if flavor == DICT:
+        return _compile_dict(s, ignore_extra_keys)
+    if flavor == TYPE:
+        return _compile_type(s)
+    if flavor == VALIDATOR:
+        return _compile_validator(s)
+    if flavor == CALLABLE:
+
+        def validate_callable(data):
+            if s(data):
+                return data
+            raise _Invalid()
+
+        return validate_callable
+
+    def validate_comparable(data):
+        if s == data:
+            return data
+        raise _Invalid()
+
+    return validate_comparable
+
+
+def _compile_type(s):
+    if s is int:
+
+        def validate_int(data):
+            if isinstance(data, int) and not isinstance(data, bool):
+                return data
+            raise _Invalid()
+
+        return validate_int
+
+    def validate_type(data):
+        if isinstance(data, s):
+            return data
+        raise _Invalid()
+
+    return validate_type
+
+
+def _compile_any(schemas, ignore_extra_keys):
+    """
+    Returns a function which returns the result of the first of the schemas
+    which validates the data, like Or does.
+    """
+    validators = [_compile(s, ignore_extra_keys) for s in schemas]
+    if len(validators) == 1:
+        return validators[0]
+
+    def validate_any(data):
+        for validate in validators:
+            try:
+                return validate(data)
+            except Exception:
+                pass
+        raise _Invalid()
+
+    return validate_any
+
+
+def _compile_iterable(s, ignore_extra_keys):
+    kind = type(s)
+    validate_item = _compile_any(s, ignore_extra_keys)
+
+    def validate_iterable(data):
+        if not isinstance(data, kind):
+            raise _Invalid()
+        return type(data)(validate_item(item) for item in data)
+
+    return validate_iterable
+
+
+def _compile_validator(s):
+    kind = type(s)
+    if kind in (Schema, CompiledSchema):
+        return _compile(s._schema, s._ignore_extra_keys)
+    if kind is Optional and not hasattr(s, 'default'):
+        return _compile(s._schema, s._ignore_extra_keys)
+    if kind is And and getattr(s, '_schema_class', Schema) is Schema:
+        validators = [_compile(a, s._ignore_extra_keys) for a in s.args]
+
+        def validate_all(data):
+            for validate in validators:
+                data = validate(data)
+            return data
+
+        return validate_all
+    if (
+        kind is Or
+        and getattr(s, '_schema_class', Schema) is Schema
+        and not s.only_one
+    ):
+        return _compile_any(s.args, s._ignore_extra_keys)
+    if kind is Use:
+        return s._callable
+    if kind is Regex:
+        search = s._pattern.search
+
+        def validate_regex(data):
+            if search(data):
+                return data
+            raise _Invalid()
+
+        return validate_regex
+    return s.validate
+
+
+def _compile_dict(s, ignore_extra_keys):
+    # the schema keys which only match data keys equal to them can be looked
+    # up directly; they have the highest priority, so when a data key equals
+    # one of them, it is the one which the schema library would match.
+    literal = {}
+    others = []
+    for skey in sorted(s, key=_key_priority):
+        key = skey._schema if isinstance(skey, Optional) else skey
+        if isinstance(key, Literal):
+            key = key.schema
+        if isinstance(skey, Hook) or getattr(key, 'only_one', False):
+            # these keys have side effects when they match
+            raise _Unsupported(skey)
+        entry = (skey, _compile(s[skey], ignore_extra_keys))
+        if _flavor(key) == COMPARABLE:
+            literal.setdefault(key, entry)
+        else:
+            others.append((_compile(skey),) + entry)
+    required = set(k for k in s if not isinstance(k, (Optional, Hook)))
+    defaults = set(
+        k for k in s if isinstance(k, Optional) and hasattr(k, "default")
+    )
+
+    def validate_dict(data):
+        if not isinstance(data, dict):
+            raise _Invalid()
+        new = type(data)()
+        coverage = set()
+        for key, value in sorted(data.items(), key=_dict_last):
+            entry = literal.get(key)
+            if entry is not None:
+                skey, validate_value = entry
+                new[key] = validate_value(value)
+                coverage.add(skey)
+                continue
+            for validate_key, skey, validate_value in others:
+                try:
+                    nkey = validate_key(key)
+                except Exception:
+                    continue
+                new[nkey] = validate_value(value)
+                coverage.add(skey)
+                break
+        if not required <= coverage:
+            raise _Invalid()
+        if not ignore_extra_keys and len(new) != len(data):
+            raise _Invalid()
+        for default in defaults - coverage:
+            new[default.key] = (
+                default.default()
+                if callable(default.default)
+                else default.default
+            )
+        return new
+
+    return validate_dict
+
+
+class CompiledSchema(Schema):
+    """
+    A Schema which validates data with a validator compiled from it, and only
+    falls back to the schema library's validation when that fails.
+
+    >>> from schema import SchemaError
+    >>> s = CompiledSchema(Schema({'a': Use(int), Optional('b'): [str]}))
+    >>> s.validate({'a': '1', 'b': ['x']})
+    {'a': 1, 'b': ['x']}
+    >>> try:
+    ...     s.validate({'a': 'x'})
+    ... except SchemaError as ex:
+    ...     print(ex)
+    Key 'a' error:
+    int('x') raised ValueError("invalid literal for int() with base 10: 'x'")
+
+    If a schema can't be compiled, it is always validated by the schema
+    library:
+
+    >>> from schema import Forbidden
+    >>> s = CompiledSchema(Schema({Forbidden('b'): object, str: int}))
+    >>> s.compiled is None, s.validate({'a': 1})
+    (True, {'a': 1})
+    """
+
+    # this can be set to False to validate everything with the schema library,
+    # for comparison.
+    enabled = True
+
+    def __init__(self, schema):
+        # the schema library instantiates type(self) for the parts of a schema
+        # while validating it, so the fallback uses the original Schema
+        self.interpreted = schema
+        super(CompiledSchema, self).__init__(
+            schema._schema,
+            error=schema._error,
+            ignore_extra_keys=schema._ignore_extra_keys,
+            name=schema._name,
+            description=schema._description,
+            as_reference=schema.as_reference,
+        )
+        try:
+            self.compiled = _compile(self._schema, self._ignore_extra_keys)
+        except _Unsupported:
+            self.compiled = None
+
+    def validate(self, data, **kwargs):
+        if self.compiled is not None and self.enabled and not kwargs:
+            try:
+                return self.compiled(data)
+            except Exception:
+                pass
+        return self.interpreted.validate(data, **kwargs)
@@ -36,6 +36,10 @@ _B64ALPHABET: str = (
 )
 _ORGANIZE_CACHE_FILE: str = _ORGANIZE_CACHE_BASEDIR + "vula-organize-cache"
 _ORGANIZE_CONF_FILE: str = _ORGANIZE_CACHE_BASEDIR + "vula-organize.yaml"
+_ORGANIZE_JOURNAL_SNAPSHOT_INTERVAL: int = 1000
+# seconds after which the addresses and routes which organize follows through
+# netlink events are dumped again, in case an event was missed
+_SYSTEM_STATE_REDUMP_INTERVAL: int = 600
 _ORGANIZE_KEYS_CONF_FILE: str = _ORGANIZE_CACHE_BASEDIR + "keys.yaml"
 _ORGANIZE_HOSTS_FILE: str = _ORGANIZE_CACHE_BASEDIR + "hosts"
 _ORGANIZE_UPDATE_TEMP: str = "vula-organize-peer-update-"
@@ -56,6 +60,10 @@ _PUBLISH_DBUS_PATH: str = "/local/vula/publish"
 _DISCOVER_ALT_DBUS_PATH: str = "/local/vula/discoveralt"
 _PUBLISH_ALT_DBUS_PATH: str = "/local/vula/publishalt"
 
+# seconds for which discover collects descriptors before passing them to
+# organize together
+_DISCOVER_BATCH_DELAY: float = 0.25
+
 _LINUX_MAIN_ROUTING_TABLE = 254
 
 # from linux/include/uapi/linux/if_link.h
@@ -15,6 +15,7 @@ addresses for the local network segment are used as WireGuard peers.
 
 from ipaddress import ip_address as ip_addr_parser
 from logging import Logger, getLogger
+from threading import Lock, Timer
 from typing import Optional, Callable
 import click
 import pydbus
@@ -24,6 +25,7 @@ from pyroute2 import IPRoute
 from zeroconf import ServiceBrowser, ServiceInfo, ServiceListener, Zeroconf
 
 from .constants import (
+    _DISCOVER_BATCH_DELAY,
     _DISCOVER_DBUS_NAME,
     _LABEL,
     _ORGANIZE_DBUS_NAME,
@@ -91,6 +93,42 @@ class VulaServiceListener(ServiceListener):
         return self.add_service(*a, **kw)
 
 
+class DescriptorBatcher(object):
+    """
+    Collects the descriptors which are discovered within delay seconds of the
+    first of them, and passes them to callback as one list, so that a burst of
+    descriptors (eg, when joining a busy network) is processed as one batch.
+    """
+
+    def __init__(
+        self,
+        callback: Callable[[list[Descriptor]], None],
+        delay: float = _DISCOVER_BATCH_DELAY,
+    ) -> None:
+        self.callback = callback
+        self.delay = delay
+        self._lock = Lock()
+        self._pending: list[Descriptor] = []
+        self._timer: Optional[Timer] = None
+
+    def add(self, descriptor: Descriptor) -> None:
+        with self._lock:
+            self._pending.append(descriptor)
+            if self._timer is None:
+                self._timer = Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, []
+        if pending:
+            self.callback(pending)
+
+
 class Discover(object):
     dbus = '''
     <node>
@@ -190,8 +228,11 @@ class Discover(object):
             system_bus = pydbus.SystemBus()
             process = system_bus.get(
                 _ORGANIZE_DBUS_NAME, _ORGANIZE_DBUS_PATH
-            ).process_descriptor_string
-            discover.callbacks.append(lambda d: process(str(d)))
+            ).process_descriptor_strings
+            batcher = DescriptorBatcher(
+                lambda descriptors: process(list(map(str, descriptors)))
+            )
+            discover.callbacks.append(batcher.add)
             system_bus.publish(_DISCOVER_DBUS_NAME, discover)
 
         discover.listen_on_ip_or_if(ip_address, interface)
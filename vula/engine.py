@@ -1,9 +1,22 @@
 from __future__ import annotations
 
 import copy
+import heapq
+import time
 import traceback
-from functools import reduce, wraps
-from threading import Lock
+from collections import deque
+from concurrent.futures import Future
+from functools import wraps
+from itertools import count
+from threading import (
+    Condition,
+    Event,
+    Lock,
+    RLock,
+    Thread,
+    Timer,
+    current_thread,
+)
 
 from schema import Optional, Schema, Use
 
@@ -16,11 +29,13 @@ class Result(yamlrepr_hl, schemattrdict):
     actions, writes, triggers, and trigger_results that resulted from
     the event.
 
-    Although log replay is not yet implemented, the event engine is designed
-    such that replaying the events from a log of result objects should produce
-    an identical state and an identical series of result objects (except for
-    the trigger_results, which depend on the system's actual configuration
-    state, which exists outside of the state engine).
+    The event engine is designed such that replaying the events from a log of
+    result objects should produce an identical state and an identical series
+    of result objects (except for the trigger_results, which depend on the
+    system's actual configuration state, which exists outside of the state
+    engine). Replaying only the writes of a log of result objects, which is
+    what Engine.replay does, produces an identical state without re-running
+    the events' actions.
     """
 
     schema = Schema(
@@ -30,6 +45,8 @@ class Result(yamlrepr_hl, schemattrdict):
             'writes': Use(raw),
             Optional('triggers'): Use(raw),
             Optional('trigger_results'): Use(raw),
+            Optional('results'): [object],
+            Optional('timings'): Use(raw),
             Optional('error'): object,
             Optional('traceback'): str,
         },
@@ -37,6 +54,23 @@ class Result(yamlrepr_hl, schemattrdict):
 
     default = dict(event=[], actions=[], writes=[], triggers=[])
 
+    # This maps trigger names to how run_triggers merges several calls of the
+    # same trigger. With 'union', the calls which have the same arguments
+    # after the first are merged into one call (in the position of the first of
+    # them) whose first argument is the union of their first arguments, which
+    # are lists or single strings. With 'last', identical calls are run only
+    # once, in the position of the last of them. Identical calls of triggers
+    # which are not listed here are run once, in the position of the first.
+    coalesce: dict[str, str] = {}
+
+    def __init__(self, *a, **kw):
+        super(Result, self).__init__(*a, **kw)
+        # this is cleared while the triggers are waiting to be run (or are
+        # running) on a TriggerExecutor
+        self._triggers_done = Event()
+        self._triggers_done.set()
+        self._lap_start = time.monotonic_ns()
+
     def __repr__(self):
         return "<Result\n  %s\n>" % (
             super(Result, self).__repr__().strip().replace("\n", "\n  "),
@@ -58,6 +92,43 @@ class Result(yamlrepr_hl, schemattrdict):
     def trigger_results(self):
         return self.setdefault('trigger_results', [])
 
+    @property
+    def results(self):
+        return self.setdefault('results', [])
+
+    @property
+    def timings(self):
+        """
+        A dictionary of the time spent in each phase of processing the event
+        (and running its triggers), in nanoseconds.
+        """
+        return self.setdefault('timings', {})
+
+    def lap(self, phase):
+        """
+        Adds the time since the previous lap (or since the result was created)
+        to the timing of phase.
+        """
+        now = time.monotonic_ns()
+        self.timings[phase] = (
+            self.timings.get(phase, 0) + now - self._lap_start
+        )
+        self._lap_start = now
+
+    @property
+    def pending(self):
+        """
+        True while the triggers are waiting to be run by a TriggerExecutor.
+        """
+        return not self._triggers_done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the triggers have been run (and the result has been
+        recorded). Returns False if the timeout expired first.
+        """
+        return self._triggers_done.wait(timeout)
+
     @property
     def summary(self):
         if self.error:
@@ -69,16 +140,451 @@ class Result(yamlrepr_hl, schemattrdict):
         for name, args in kw.items():
             self.triggers.append((name, args))
 
+    def merge_triggers(self):
+        """
+        Merges the triggers (in place) as specified by coalesce, and returns
+        them.
+
+        >>> class R(Result):
+        ...     coalesce = dict(rm='union', gc='last')
+        >>> res = R(event=[], actions=[], writes=[])
+        >>> res.add_triggers(sync=('a',), gc=(), rm=(['x', 'y'],))
+        >>> res.add_triggers(sync=('b',), rm=('z', 1))
+        >>> res.add_triggers(sync=('a',), gc=(), rm=(['y', 'w'],))
+        >>> res.merge_triggers()  # doctest: +NORMALIZE_WHITESPACE
+        [('sync', ('a',)), ('rm', (['x', 'y', 'w'],)), ('sync', ('b',)),
+         ('rm', (['z'], 1)), ('gc', ())]
+        """
+        triggers = [(name, tuple(raw(args))) for name, args in self.triggers]
+        first, last, unions, merged = {}, {}, {}, []
+        for i, (name, args) in enumerate(triggers):
+            first.setdefault((name, repr(args)), i)
+            last[(name, repr(args))] = i
+        for i, (name, args) in enumerate(triggers):
+            how = self.coalesce.get(name)
+            if how == 'union':
+                items = [args[0]] if isinstance(args[0], str) else args[0]
+                key = (name, repr(args[1:]))
+                if key not in unions:
+                    unions[key] = []
+                    merged.append((name, (unions[key],) + args[1:]))
+                unions[key].extend(
+                    item for item in items if item not in unions[key]
+                )
+            elif (last if how == 'last' else first)[(name, repr(args))] == i:
+                merged.append((name, args))
+        self.triggers[:] = merged
+        return self.triggers
+
     def run_triggers(self, target):
+        """
+        Merges the triggers (see merge_triggers) and calls them on target.
+        """
         assert not self.trigger_results, "triggers should only be run once"
-        for name, args in self.triggers:
+        self._lap_start = time.monotonic_ns()
+        for name, args in self.merge_triggers():
             try:
                 self.trigger_results.append(getattr(target, name)(*args))
             except Exception:
                 self.trigger_results.append(traceback.format_exc())
+        self.lap('triggers')
         return self
 
 
+class EventTimings(object):
+    """
+    This aggregates the timings of results into a histogram for each phase of
+    each event type. The buckets are powers of two microseconds, and each
+    bucket counts the timings which were longer than the previous bucket's.
+
+    >>> timings = EventTimings()
+    >>> for ns in (800, 1500, 3000, 4000):
+    ...     timings.add(Result(event=['E'], actions=[], writes=[],
+    ...                        timings=dict(save=ns)))
+    >>> timings.stats()['E']['save']
+    {'count': 4, 'total_us': 9.3, 'max_us': 4.0, 'histogram_us': {1: 1, 2: 1, 4: 2}}
+    """  # noqa: E501
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+
+    def add(self, result):
+        with self._lock:
+            event = self._histograms.setdefault(result.event[0], {})
+            for phase, ns in result.get('timings', {}).items():
+                h = event.setdefault(
+                    phase, dict(count=0, total=0, max=0, buckets={})
+                )
+                h['count'] += 1
+                h['total'] += ns
+                h['max'] = max(h['max'], ns)
+                us = -(-ns // 1000)
+                bucket = 1 << (us - 1).bit_length() if us > 1 else 1
+                h['buckets'][bucket] = h['buckets'].get(bucket, 0) + 1
+
+    def stats(self):
+        """
+        Returns the histograms as a dictionary of event types, containing a
+        dictionary of phases.
+        """
+        with self._lock:
+            return {
+                event: {
+                    phase: dict(
+                        count=h['count'],
+                        total_us=h['total'] / 1000,
+                        max_us=h['max'] / 1000,
+                        histogram_us=dict(sorted(h['buckets'].items())),
+                    )
+                    for phase, h in phases.items()
+                }
+                for event, phases in sorted(self._histograms.items())
+            }
+
+
+class TriggerExecutor(object):
+    """
+    This runs the triggers of results on a worker thread, so that the threads
+    which call events don't have to wait for them.
+
+    The results' triggers are run one result at a time, in the order in which
+    they were submitted, so triggers concerning the same peer are always run
+    in the order of the events which produced them.
+
+    When maxsize results are waiting, submit blocks until there is room, so
+    that a backlog of triggers slows down the producers of events instead of
+    growing without bound. (Events which are called by the triggers
+    themselves, on the worker thread, are never blocked.)
+    """
+
+    def __init__(self, target, maxsize=64, log=lambda *a: None):
+        self.target = target
+        self.maxsize = maxsize
+        self.log = log
+        self._queue = deque()
+        self._cond = Condition()
+        self._thread = Thread(
+            target=self._run, name="trigger executor", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def backlog(self):
+        """
+        The number of results whose triggers have not yet been run.
+        """
+        return len(self._queue)
+
+    def submit(self, result, callback=None, block=True):
+        """
+        Queues the result's triggers to be run, after which callback (if any)
+        is called with the result. If block is False, this does not wait for
+        room in the backlog.
+        """
+        result._triggers_done.clear()
+        with self._cond:
+            if block:
+                self._wait_for_room()
+            self._queue.append((result, callback))
+            self._cond.notify_all()
+
+    def call(self, function, *args):
+        """
+        Calls function on the worker thread, after the triggers which were
+        already submitted, and returns its result (or raises its exception),
+        so that it is never run concurrently with triggers.
+        """
+        if current_thread() is self._thread:
+            return function(*args)
+        outcome = []
+
+        def callback(result):
+            try:
+                outcome.append((True, function(*args)))
+            except Exception as ex:
+                outcome.append((False, ex))
+
+        result = Result(event=['call'], actions=[], writes=[])
+        self.submit(result, callback)
+        result.wait()
+        ok, value = outcome[0]
+        if not ok:
+            raise value
+        return value
+
+    def wait_for_room(self):
+        """
+        Waits until the backlog is not full (unless called by the worker).
+        """
+        with self._cond:
+            self._wait_for_room()
+
+    def _wait_for_room(self):
+        if current_thread() is self._thread:
+            return
+        if len(self._queue) >= self.maxsize:
+            self.log("trigger backlog is full: %s", len(self._queue))
+        while len(self._queue) >= self.maxsize:
+            self._cond.wait()
+
+    def join(self, timeout=None):
+        """
+        Waits until all of the submitted triggers have been run. Returns False
+        if the timeout expired first.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue, timeout)
+
+    def stop(self):
+        """
+        Runs the triggers which were already submitted, and stops the worker.
+        """
+        with self._cond:
+            self._queue.append(None)
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                item = self._queue[0]
+                if item is None:
+                    self._queue.popleft()
+                    self._cond.notify_all()
+                    return
+            result, callback = item
+            try:
+                result.run_triggers(self.target)
+                if callback:
+                    callback(result)
+            except Exception:
+                self.log("trigger executor error: %s", traceback.format_exc())
+            finally:
+                with self._cond:
+                    self._queue.popleft()
+                    self._cond.notify_all()
+                result._triggers_done.set()
+
+
+class EventQueue(object):
+    """
+    This runs all of an engine's events on a single thread of its own. Calling
+    an event from any other thread submits it to the queue and waits for its
+    Result.
+
+    Events are run in order of their priority in the engine's event_priorities
+    (lower numbers first), and in the order they were submitted within each
+    priority, so that eg user edits don't have to wait for a flood of incoming
+    descriptors.
+
+    When the engine has a trigger_executor, submitting an event waits for room
+    in its backlog first (except on the executor's own thread), so that the
+    threads producing events are slowed down when the triggers can't keep up.
+    """
+
+    default_priority = 1
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._heap = []
+        self._count = count()
+        self._cond = Condition()
+        self._stats = {}
+        self.max_depth = 0
+        self._thread = Thread(
+            target=self._run, name="event queue", daemon=True
+        )
+        self._thread.start()
+
+    @property
+    def depth(self):
+        """
+        The number of events waiting to be run.
+        """
+        return len(self._heap)
+
+    def is_current(self):
+        """
+        True if called from the queue's thread.
+        """
+        return current_thread() is self._thread
+
+    def priority(self, name):
+        return self.engine.event_priorities.get(name, self.default_priority)
+
+    def submit(self, name, function, *a, **kw):
+        """
+        Queues a call of function (which should be an event method) to be run
+        on the queue's thread with the priority of the named event, and returns
+        a Future for its result.
+        """
+        executor = self.engine.trigger_executor
+        if executor is not None and not self.is_current():
+            executor.wait_for_room()
+        future = Future()
+        priority = self.priority(name)
+        with self._cond:
+            heapq.heappush(
+                self._heap,
+                (
+                    priority,
+                    next(self._count),
+                    time.monotonic(),
+                    future,
+                    (function, a, kw),
+                ),
+            )
+            self.max_depth = max(self.max_depth, len(self._heap))
+            self._cond.notify()
+        return future
+
+    def call(self, name, function, *a, **kw):
+        """
+        Submits a call and waits for its result.
+        """
+        return self.submit(name, function, *a, **kw).result()
+
+    def stop(self):
+        """
+        Stops the queue's thread after the events which were already queued
+        have been run.
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (float('inf'), next(self._count)))
+            self._cond.notify()
+        self._thread.join()
+
+    def stats(self):
+        """
+        Returns a dictionary of the queue's metrics: its current and maximum
+        depth, and the number of events which were run and the total and
+        maximum time that they waited in the queue, for each priority.
+        """
+        with self._cond:
+            return dict(
+                depth=len(self._heap),
+                max_depth=self.max_depth,
+                priorities={
+                    priority: dict(stats)
+                    for priority, stats in sorted(self._stats.items())
+                },
+            )
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._heap)
+                item = heapq.heappop(self._heap)
+            if len(item) == 2:
+                return
+            priority, _, queued, future, (function, a, kw) = item
+            waited = time.monotonic() - queued
+            with self._cond:
+                stats = self._stats.setdefault(
+                    priority, dict(events=0, total_wait=0.0, max_wait=0.0)
+                )
+                stats['events'] += 1
+                stats['total_wait'] += waited
+                stats['max_wait'] = max(stats['max_wait'], waited)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*a, **kw))
+            except BaseException as ex:
+                future.set_exception(ex)
+
+
+class SaveScheduler(object):
+    """
+    This coalesces the saves of an engine's state. It is called like the save
+    function it wraps, with the results of the events which changed the state,
+    but instead of saving right away it collects them, and saves them all
+    together once delay() seconds have passed since the first of them.
+
+    The results are saved right away (along with any which were waiting) when
+    urgent(result) is true for any of them, when there are none (which asks
+    for the whole state to be saved), when the delay is not positive, and when
+    flush is called, eg at shutdown.
+
+    Lock is the engine's lock, which the engine holds while calling save; the
+    delayed saves acquire it, so that they see a committed state. It must be
+    reentrant, as flush may be called by a thread which already holds it (eg,
+    by atexit while an event was interrupted).
+
+    >>> saved = []
+    >>> saver = SaveScheduler(lambda *r: saved.append(r), RLock(),
+    ...                       delay=lambda: 60, urgent=lambda r: r == 'edit')
+    >>> saver('a'); saver('b'); saved
+    []
+    >>> saver('edit'); saved
+    [('a', 'b', 'edit')]
+    >>> saver('c'); saver.flush(); saved[-1]
+    ('c',)
+    >>> with saver.lock:
+    ...     saver('d'); saver.flush()
+    >>> saved[-1]
+    ('d',)
+    >>> saver.stats()
+    {'requested': 5, 'written': 3, 'avoided': 2, 'pending': 0}
+    """
+
+    def __init__(self, save, lock, delay, urgent=lambda result: False):
+        self.save = save
+        self.lock = lock
+        self.delay = delay
+        self.urgent = urgent
+        self.requested = 0
+        self.written = 0
+        self._pending = []
+        self._timer = None
+        self._cond = Condition()
+
+    def __call__(self, *results):
+        with self._cond:
+            self.requested += 1
+            self._pending.extend(results)
+            delay = self.delay()
+            if not results or delay <= 0 or any(map(self.urgent, results)):
+                self._save()
+            elif self._timer is None:
+                self._timer = Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Saves the results which are waiting, if there are any.
+        """
+        with self.lock:
+            with self._cond:
+                if self._pending:
+                    self._save()
+
+    def _save(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        results, self._pending = self._pending, []
+        self.written += 1
+        self.save(*results)
+
+    def stats(self):
+        """
+        Returns the number of saves requested and written, the number of
+        writes which were avoided by coalescing them, and the number of
+        results waiting to be saved.
+        """
+        with self._cond:
+            return dict(
+                requested=self.requested,
+                written=self.written,
+                avoided=self.requested - self.written - bool(self._pending),
+                pending=len(self._pending),
+            )
+
+
 class Engine(schemattrdict, yamlfile):
     """
     This is a transactional state engine. Subclasses implement rules in the
@@ -101,10 +607,37 @@ class Engine(schemattrdict, yamlfile):
     satisfy the schema, then none of the event's actions' write operations
     are applied.
 
+    After each event, the new state is validated by validate_writes, which is
+    given the paths that the event wrote to. Subclasses can override it to
+    only validate what those writes could have changed; setting full_validation
+    makes every event validate the whole state against the schema instead,
+    which is useful for debugging. (The state is always fully validated when it
+    is instantiated, eg when it is loaded from disk.)
+
+    Events do not operate on a deep copy of the state. The next_state starts
+    out as a shallow copy of the serialized state, and write methods copy only
+    the containers along the path they are writing to (copy-on-write), so the
+    cost of an event scales with the size of its writes rather than with the
+    size of the state. Everything that is not written to is shared with the
+    committed state, which must therefore never be mutated in place.
+
+    After an event which changed the state is committed, it is saved by calling
+    save with its Result as the argument, so that the save method can persist
+    only the writes in it. Engine.batch calls save once with all of the
+    committed Results of the batch. The writes of saved Results can be applied
+    to a previously saved state with the replay method.
+
+    If the engine has an event_queue, events called from any thread but the
+    queue's own are run on the queue's thread (see EventQueue), so that only
+    one thread ever writes to the state.
+
     If the event does not have an error, after the new state is committed, the
     triggers are executed and their results are recorded in the event's
     result object. Triggers may modify state which exists outside of the state
-    engine, and may also initiate new events.
+    engine, and may also initiate new events. If the engine has a
+    trigger_executor, the triggers are run on its worker thread instead, and
+    the event returns without waiting for them; Result.pending and
+    Result.wait tell when they have been run.
 
     Calling an event will yield a Result object that contains a record of the
     event arguments and the resulting actions, writes, triggers, and trigger
@@ -121,19 +654,57 @@ class Engine(schemattrdict, yamlfile):
 
     Result = Result
 
+    full_validation = False
+
+    # This maps event names to their priority in the event_queue, if there is
+    # one. Lower numbers run first; see EventQueue.
+    event_priorities: dict[str, int] = {}
+
     def __init__(self, *a, **kw):
-        self._lock = Lock()
+        self._init_engine()
+        super(Engine, self).__init__(*a, **kw)
+
+    @classmethod
+    def _from_validated(cls, data):
+        self = super(Engine, cls)._from_validated(data)
+        self._init_engine()
+        return self
+
+    def _init_engine(self):
+        """
+        Initializes the attributes which are not part of the state. A copy of
+        an engine gets its own, as if it had been newly instantiated.
+        """
+        # reentrant, so that a thread which holds it can flush the saves
+        # (see SaveScheduler)
+        self._lock = RLock()
         self.result = None
         self.next_state = None
+        self._owned = {}
+        self._written = []
+        self._changed = False
         self.save = lambda *a: None
         self.info_log = lambda *a: None
         self.debug_log = lambda *a: None
         self.trigger_target = None
-        super(Engine, self).__init__(*a, **kw)
+        self.trigger_executor = None
+        self.event_queue = None
+        self.timings = EventTimings()
 
     def record(self, result):
         pass
 
+    def validate_writes(self, state, paths):
+        """
+        Returns the validated form of state, which is the next_state of the
+        current event. Paths is a list of the tuples of keys which were written
+        to by the event.
+
+        This implementation validates the entire state; subclasses can override
+        it to only validate the parts which the paths could have changed.
+        """
+        return self.schema.validate(state)
+
     @staticmethod
     def event(method):
         """
@@ -145,46 +716,218 @@ class Engine(schemattrdict, yamlfile):
 
         @wraps(method)
         def _method(self, *a, **kw):
-            new_state = None
-            res = self.Result(
-                event=(name, *a),
-                actions=[],
-                writes=[],
-                error=None,
-            )
-            error = None
+            if self._queued():
+                return self.event_queue.call(name, _method, self, *a, **kw)
             self._lock.acquire()
             try:
-                self.next_state = copy.deepcopy(self._dict())
-                self.result = res
-                # run event method on a copy of our state
-                method(self, *a, **kw)
-                # confirm event produced a new valid state
-                new_state = self.schema.validate(self.next_state)
-                if raw(new_state) == raw(self):
-                    self.debug_log("state unchanged")
-                else:
-                    # apply new state, cheating the ro_dict
-                    dict.update(self, new_state)
-                    self._as_dict = None  # part of careful ro_dict cheating
-                    self.save()
-            except Exception as ex:
-                error = [ex, traceback.format_exc()]
-                res = res._dict()
-                res.update(error=error[0], traceback=error[1], triggers=[])
-                res = self.Result(**res)
+                res = self._transact(name, method, a, kw)
             finally:
-                self.result = None
-                self.next_state = None
                 self._lock.release()
-            if self.trigger_target:
-                res.run_triggers(self.trigger_target)
-            self.record(res)
-            self.debug_log(res)
+            self._finish(res)
             return res
 
         return _method
 
+    def _queued(self):
+        """
+        True if events should be submitted to the event_queue instead of
+        being run on the current thread.
+        """
+        return (
+            self.event_queue is not None and not self.event_queue.is_current()
+        )
+
+    def _finish(self, res, records=None):
+        """
+        Runs the triggers of a committed result (or queues them to be run by
+        the trigger_executor), and then records the results in records (which
+        defaults to the result itself) and logs the result.
+        """
+
+        def done(res):
+            for record in [res] if records is None else records:
+                self.record(record)
+            for result in [res] + (records or []):
+                self.timings.add(result)
+            self.debug_log(res)
+
+        if self.trigger_executor is not None:
+            # when there is an event_queue, it waits for room in the backlog
+            # before queueing events instead
+            self.trigger_executor.submit(
+                res, done, block=self.event_queue is None
+            )
+        else:
+            if self.trigger_target:
+                res.run_triggers(self.trigger_target)
+            done(res)
+
+    def _transact(self, name, method, a, kw, save=True):
+        """
+        Runs an event method and commits the state it produces. This must be
+        called with the lock held. Returns the event's Result, which contains
+        the error instead if the event failed.
+
+        If save is False, the new state is only committed in memory, and the
+        caller is responsible for saving it.
+        """
+        res = self.Result(
+            event=(name, *a),
+            actions=[],
+            writes=[],
+            error=None,
+        )
+        try:
+            self.next_state = self._own(self._dict())
+            self.result = res
+            res.lap('copy')
+            # run event method on a copy-on-write view of our state
+            method(self, *a, **kw)
+            res.lap('actions')
+            if not self._changed:
+                # none of the writes (if there were any) changed anything
+                self.debug_log("state unchanged")
+            else:
+                # confirm event produced a new valid state
+                if self.full_validation:
+                    new_state = self.schema.validate(self.next_state)
+                else:
+                    new_state = self.validate_writes(
+                        self.next_state, self._written
+                    )
+                res.lap('validate')
+                # apply new state, cheating the ro_dict
+                changed = [
+                    k for k, v in new_state.items() if self.get(k) is not v
+                ]
+                before = self._as_dict
+                dict.update(self, new_state)
+                # part of careful ro_dict cheating: only the changed items
+                # are serialized again
+                self._as_dict = None
+                self._update_dict(before, changed)
+                res.lap('commit')
+                if save:
+                    self.save(res)
+                    res.lap('save')
+        except Exception as ex:
+            res = res._dict()
+            res.update(error=ex, traceback=traceback.format_exc(), triggers=[])
+            res = self.Result(**res)
+        finally:
+            self.result = None
+            self.next_state = None
+            self._owned = {}
+            self._written = []
+            self._changed = False
+        return res
+
+    def batch(self, events, atomic=False):
+        """
+        Processes a sequence of events in one transaction, and returns a
+        Result for the whole batch.
+
+        Each event is a tuple of an event name (without the event_ prefix)
+        and its arguments, eg ('INCOMING_DESCRIPTOR', descriptor). Each event
+        sees the state committed by the events before it, and gets its own
+        Result, which is recorded as if it had been processed by itself; the
+        batch result's results list contains them in order.
+
+        If atomic is False, an event which fails leaves the state as it was
+        before that event, and the rest of the batch is still processed. If
+        atomic is True, the first failure rolls back the state to what it was
+        before the batch, the remaining events are not processed, and the
+        batch result has the failed event's error.
+
+        The state is saved once at the end of the batch (if it changed), and
+        the triggers of all the committed events are run together afterwards,
+        so run_triggers merges the duplicates among all of them.
+        """
+        methods = []
+        for name, *args in events:
+            method = getattr(type(self), 'event_' + name, None)
+            if not hasattr(method, '__wrapped__'):
+                raise ValueError("No such event: %r" % (name,))
+            methods.append((name, method.__wrapped__, args))
+        if self._queued():
+            # the batch waits for the least urgent of its events
+            least_urgent = max(
+                (name for name, _, _ in methods),
+                key=self.event_queue.priority,
+                default='BATCH',
+            )
+            return self.event_queue.call(
+                least_urgent,
+                Engine.batch,
+                self,
+                [(name, *args) for name, _, args in methods],
+                atomic,
+            )
+        results, triggers, error, timings = [], [], {}, {}
+        self._lock.acquire()
+        before = dict(self)
+        # the results of the events whose writes were committed, or failed
+        committed = results
+        try:
+            for name, method, args in methods:
+                res = self._transact(name, method, args, {}, save=False)
+                results.append(res)
+                if atomic and not res.ok:
+                    dict.update(self, before)
+                    self._as_dict = None
+                    error = dict(error=res.error, traceback=res.traceback)
+                    committed = [res]
+                    break
+            else:
+                for res in results:
+                    triggers.extend(res.triggers)
+                if any(self[key] is not before[key] for key in before):
+                    start = time.monotonic_ns()
+                    self.save(*(res for res in results if res.ok))
+                    timings['save'] = time.monotonic_ns() - start
+        except Exception as ex:
+            error = dict(error=ex, traceback=traceback.format_exc())
+            if atomic:
+                dict.update(self, before)
+                self._as_dict = None
+                committed = []
+        finally:
+            self._lock.release()
+        batch = self.Result(
+            event=('BATCH', len(methods)),
+            actions=[],
+            writes=[],
+            triggers=[] if error else triggers,
+            results=results,
+            timings=timings,
+            **(error or dict(error=None)),
+        )
+        self._finish(batch, committed)
+        return batch
+
+    def replay(self, writes):
+        """
+        Applies a list of (name, path, value) writes, as found in the writes of
+        committed Results, in a transaction of their own. This bypasses the
+        events and actions which originally produced the writes, and it does
+        not save the state, record anything, or run any triggers.
+
+        Raises the exception if the writes could not be applied or did not
+        produce a valid state, in which case the state is unchanged.
+        """
+        with self._lock:
+            res = self._transact(
+                'REPLAY', Engine._replay, (writes,), {}, False
+            )
+        if res.error:
+            raise res.error
+
+    def _replay(self, writes):
+        for name, path, value in writes:
+            if name not in ('SET', 'ADD', 'REMOVE'):
+                raise ValueError("Unknown write: %r" % (name,))
+            getattr(self, '_' + name)(path, value)
+
     @staticmethod
     def action(method):
         """
@@ -210,6 +953,10 @@ class Engine(schemattrdict, yamlfile):
         Writes are where the state gets changed. They should be called from
         action methods, which should be called from event methods.
 
+        The undecorated write methods return True if they changed the value at
+        the path. Events where no write changed anything are neither validated
+        nor saved.
+
         The data model here is a bit weird and still not stable, but roughly
         speaking there are three write methods and they operate on these
         types:
@@ -236,53 +983,86 @@ class Engine(schemattrdict, yamlfile):
 
             if type(path) is str:
                 path = path.split('.')
-            if len(path) == 1:
-                target = self.next_state
-                key = path[0]
+            target = self.next_state
+            for step in path[:-1]:
+                # copy-on-write: containers along the path become our own
+                target[step] = self._own(target[step])
+                target = target[step]
+            key = path[-1]
+            value = raw(value)
+
+            if name != 'SET' and isinstance(target[key], dict):
+                # adding or removing dict items only writes to those items
+                self._written.extend(
+                    tuple(path) + (item,)
+                    for item in (
+                        value if isinstance(value, dict) else (value,)
+                    )
+                )
             else:
-                target = reduce(lambda a, b: a[b], path[:-1], self.next_state)
-                key = path[-1]
+                self._written.append(tuple(path))
 
-            method(self, target, key, raw(value))
+            if method(self, target, key, value):
+                self._changed = True
 
         return _method
 
+    def _own(self, value):
+        """
+        Returns a shallow copy of value which belongs to the current
+        transaction, unless value already is such a copy.
+
+        Containers in next_state are shared with the committed state until
+        they are written to; this is called for each container along a write
+        path so that only those get copied.
+        """
+        if id(value) not in self._owned:
+            value = copy.copy(value)
+            self._owned[id(value)] = value
+        return value
+
     @write
     def _SET(self, target, key, value):
+        changed = key not in target or target[key] != value
         target[key] = value
+        return changed
 
     @write
     def _ADD(self, target, key, value):
-        if isinstance(target[key], (list, tuple)):
-            target[key] = type(target[key])(
-                item for item in target[key] if raw(item) != value
-            ) + type(target[key])((value,))
-        elif isinstance(target[key], (set, frozenset)):
-            target[key] = type(target[key])(
-                frozenset(raw(target[key])) | set([value])
-            )
-        elif isinstance(target[key], dict):
-            if isinstance(value, dict):
-                target[key].update(value)
-            else:
-                target[key].update({value: True})
+        old = target[key]
+        if isinstance(old, (list, tuple)):
+            target[key] = type(old)(
+                item for item in old if raw(item) != value
+            ) + type(old)((value,))
+        elif isinstance(old, (set, frozenset)):
+            target[key] = type(old)(frozenset(raw(old)) | set([value]))
+        elif isinstance(old, dict):
+            items = value if isinstance(value, dict) else {value: True}
+            if all(k in old and old[k] == v for k, v in items.items()):
+                return False
+            target[key] = self._own(old)
+            target[key].update(items)
+            return True
         else:
-            raise ValueError("Can't add type: %r" % type(target[key]))
+            raise ValueError("Can't add type: %r" % type(old))
+        return target[key] != old
 
     @write
     def _REMOVE(self, target, key, value):
-        if isinstance(target[key], (list, tuple)):
-            target[key] = type(target[key])(
-                item for item in raw(target[key]) if item != raw(value)
-            )
-        elif isinstance(target[key], (set, frozenset)):
-            target[key] = type(target[key])(
-                frozenset(raw(target[key])) - set([raw(value)])
+        old = target[key]
+        if isinstance(old, (list, tuple)):
+            target[key] = type(old)(
+                item for item in raw(old) if item != raw(value)
             )
-        elif isinstance(target[key], dict):
+        elif isinstance(old, (set, frozenset)):
+            target[key] = type(old)(frozenset(raw(old)) - set([raw(value)]))
+        elif isinstance(old, dict):
+            target[key] = self._own(old)
             del target[key][value]
+            return True
         else:
-            raise ValueError("Can't remove type: %r" % type(target[key]))
+            raise ValueError("Can't remove type: %r" % type(old))
+        return target[key] != old
 
 
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+"""
+The journal is an append-only log of the writes which have been committed to
+the organize state since it was last written to the state file, which serves
+as the journal's snapshot.
+
+Each line of the journal file is a JSON object. The first line identifies the
+snapshot which the rest of the journal applies to (by the SHA-256 digest of the
+state file), and each following line contains the writes of one save. Writing
+a new snapshot starts a new journal, so a journal which does not match the
+state file on disk has already been incorporated into it and is ignored.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import click
+
+from .common import chown_like_dir_if_root, fsync_dir, raw
+from .constants import _ORGANIZE_JOURNAL_SNAPSHOT_INTERVAL
+
+
+def file_digest(path) -> str:
+    """
+    Returns the hex SHA-256 digest of a file's contents.
+    """
+    with open(path, 'rb') as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+class Journal(object):
+    """
+    An append-only journal of write operations.
+
+    >>> import tempfile
+    >>> d = tempfile.mkdtemp()
+    >>> snapshot = Path(d, 'state.yaml')
+    >>> _ = snapshot.write_text('a: 1\\n')
+    >>> journal = Journal(Path(d, 'state.journal'), snapshot_interval=2)
+    >>> journal.read(snapshot)
+    []
+    >>> journal.started
+    False
+    >>> journal.start(snapshot)
+    >>> journal.append([('SET', ['a'], 2)])
+    >>> journal.full
+    False
+    >>> journal.append([('SET', ['a'], 3)])
+    >>> journal.full
+    True
+    >>> Journal(journal.path).read(snapshot)
+    [[['SET', ['a'], 2]], [['SET', ['a'], 3]]]
+
+    A journal which has been removed is not appended to:
+
+    >>> journal.entries = 0
+    >>> journal.full
+    False
+    >>> journal.path.unlink()
+    >>> journal.full
+    True
+
+    A journal for a different snapshot is ignored:
+
+    >>> _ = snapshot.write_text('a: 3\\n')
+    >>> Journal(journal.path).read(snapshot)
+    []
+
+    A partially written last line is ignored, and left in place until the
+    next append:
+
+    >>> journal.start(snapshot)
+    >>> journal.append([('SET', ['a'], 4)])
+    >>> with open(journal.path, 'a') as fh:
+    ...     _ = fh.write('{"writes": [["SET", ["a"], 5')
+    >>> torn = journal.path.read_text()
+    >>> journal = Journal(journal.path)
+    >>> journal.read(snapshot)
+    [[['SET', ['a'], 4]]]
+    >>> journal.path.read_text() == torn
+    True
+    >>> journal.append([('SET', ['a'], 6)])
+    >>> Journal(journal.path).read(snapshot)
+    [[['SET', ['a'], 4]], [['SET', ['a'], 6]]]
+    """
+
+    def __init__(
+        self,
+        path,
+        snapshot_interval=_ORGANIZE_JOURNAL_SNAPSHOT_INTERVAL,
+        fsync=True,
+    ):
+        self.path = Path(path)
+        self.snapshot_interval = snapshot_interval
+        # whether appends and new journals are synced to disk before they
+        # are considered written
+        self.fsync = fsync
+        self.started = False
+        self.entries = 0
+        # the size of the journal without a partially written last line, if
+        # it had one when it was read
+        self._torn_at = None
+
+    @property
+    def full(self) -> bool:
+        """
+        True if a new snapshot should be written instead of appending, which
+        is also the case if the journal file has been removed (as appending
+        would recreate it without the snapshot's digest).
+        """
+        return (
+            not self.started
+            or self.entries >= self.snapshot_interval
+            or not self.path.exists()
+        )
+
+    def read(self, snapshot_path) -> list:
+        """
+        Returns the list of entries (lists of writes) which apply to the
+        snapshot at snapshot_path, and prepares the journal for appending to
+        them. Returns an empty list if the journal does not exist or does not
+        apply to the snapshot, in which case the journal is not started.
+
+        A partially written last line, from a crash during an append, is
+        ignored. Reading doesn't change the file; the line is truncated away
+        by the next append.
+        """
+        self.started = False
+        self.entries = 0
+        self._torn_at = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                lines = fh.read().split('\n')
+            header = json.loads(lines[0])
+            if header.get('snapshot') != file_digest(snapshot_path):
+                return []
+        except (OSError, ValueError, AttributeError):
+            return []
+        entries = []
+        # the last line is only complete if it ends with a newline
+        for line in lines[1:-1]:
+            try:
+                entries.append(json.loads(line)['writes'])
+            except (ValueError, KeyError, TypeError):
+                break
+        if lines[len(entries) + 1 :] != ['']:
+            complete = lines[: len(entries) + 1]
+            self._torn_at = len('\n'.join(complete).encode('utf-8')) + 1
+        self.started = True
+        self.entries = len(entries)
+        return entries
+
+    def start(self, snapshot_path):
+        """
+        Replaces the journal with an empty one for the snapshot which has just
+        been written to snapshot_path.
+        """
+        self._write([dict(snapshot=file_digest(snapshot_path))])
+        self.started = True
+        self.entries = 0
+        self._torn_at = None
+
+    def append(self, writes):
+        """
+        Appends an entry of writes to the journal, and syncs it to disk if
+        fsync is true.
+        """
+        assert self.started, "can't append to a journal before starting it"
+        # if the file is removed after full was checked, it is recreated as
+        # private as _write makes it, not with the umask's permissions
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        if self._torn_at is not None:
+            # drop the torn line which read ignored, so that appending after
+            # it doesn't make the new line unreadable too
+            os.ftruncate(fd, self._torn_at)
+            self._torn_at = None
+        with open(fd, 'a', encoding='utf-8') as fh:
+            fh.write(json.dumps(dict(writes=raw(writes))) + '\n')
+            if self.fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+        self.entries += 1
+
+    def _write(self, records):
+        self.path.touch(mode=0o600)
+        with click.open_file(
+            self.path, mode='w', encoding='utf-8', atomic=True
+        ) as fh:
+            fh.write(''.join(json.dumps(raw(r)) + '\n' for r in records))
+            if self.fsync:
+                fh.flush()
+                os.fsync(fh.fileno())
+        if self.fsync:
+            fsync_dir(self.path)
+        chown_like_dir_if_root(self.path)
@@ -8,15 +8,17 @@ modifying routing information. It does not need network access.
 
 from __future__ import annotations
 
+import atexit
 import os
 import pdb
+import signal
 import time
-from functools import lru_cache
+from functools import cached_property, lru_cache
 from ipaddress import ip_address, ip_network
 from logging import Logger, getLogger
 from pathlib import Path
 from platform import node
-from typing import Any
+from typing import Any, Optional
 
 import click
 import pydbus
@@ -28,11 +30,13 @@ from schema import Schema, Use
 
 from .common import (
     IPs,
+    SubnetMatcher,
     addrs_in_subnets,
     attrdict,
     b64_bytes,
     chown_like_dir_if_root,
     jsonrepr,
+    organize_dbus_if_active,
     raw,
     schemattrdict,
     sort_LL_first,
@@ -57,13 +61,22 @@ from .constants import (
     _WG_PORT,
     _VULA_ULA_SUBNET,
     _GW_ROUTES,
+    _LINUX_MAIN_ROUTING_TABLE,
     _IPv6_LL,
     _IPv6_ULA,
     _LRU_CACHE_MAX_SIZE,
 )
 from .csidh import ctidh, ctidh_parameters, hkdf
-from .discover import Discover
-from .engine import Engine, Result
+from .discover import DescriptorBatcher, Discover
+from .engine import (
+    Engine,
+    EventQueue,
+    EventTimings,
+    Result,
+    SaveScheduler,
+    TriggerExecutor,
+)
+from .journal import Journal
 from .notclick import DualUse
 from .peer import Descriptor, PeerCommands, Peers, Peer
 from .prefs import Prefs, PrefsCommands
@@ -145,8 +158,64 @@ class SystemState(schemattrdict):
             if k != _VULA_ULA_SUBNET
         }
 
+    @cached_property
+    def current_subnets_matcher(self):
+        """
+        >>> s = SystemState(current_subnets={'10.0.0.0/8': ['10.0.0.1'],
+        ... '10.1.0.0/16': ['10.1.0.1']})
+        >>> s.current_subnets_matcher.longest_match(ip_address('10.1.2.3'))
+        IPv4Network('10.1.0.0/16')
+        """
+        return SubnetMatcher(self.current_subnets)
+
+    @cached_property
+    def current_subnets_no_ULA_matcher(self):
+        return SubnetMatcher(self.current_subnets_no_ULA)
+
+
+class OrganizeResult(Result):
+    """
+    The result of an OrganizeState event.
+
+    Of the triggers, remove_routes calls for the same table and device are
+    merged into one, and remove_unknown is only run once, after the triggers
+    which might make it unnecessary. Each peer is only synced once.
+    """
+
+    coalesce = dict(remove_routes='union', remove_unknown='last')
+
 
 class OrganizeState(Engine, yamlrepr_hl):
+    Result = OrganizeResult
+
+    # user requests come first, and descriptors, which can arrive in floods,
+    # come last
+    event_priorities = dict(
+        USER_EDIT=0,
+        USER_REMOVE_PEER=0,
+        USER_PEER_ADDR_ADD=0,
+        USER_PEER_ADDR_DEL=0,
+        VERIFY_AND_PIN_PEER=0,
+        RELEASE_GATEWAY=0,
+        NEW_SYSTEM_STATE=1,
+        INCOMING_DESCRIPTOR=2,
+    )
+
+    # the results of user requests are saved right away, rather than being
+    # coalesced with other saves
+    urgent_saves = frozenset(
+        name for name, priority in event_priorities.items() if priority == 0
+    )
+
+    # these are the invariants which involve more than one peer, and so can't
+    # be checked by the schema of an individual Peer object.
+    invariants = Schema(
+        And(
+            lambda state: not state['peers'].conflicts,
+            error="conflicting peers: {[peers].conflicts}",
+        )
+    )
+
     schema = Schema(
         And(
             Use(dict),
@@ -156,10 +225,7 @@ class OrganizeState(Engine, yamlrepr_hl):
                 'system_state': Use(SystemState),
                 'event_log': object,
             },
-            And(
-                lambda state: not state['peers'].conflicts,
-                error="conflicting peers: {[peers].conflicts}",
-            ),
+            invariants,
         )
     )
 
@@ -175,6 +241,39 @@ class OrganizeState(Engine, yamlrepr_hl):
         if self.prefs.record_events:
             self.event_log.append(raw(res))
 
+    def validate_writes(self, state, paths):
+        """
+        Validates the prefs, system_state, and individual peers which were
+        written to, and reuses the current (already validated) objects for
+        everything else. The invariants are only checked if peers changed, and
+        then only for conflicts involving the peers which changed; the full
+        check of all peers is done when the state is loaded, when all of the
+        peers are replaced, and in full_validation mode.
+        """
+        keys = {path[0] for path in paths}
+        if not keys <= {'prefs', 'peers', 'system_state'}:
+            return self.schema.validate(state)
+        new = dict(self)
+        if 'prefs' in keys:
+            new['prefs'] = Prefs(state['prefs'])
+        if 'system_state' in keys:
+            new['system_state'] = SystemState(state['system_state'])
+        if 'peers' in keys:
+            if ('peers',) in paths:
+                new['peers'] = Peers(state['peers'])
+                self.invariants.validate(new)
+            else:
+                changed = {path[1] for path in paths if path[0] == 'peers'}
+                new['peers'] = self.peers.replace(
+                    {vk: state['peers'].get(vk) for vk in changed}
+                )
+                # the peers which weren't written to had no conflicts among
+                # themselves, so only the written ones need to be checked.
+                # if they have any, the invariants raise the usual error.
+                if new['peers'].conflicts_involving(changed):
+                    self.invariants.validate(new)
+        return new
+
     @Engine.event
     def event_VERIFY_AND_PIN_PEER(self, vk, hostname):
         _id = self.peers.with_hostname(hostname).id
@@ -224,7 +323,7 @@ class OrganizeState(Engine, yamlrepr_hl):
         self._REMOVE(('peers', vk, 'IPv%saddrs' % (ipa.version,)), ip)
         self.result.add_triggers(sync_peer=(peer.id,))
         self.result.add_triggers(
-            remove_routes=(ip + ('/32' if ipa.version == 4 else '/128'),)
+            remove_routes=((ip + ('/32' if ipa.version == 4 else '/128'),),)
         )
 
     @Engine.event
@@ -275,7 +374,9 @@ class OrganizeState(Engine, yamlrepr_hl):
             # if a non-pinned peer had our gateway IP but no longer does,
             # remove its gateway flag
             self._SET(('peers', cur_gw.id, 'use_as_gateway'), False)
-            self.result.add_triggers(remove_routes=_GW_ROUTES)
+            self.result.add_triggers(
+                remove_routes=(_GW_ROUTES, _LINUX_MAIN_ROUTING_TABLE)
+            )
         if not (cur_gw and cur_gw.pinned):
             # if there isn't a pinned peer acting as the gateway.
             # FIXME: this could set two peers as the gateway if the system has
@@ -320,7 +421,8 @@ class OrganizeState(Engine, yamlrepr_hl):
             return self.action_IGNORE(descriptor, "replay")
 
         if not addrs_in_subnets(
-            descriptor.all_addrs, set(self.system_state.current_subnets_no_ULA)
+            descriptor.all_addrs,
+            self.system_state.current_subnets_no_ULA_matcher,
         ):
             return self.action_REJECT(
                 descriptor,
@@ -380,21 +482,14 @@ class OrganizeState(Engine, yamlrepr_hl):
             desc = peer.descriptor
         if system_state is None:
             system_state = self.system_state
-        subnets = list(system_state.current_subnets_no_ULA)
+        subnets = system_state.current_subnets_no_ULA_matcher
+        allowed = self.prefs.subnets_allowed_matcher
         if peer.pinned:
             v4 = {i: True for i in desc.IPv4addrs + list(peer.IPv4addrs)}
             v6 = {i: True for i in desc.IPv6addrs + list(peer.IPv6addrs)}
         else:
-            v4 = {
-                i: any(i in s for s in subnets)
-                and any(i in s for s in self.prefs.subnets_allowed)
-                for i in desc.IPv4addrs
-            }
-            v6 = {
-                i: any(i in s for s in subnets)
-                and any(i in s for s in self.prefs.subnets_allowed)
-                for i in desc.IPv6addrs
-            }
+            v4 = {i: i in subnets and i in allowed for i in desc.IPv4addrs}
+            v6 = {i: i in subnets and i in allowed for i in desc.IPv6addrs}
         if v4 != peer.IPv4addrs:
             self._SET(
                 ('peers', peer.id, 'IPv4addrs'),
@@ -423,7 +518,7 @@ class OrganizeState(Engine, yamlrepr_hl):
         if set(
             a
             for a in desc.all_addrs
-            if any(a in s for s in system_state.current_subnets_no_ULA)
+            if a in system_state.current_subnets_no_ULA_matcher
         ) & set(self.system_state.gateways):
             # BUG: this will fail (new peer won't be accepted) if the new peer
             # has a gateway IP and there is already another gateway. it fails
@@ -444,9 +539,9 @@ class OrganizeState(Engine, yamlrepr_hl):
             remove_routes=(tuple(map(str, peer.routes)),),
         )
         if peer.use_as_gateway:
-            # FIXME: this doesn't specify the routing table. maybe need to make
-            # triggers api accept kwargs too?
-            self.result.add_triggers(remove_routes=_GW_ROUTES)
+            self.result.add_triggers(
+                remove_routes=(_GW_ROUTES, _LINUX_MAIN_ROUTING_TABLE)
+            )
             # these routes are currently only removed because we still call
             # sync (aka full repair) on system state change
 
@@ -546,6 +641,14 @@ class Organize(attrdict):
             <arg type='b' name='interactive' direction='in'/>
             <arg type='s' name='response' direction='out'/>
         </method>
+        <method name='stats'>
+          <arg type='b' name='interactive' direction='in'/>
+          <arg type='s' name='response' direction='out'/>
+        </method>
+        <method name='event_timings'>
+          <arg type='b' name='interactive' direction='in'/>
+          <arg type='s' name='response' direction='out'/>
+        </method>
       </interface>
       <interface name='local.vula.organize1.Peers'>
         <method name='show_peer'>
@@ -601,6 +704,10 @@ class Organize(attrdict):
           <arg type='s' name='descriptor' direction='in'/>
           <arg type='s' name='response' direction='out'/>
         </method>
+        <method name='process_descriptor_strings'>
+          <arg type='as' name='descriptors' direction='in'/>
+          <arg type='s' name='response' direction='out'/>
+        </method>
       </interface>
       <interface name='local.vula.organize1.Prefs'>
         <method name='get_prefs'>
@@ -645,6 +752,7 @@ class Organize(attrdict):
         self._state.info_log = self.log.info
         self._state.debug_log = self.log.debug
         self._current_descriptors: dict[str, str] = {}
+        self._hosts_written: Optional[str] = None
 
         if ctx.invoked_subcommand is None:
             self.run(monolithic=False)
@@ -776,6 +884,22 @@ class Organize(attrdict):
                 )
             self.log.debug("Created new OrganizeState")
 
+        self._journal = Journal(Path(self.state_file).with_suffix('.journal'))
+        entries = self._journal.read(self.state_file)
+        try:
+            for writes in entries:
+                state.replay(writes)
+        except Exception as ex:
+            # the next save will write a new snapshot of what we have
+            self.log.info("Couldn't replay journal: %r", ex)
+            self._journal.started = False
+        else:
+            if entries:
+                self.log.debug(
+                    "Replayed %s journal entries, state has %s peers"
+                    % (len(entries), len(state.peers))
+                )
+
         if state.event_log:
             self.log.info(
                 "event_log contains %s entries" % (len(state.event_log),)
@@ -794,53 +918,80 @@ class Organize(attrdict):
     def prefs(self):
         return self._state.prefs
 
+    def _hosts_file_text(self) -> str:
+        """
+        Returns the contents of the hosts file for the current state.
+        """
+        hosts = {}
+        hosts_v4 = {}
+        for peer in self.peers.limit(enabled=True).values():
+            v4 = next((a for a in peer.enabled_ips if a.version == 4), None)
+            for name in peer.enabled_names:
+                hosts[name] = peer.primary_ip
+                if v4 is not None:
+                    hosts_v4[name] = v4
+        lines = [f"{self.prefs.primary_ip} {self.hostname}\n"]
+        if v4s := IPs(self.state.system_state.current_ips).v4s:
+            lines.append(f"{v4s[0]} {self.hostname}\n")
+        lines.append(
+            "\n".join("%s %s" % (ip, host) for host, ip in hosts.items())
+            + "\n"
+        )
+        lines.append(
+            "\n".join(
+                "%s %s" % (ip, host)
+                for host, ip in hosts_v4.items()
+                if hosts[host] != ip
+            )
+            + "\n"
+        )
+        return ''.join(lines)
+
     @DualUse.method()
     def _write_hosts_file(self) -> bool:
         """
-        Write the hosts file
+        Write the hosts file, if its contents have changed since we last
+        wrote it. Returns True if it was written.
         """
         hosts_file: str = _ORGANIZE_HOSTS_FILE
-        hosts = {
-            name: peer.primary_ip
-            for peer in self.peers.limit(enabled=True).values()
-            for name in peer.enabled_names
-        }
-        hosts_v4 = {
-            name: ips[0]
-            for peer in self.peers.limit(enabled=True).values()
-            for name in peer.enabled_names
-            if (ips := [a for a in peer.enabled_ips if a.version == 4])
-        }
+        text = self._hosts_file_text()
+        # most saves don't change any names or IPs (eg, a descriptor's vf
+        # was updated), so we don't make resolvers reload an identical file
+        if text == self._hosts_written and os.path.exists(hosts_file):
+            return False
         Path(hosts_file).touch(mode=0o644)
         with click.open_file(
             hosts_file, mode='w', encoding='utf-8', atomic=True
         ) as fh:
-            fh.write(f"{self.prefs.primary_ip} {self.hostname}\n")
-            if v4s := IPs(self.state.system_state.current_ips).v4s:
-                fh.write(f"{v4s[0]} {self.hostname}\n")
-            fh.write(
-                "\n".join("%s %s" % (ip, host) for host, ip in hosts.items())
-                + "\n"
-            )
-            fh.write(
-                "\n".join(
-                    "%s %s" % (ip, host)
-                    for host, ip in hosts_v4.items()
-                    if hosts[host] != ip
-                )
-                + "\n"
-            )
+            fh.write(text)
         chown_like_dir_if_root(hosts_file)
+        self._hosts_written = text
         return True
 
     @DualUse.method()
-    def save(self):
+    def save(self, *results):
         """
         Save state to disk. (Should be no-op if run from the commandline in a
         new organize instance.)
+
+        When called by the state engine with the results of the events which
+        changed the state, their writes are appended to the journal instead of
+        writing the whole state file, unless it is time for a new snapshot.
+        While organize is running, the engine's saves are coalesced by a
+        SaveScheduler (see run), so the results may be those of several
+        events. The files are synced to disk if the save_fsync pref is set.
         """
-        self.state.write_yaml_file(self.state_file, mode=0o600, autochown=True)
-        self.log.info("vula state file updated: %i peers", len(self.peers))
+        fsync = self.prefs.save_fsync
+        self._journal.fsync = fsync
+        if results and not self._journal.full:
+            self._journal.append([w for res in results for w in res.writes])
+            self.log.debug("vula state journal updated")
+        else:
+            self.state.write_yaml_file(
+                self.state_file, mode=0o600, autochown=True, fsync=fsync
+            )
+            self._journal.start(self.state_file)
+            self.log.info("vula state file updated: %i peers", len(self.peers))
         self._write_hosts_file()
 
     @DualUse.method()
@@ -857,19 +1008,18 @@ class Organize(attrdict):
     )
     def sync(self, dryrun=False, verbose=False, firstrun=False):
         """
-        Sync system to the desired organized state.
+        Sync system to the desired organized state. The system's state is
+        dumped once, and only the operations which are needed are done (see
+        Sys.reconcile); with dryrun, they are only returned.
+
+        Once triggers are run by the trigger executor, the sync is run by it
+        too, so that it doesn't change the system while triggers do.
         """
-        res = []
-        res += self.sys.sync_interfaces(dryrun=dryrun)
-        res += self.sys.sync_iprules(dryrun=dryrun)
-        for peer in self.peers.values():
-            self.log.debug("syncing peer %s", peer.name_and_id)
-            try:
-                peer_res = self.sys.sync_peer(peer.id, dryrun)
-            except Exception as ex:
-                peer_res = repr(ex)
-            res.append(peer_res)
-        res += self.sys.remove_unknown(dryrun=dryrun)
+        executor = self.state.trigger_executor
+        if executor is None:
+            res = self.sys.reconcile(dryrun=dryrun)
+        else:
+            res = executor.call(self.sys.reconcile, dryrun)
         res = list(filter(None, res))
         if res and not firstrun:
             pass
@@ -925,7 +1075,9 @@ class Organize(attrdict):
 
         if monolithic or no_dbus:
             self.discover = Discover()
-            self.discover.callbacks.append(self.process_descriptor)
+            self.discover.callbacks.append(
+                DescriptorBatcher(self.process_descriptors).add
+            )
             self.publish = Publish()
         else:
             self.discover = system_bus.get(
@@ -985,10 +1137,41 @@ class Organize(attrdict):
         self._instruct_zeroconf()
         self.sync()
 
+        # from now on, run triggers on a worker thread so that they don't
+        # block the DBus and netlink monitor threads which call events, and
+        # run the events themselves on a thread of their own
+        self._state.trigger_executor = TriggerExecutor(
+            self.sys, log=self.log.info
+        )
+        self._state.event_queue = EventQueue(self._state)
+
+        # and coalesce the saves of the events which come in quick succession,
+        # such as descriptors during discovery. whatever is waiting to be
+        # saved is saved when we exit, including on SIGTERM.
+        atexit.register(self._coalesce_saves().flush)
+
         if not no_dbus:
+            GLib.unix_signal_add(
+                GLib.PRIORITY_DEFAULT, signal.SIGTERM, main_loop.quit
+            )
             self.log.info("calling GLib.MainLoop().run()")
             main_loop.run()
 
+    def _coalesce_saves(self):
+        """
+        Makes the state engine's saves go through a SaveScheduler, which
+        saves the results of the events within save_delay seconds of each
+        other together, except for those of user requests. Returns the
+        SaveScheduler.
+        """
+        self._state.save = SaveScheduler(
+            self.save,
+            self._state._lock,
+            delay=lambda: self.prefs.save_delay,
+            urgent=lambda res: res.event[0] in self._state.urgent_saves,
+        )
+        return self._state.save
+
     def _instruct_zeroconf(self) -> None:
         descriptors: dict[str, str] = {}
         vf: int = int(time.time())
@@ -998,8 +1181,8 @@ class Organize(attrdict):
             ips = [
                 ip
                 for ip in ips
-                if any(ip in net for net in self.prefs.subnets_allowed)
-                and not any(ip in net for net in self.prefs.subnets_forbidden)
+                if ip in self.prefs.subnets_allowed_matcher
+                and ip not in self.prefs.subnets_forbidden_matcher
             ]
             ips_to_publish.extend(list(map(str, ips)))
             descriptors[iface] = str(
@@ -1055,7 +1238,7 @@ class Organize(attrdict):
         peer = self.peers.query(query)
         return str(peer.descriptor) if peer else ''
 
-    def process_descriptor_string(self: Organize, descriptor_string: str):
+    def _parse_descriptor(self, descriptor_string: str):
         self.log.debug("about to parse descriptor: %r", descriptor_string)
         try:
             descriptor = Descriptor.parse(descriptor_string)
@@ -1073,14 +1256,46 @@ class Organize(attrdict):
             )
             return
 
-        return self.process_descriptor(descriptor)
+        return descriptor
 
-    def process_descriptor(self: Organize, descriptor: Descriptor):
+    def _verify_descriptor(self, descriptor: Descriptor) -> bool:
         if not descriptor.verify_signature():
             self.log.info(
                 "Discarded descriptor with invalid signature: %r"
                 % (descriptor,)
             )
+            return False
+        return True
+
+    def process_descriptor_string(self: Organize, descriptor_string: str):
+        descriptor = self._parse_descriptor(descriptor_string)
+        if descriptor is None:
+            return
+        return self.process_descriptor(descriptor)
+
+    def process_descriptor_strings(self: Organize, descriptor_strings):
+        """
+        Processes a burst of descriptors as one batch of events, so that the
+        state is saved and the triggers are run only once for all of them.
+        Descriptors which can't be parsed or verified are skipped.
+        """
+        return self.process_descriptors(
+            filter(None, map(self._parse_descriptor, descriptor_strings))
+        )
+
+    def process_descriptors(self: Organize, descriptors):
+        """
+        Like process_descriptor_strings, for parsed descriptors.
+        """
+        res = self.state.batch(
+            ('INCOMING_DESCRIPTOR', descriptor)
+            for descriptor in descriptors
+            if self._verify_descriptor(descriptor)
+        )
+        return str(yamlrepr(res))
+
+    def process_descriptor(self: Organize, descriptor: Descriptor):
+        if not self._verify_descriptor(descriptor):
             return
 
         res = self.state.event_INCOMING_DESCRIPTOR(descriptor)
@@ -1113,6 +1328,54 @@ class Organize(attrdict):
         else:
             return "Forbidden"
 
+    @DualUse.method()
+    def stats(self, interactive=True, dbus_context=None):
+        """
+        Returns YAML describing the event queue, the trigger backlog, the
+        saves of the state, including how many writes were avoided by
+        coalescing them, the netlink events which were received and how many
+        of them caused a refresh of the system state, and the last sync.
+
+        On the command line, this asks the running organize for its stats.
+        """
+        if dbus_context is None:
+            return organize_dbus_if_active().stats(interactive)
+        if not dbus_context.is_authorized(
+            'local.vula.organize1.Debug.stats',
+            details={},
+            interactive=interactive,
+        ):
+            return "Forbidden"
+        res = {}
+        if self.state.event_queue is not None:
+            res['event_queue'] = self.state.event_queue.stats()
+        if self.state.trigger_executor is not None:
+            res['trigger_backlog'] = self.state.trigger_executor.backlog
+        if isinstance(self.state.save, SaveScheduler):
+            res['saves'] = self.state.save.stats()
+        res['netlink_events'] = self.sys.netlink_event_stats()
+        if self.sys.last_sync is not None:
+            res['last_sync'] = self.sys.last_sync
+        return str(yamlrepr(res))
+
+    @DualUse.method()
+    def event_timings(self, interactive=True, dbus_context=None):
+        """
+        Returns YAML histograms of the time spent in each phase of each type
+        of event since organize started.
+
+        On the command line, this asks the running organize for its timings.
+        """
+        if dbus_context is None:
+            return organize_dbus_if_active().event_timings(interactive)
+        if not dbus_context.is_authorized(
+            'local.vula.organize1.Debug.event_timings',
+            details={},
+            interactive=interactive,
+        ):
+            return "Forbidden"
+        return str(yamlrepr(self.state.timings.stats()))
+
     def test_auth(self, interactive, dbus_context):
         if dbus_context.is_authorized(
             'local.vula.organize1.Debug.test_auth',
@@ -1157,16 +1420,32 @@ class Organize(attrdict):
             self.state.event_USER_EDIT('REMOVE', ['prefs', pref], value)
         )
 
-    @DualUse.method()
-    def eventlog(self):
+    @DualUse.method(
+        opts=(
+            click.option(
+                '-t',
+                '--timings',
+                is_flag=True,
+                help="Show histograms of the recorded events' timings",
+            ),
+        )
+    )
+    def eventlog(self, timings=False):
+        results = list(map(OrganizeResult, self.state.event_log))
+        if timings:
+            histograms = EventTimings()
+            for result in results:
+                histograms.add(result)
+            return str(yamlrepr(histograms.stats()))
         return "\n".join(
-            "{event}: {actions} {writes} {triggers}".format(
+            "{event}: {actions} {writes} {triggers} {us}us".format(
                 event=result.event[0],
                 actions=[action[0] for action in result.actions],
                 writes=[write[0] for write in result.writes],
                 triggers=[trigger[0] for trigger in result.triggers],
+                us=sum(result.get('timings', {}).values()) // 1000,
             )
-            for result in map(Result, self.state.event_log)
+            for result in results
         )
 
 
@@ -4,6 +4,7 @@ import json
 import time
 from base64 import b64encode
 from datetime import timedelta
+from functools import cached_property
 from io import StringIO
 from ipaddress import IPv4Address, IPv6Address, ip_address, ip_network
 from typing import List, Self, Any
@@ -227,7 +228,9 @@ class Descriptor(schemattrdict, serializable):
         # ^^^
         return self.verify_signature()
 
-    @property
+    # descriptors are never modified once they are validated, so the
+    # properties derived from their addresses are only computed once.
+    @cached_property
     def IPv4addrs(self):
         """
         >>> from vula.constants import _TEST_DESC_UNSIGNED
@@ -237,7 +240,7 @@ class Descriptor(schemattrdict, serializable):
         """
         return list(getattr(self, 'v4a', ()))
 
-    @property
+    @cached_property
     def IPv6addrs(self):
         """
         >>> from vula.constants import _TEST_DESC_UNSIGNED
@@ -249,7 +252,7 @@ class Descriptor(schemattrdict, serializable):
         """
         return list(getattr(self, 'v6a', ()))
 
-    @property
+    @cached_property
     def all_addrs(self):
         return self.IPv6addrs + self.IPv4addrs
 
@@ -325,6 +328,19 @@ class Descriptor(schemattrdict, serializable):
         return sio.read()
 
 
+def _share_addrs(peer):
+    """
+    Replaces the addresses in a validated peer's IPv4addrs and IPv6addrs with
+    the equal address objects of its descriptor, so that each address is only
+    held in memory once.
+    """
+    desc = peer['descriptor']
+    addrs = {a: a for key in ('v4a', 'v6a') for a in desc.get(key, ())}
+    for key in ('IPv4addrs', 'IPv6addrs'):
+        peer[key] = {addrs.get(a, a): on for a, on in peer[key].items()}
+    return peer
+
+
 class Peer(schemattrdict):
     schema = Schema(
         And(
@@ -342,6 +358,7 @@ class Peer(schemattrdict):
             },
             # lambda peer:
             # peer['descriptor'].verify_signature() or peer.get('_allow_unsigned_descriptor')
+            Use(_share_addrs),
         )
     )
 
@@ -359,7 +376,10 @@ class Peer(schemattrdict):
         "WireGuard public key."
         return self.descriptor.pk
 
-    @property
+    # peers are never modified once they are validated (an event which changes
+    # a peer replaces it with a new Peer object), so the properties which are
+    # derived from a peer's names and addresses are cached on each instance.
+    @cached_property
     def name(self):
         """
         This returns the best name, for display purposes.
@@ -410,7 +430,7 @@ class Peer(schemattrdict):
         """
         return "%s (%s)" % (self.name, self.id)
 
-    @property
+    @cached_property
     def enabled_names(self):
         return sorted(
             set(
@@ -419,7 +439,7 @@ class Peer(schemattrdict):
             )
         )
 
-    @property
+    @cached_property
     def enabled_ips(self):
         return (
             [self.primary_ip]
@@ -437,11 +457,11 @@ class Peer(schemattrdict):
     def primary_ip(self):
         return self.descriptor.p
 
-    @property
+    @cached_property
     def enabled_ips_str(self):
         return [str(ip) for ip in self.enabled_ips]
 
-    @property
+    @cached_property
     def routable_ips(self):
         return [
             ip
@@ -449,25 +469,22 @@ class Peer(schemattrdict):
             if not (ip.version == 6 and ip.is_link_local)
         ]
 
-    @property
+    @cached_property
     def routes(self):
         return [
             ip_network("%s/%s" % (ip, ip.max_prefixlen))
             for ip in self.routable_ips
         ]
 
-    @property
+    @cached_property
     def _wg_allowed_ips(self):
-        res = [
-            ip_network("%s/%s" % (ip, ip.max_prefixlen))
-            for ip in self.routable_ips
-        ]
+        res = list(self.routes)
         if self.use_as_gateway:
             res.append(ip_network("0.0.0.0/0"))
             res.append(ip_network("::/0"))
         return list(map(str, res))
 
-    @property
+    @cached_property
     def endpoint_addr(self):
         if ips := sort_LL_first(
             i for i in self.enabled_ips if i not in _VULA_ULA_SUBNET
@@ -573,9 +590,127 @@ class Peers(yamlrepr, queryable, schemadict):
         },
     )
 
+    # The enabled peers are indexed by these attributes (or attributes of
+    # their descriptors), as by() would index them, for looking up peers by
+    # name, key, or address without scanning all of them. Each index is built
+    # when it is first used, and replace() carries the built indexes over to
+    # the new Peers object.
+    indexed = (
+        'enabled_names',
+        'nicknames',
+        'wg_pk',
+        'IPv4addrs',
+        'IPv6addrs',
+        'enabled_ips',
+        'enabled_ips_str',
+        'descriptor.hostname',
+        'descriptor.pk',
+        'descriptor.IPv4addrs',
+        'descriptor.IPv6addrs',
+    )
+
+    def _subset(self, items):
+        # peers are validated individually, so a subset of valid peers is valid
+        return self._from_validated(items)
+
+    @staticmethod
+    def _index_keys(peer, attr):
+        value = peer
+        for name in attr.split('.'):
+            value = getattr(value, name)
+        if isinstance(value, list):
+            return value
+        if isinstance(value, dict):
+            return [key for key, on in value.items() if on]
+        return [value]
+
+    def _index(self, attr):
+        """
+        Returns the index of the enabled peers by attr, which maps each value
+        of attr to a dictionary of the peers which have it, by ID.
+        """
+        assert attr in self.indexed, attr
+        indexes = self.__dict__.setdefault('_indexes', {})
+        if attr not in indexes:
+            index = indexes[attr] = {}
+            for vk, peer in self.items():
+                if peer.enabled:
+                    for key in self._index_keys(peer, attr):
+                        index.setdefault(key, {})[vk] = peer
+        return indexes[attr]
+
+    def _lookup(self, attr, key):
+        """
+        Returns the list of enabled peers which have key among the values of
+        attr, in the same order as limit(enabled=True).by(attr).get(key, []).
+
+        >>> from vula.constants import _TEST_DESC_UNSIGNED
+        >>> peer = Descriptor.parse(_TEST_DESC_UNSIGNED).make_peer()
+        >>> peers = Peers({peer.id: peer})
+        >>> [p.id for p in peers._lookup('wg_pk', peer.wg_pk)] == [peer.id]
+        True
+        >>> peers.replace({peer.id: None})._lookup('wg_pk', peer.wg_pk)
+        []
+        """
+        hits = self._index(attr).get(key)
+        if not hits:
+            return []
+        if len(hits) == 1:
+            return list(hits.values())
+        return [peer for vk, peer in self.items() if vk in hits]
+
+    def replace(self, changes):
+        """
+        Returns a new Peers object with the peers in the changes dictionary
+        replaced by its values, or removed if their value is None.
+
+        Only the changed peers are validated; the others are shared with this
+        object. Likewise, the serialized form and the indexes which have been
+        built are updated for the changed peers, rather than being built
+        again.
+        """
+        new = dict(self)
+        for vk, peer in self.schema.validate(
+            {vk: peer for vk, peer in changes.items() if peer is not None}
+        ).items():
+            new[vk] = peer
+        for vk, peer in changes.items():
+            if peer is None:
+                new.pop(vk, None)
+        res = self._from_validated(new)
+        res._update_dict(self._as_dict, changes)
+        res._indexes = {
+            attr: self._update_index(index, attr, changes, new)
+            for attr, index in self.__dict__.get('_indexes', {}).items()
+        }
+        return res
+
+    def _update_index(self, index, attr, changes, new):
+        """
+        Returns a copy of one of our indexes, updated for the peers whose IDs
+        are the keys of changes, and which are now as they are in new. The
+        dictionaries of peers in the index which are changed are copied too.
+        """
+        index = dict(index)
+        for vk in changes:
+            for peer, add in ((self.get(vk), False), (new.get(vk), True)):
+                if peer is None or not peer.enabled:
+                    continue
+                for key in self._index_keys(peer, attr):
+                    hits = dict(index.get(key, ()))
+                    if add:
+                        hits[vk] = peer
+                    else:
+                        hits.pop(vk, None)
+                    if hits:
+                        index[key] = hits
+                    else:
+                        index.pop(key, None)
+        return index
+
     def with_hostname(self: Peers, name: str):
         "Return peer with given hostname (among all of its enabled names)"
-        res = self.limit(enabled=True).by('nicknames').get(name, [])
+        res = self._lookup('nicknames', name)
         if len(res) > 1:
             raise Bug(
                 # this should not be possible, as both the state logic and
@@ -590,7 +725,7 @@ class Peers(yamlrepr, queryable, schemadict):
     def with_ip(self, ip):
         "Return peer with given IP address"
         ip = ip_address(ip)
-        res = self.limit(enabled=True).by('enabled_ips').get(ip, [])
+        res = self._lookup('enabled_ips', ip)
         if len(res) > 1:
             raise ConsistencyError(
                 # this should also not be possible, because the state logic
@@ -627,36 +762,83 @@ class Peers(yamlrepr, queryable, schemadict):
         return list(
             {
                 conflict.id: conflict
-                for conflict in self.limit(enabled=True)
-                .by('enabled_names')
-                .get(desc.hostname, [])
-                + self.limit(enabled=True).by('wg_pk').get(desc.pk, [])
+                for conflict in self._lookup('enabled_names', desc.hostname)
+                + self._lookup('wg_pk', desc.pk)
+                + sum(
+                    (self._lookup('IPv4addrs', ip) for ip in desc.IPv4addrs),
+                    [],
+                )
+                + sum(
+                    (self._lookup('IPv6addrs', ip) for ip in desc.IPv6addrs),
+                    [],
+                )
+                if conflict.id != desc.id
+            }.values()
+        )
+
+    def conflicts_involving(self, ids):
+        """
+        Returns the list of IDs of the enabled peers which are in conflicts
+        that involve any of the peers with the given IDs, which are checked
+        both ways: whether their descriptors conflict with other peers, and
+        whether other peers' descriptors conflict with them.
+
+        If the peers which are not in ids have no conflicts among themselves
+        (for instance because they haven't changed since the last time that
+        conflicts was checked), this finds all of the conflicts which the
+        conflicts property would, without checking every peer.
+        """
+        res = {}
+        gateway = False
+        for vk in ids:
+            peer = self.get(vk)
+            if peer is None or not peer.enabled:
+                continue
+            if self.conflicts_for_descriptor(peer.descriptor):
+                res[vk] = True
+            for other in (
+                sum(
+                    (
+                        self._lookup('descriptor.hostname', name)
+                        for name in peer.enabled_names
+                    ),
+                    [],
+                )
+                + self._lookup('descriptor.pk', peer.wg_pk)
                 + sum(
                     (
-                        self.limit(enabled=True).by('IPv4addrs').get(ip, [])
-                        for ip in desc.IPv4addrs
+                        self._lookup('descriptor.IPv4addrs', ip)
+                        for ip in self._index_keys(peer, 'IPv4addrs')
                     ),
                     [],
                 )
                 + sum(
                     (
-                        self.limit(enabled=True).by('IPv6addrs').get(ip, [])
-                        for ip in desc.IPv6addrs
+                        self._lookup('descriptor.IPv6addrs', ip)
+                        for ip in self._index_keys(peer, 'IPv6addrs')
                     ),
                     [],
                 )
-                if conflict.id != desc.id
-            }.values()
-        )
+            ):
+                if other.id != peer.id:
+                    res[other.id] = True
+            gateway = gateway or peer.get('use_as_gateway')
+        if gateway:
+            enabled_gws = self.limit(use_as_gateway=True, enabled=True)
+            if len(enabled_gws) > 1:
+                res.update(
+                    dict.fromkeys(peer.id for peer in enabled_gws.values())
+                )
+        return list(res)
 
     def query(self, query):
         """
         Returns peer by vk, hostname, or IP. None if no match.
         """
         peer = (
-            self.by('id').get(query)
-            or self.limit(enabled=True).by('enabled_names').get(query)
-            or self.limit(enabled=True).by('enabled_ips_str').get(query)
+            ([self[query]] if query in self else [])
+            or self._lookup('enabled_names', query)
+            or self._lookup('enabled_ips_str', query)
         )
         if peer:
             assert len(peer) == 1, ("this should not be possible:", peer)
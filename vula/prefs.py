@@ -1,15 +1,17 @@
 from __future__ import annotations
 
+from functools import cached_property
 from ipaddress import ip_network
 
 import click
 import yaml
-from schema import Schema, Use
+from schema import And, Schema, Use
 from ipaddress import ip_address
 
 from .common import (
     DualUse,
     Flexibool,
+    SubnetMatcher,
     organize_dbus_if_active,
     schemattrdict,
     yamlrepr_hl,
@@ -40,6 +42,9 @@ class Prefs(yamlrepr_hl, schemattrdict):
             'record_events': Flexibool,
             'enable_ipv6': Flexibool,
             'enable_ipv4': Flexibool,
+            'save_delay': And(Use(float), lambda d: d >= 0),
+            'save_fsync': Flexibool,
+            'netlink_debounce': And(Use(float), lambda d: d >= 0),
         }
     )
 
@@ -71,8 +76,19 @@ class Prefs(yamlrepr_hl, schemattrdict):
         primary_ip=0,
         enable_ipv6=True,
         enable_ipv4=True,
+        save_delay=1.0,
+        save_fsync=True,
+        netlink_debounce=0.5,
     )
 
+    @cached_property
+    def subnets_allowed_matcher(self):
+        return SubnetMatcher(self.subnets_allowed)
+
+    @cached_property
+    def subnets_forbidden_matcher(self):
+        return SubnetMatcher(self.subnets_forbidden)
+
 
 @DualUse.object(
     invoke_without_command=True,
@@ -1,4 +1,6 @@
 import threading
+import time
+from functools import partial
 from ipaddress import ip_address, ip_network
 from socket import AddressFamily
 
@@ -10,12 +12,80 @@ from .constants import (
     _DUMMY_INTERFACE,
     _VULA_ULA_SUBNET,
     _GW_ROUTES,
+    _SYSTEM_STATE_REDUMP_INTERVAL,
 )
 from .wg import Interface as WgInterface
 
 # FIXME: find where the larger canonical version of this table lives
 SCOPES = {0: 'global', 253: 'static'}
 
+# from linux/include/uapi/linux/fib_rules.h
+FIB_RULE_INVERT = 0x02
+
+IP_VERSION = {AddressFamily.AF_INET: "4", AddressFamily.AF_INET6: "6"}
+
+# seconds within which the netlink event of a change we made is expected
+OWN_CHANGE_TIMEOUT = 10
+
+
+class KernelSnapshot(object):
+    """
+    One dump of the parts of the kernel's state which sync reconciles with
+    organize's state: the links, addresses, ip rules and routes, and the
+    WireGuard interface's configuration and peers.
+
+    If tables is given, only the routes in those tables and the WireGuard
+    peers are dumped, which is all that removals are planned from; the
+    links, addresses and rules are left empty.
+    """
+
+    def __init__(self, ipr, wgi, tables=None):
+        self.links = {}
+        self.link_kinds = {}
+        self.links_up = set()
+        self.addrs = set()
+        self.rules = {family: set() for family in IP_VERSION}
+        if tables is None:
+            self._dump_interfaces_and_rules(ipr)
+        # routes by (table, dst in cidr notation)
+        self.routes = {}
+        for route in ipr.get_routes():
+            attrs = dict(route['attrs'])
+            if tables is not None and attrs.get('RTA_TABLE') not in tables:
+                continue
+            if 'RTA_DST' in attrs:
+                dst = "%s/%s" % (attrs['RTA_DST'], route['dst_len'])
+                self.routes[attrs['RTA_TABLE'], dst] = route['scope']
+        self.wg = dict(wgi.query())
+        self.wg_peers = {peer['public_key']: peer for peer in wgi.peers}
+
+    def _dump_interfaces_and_rules(self, ipr):
+        for link in ipr.get_links():
+            name = link.get_attr('IFLA_IFNAME')
+            info = link.get_attr('IFLA_LINKINFO')
+            self.links[name] = link['index']
+            self.link_kinds[name] = info and info.get_attr('IFLA_INFO_KIND')
+            if link.get('state') == 'up':
+                self.links_up.add(name)
+        names = {index: name for name, index in self.links.items()}
+        self.addrs = {
+            (ip_address(a.get_attr('IFA_ADDRESS')), names.get(a['index']))
+            for a in ipr.get_addr()
+        }
+        # rules by family, as (table, fwmark, priority, flags) tuples
+        self.rules = {
+            family: {
+                (
+                    rule.get_attr('FRA_TABLE'),
+                    rule.get_attr('FRA_FWMARK'),
+                    rule.get_attr('FRA_PRIORITY'),
+                    rule['flags'],
+                )
+                for rule in ipr.get_rules(family=family)
+            }
+            for family in IP_VERSION
+        }
+
 
 class Sys(object):
     """
@@ -37,6 +107,34 @@ class Sys(object):
         self.wgi = WgInterface(self.wg_name, ipr=self.ipr)
         self._monitor_thread = None
         self._stop_monitor = False
+        self.last_sync = None
+        # the link table, which is filled by the first lookup and then kept
+        # up to date by the monitor's RTM_NEWLINK and RTM_DELLINK events
+        self._link_names = None
+        self._link_indexes = {}
+        # the addresses, by (link index, address), with their prefix lengths,
+        # and the gateways of the routes, by route. these are dumped by the
+        # first read of the system state, and then kept up to date by the
+        # monitor's address and route events, and dumped again every
+        # _SYSTEM_STATE_REDUMP_INTERVAL seconds.
+        self._model_lock = threading.RLock()
+        self._addrs = None
+        self._gateways = None
+        self._model_time = None
+        self._projection = None
+        self._redump_timer = None
+        # the system state is refreshed netlink_debounce seconds after the
+        # first event which changes it, so that the events which come in
+        # bursts (eg, when an interface comes up) cause one refresh. the
+        # events of changes which we made ourselves are recognized by their
+        # keys, and don't cause a refresh.
+        self._refresh_lock = threading.Lock()
+        self._refresh_timer = None
+        self._refresh_events = []
+        self._own_changes = {}
+        self._netlink_event_counts = dict(
+            received=0, suppressed=0, unchanged=0, coalesced=0, refreshes=0
+        )
 
     def start_monitor(self):
         self._stop_monitor = False
@@ -45,6 +143,8 @@ class Sys(object):
                 target=self._monitor
             )  # , args=(1,))
             self._monitor_thread.start()
+        if self._redump_timer is None:
+            self._schedule_redump()
 
     def get_stats(self):
         """
@@ -63,6 +163,39 @@ class Sys(object):
         Stops the monitor.
         """
         self._stop_monitor = True
+        if self._redump_timer is not None:
+            self._redump_timer.cancel()
+            self._redump_timer = None
+
+    def _schedule_redump(self):
+        if self._redump_timer is not None:
+            self._redump_timer.cancel()
+        self._redump_timer = threading.Timer(
+            _SYSTEM_STATE_REDUMP_INTERVAL, self._redump
+        )
+        self._redump_timer.daemon = True
+        self._redump_timer.start()
+
+    def _redump(self):
+        """
+        Dumps the addresses and routes again while the monitor runs, so that
+        an event which it missed is corrected even if no other event comes,
+        and refreshes the system state if that changed it.
+        """
+        try:
+            with self._model_lock:
+                if self._addrs is None:
+                    # nothing has read the system state yet
+                    return
+                self._load_model()
+                changed = self._project() != self._projection
+            if changed:
+                self.get_new_system_state("periodic re-dump")
+        except Exception as ex:
+            self.log.error("Failed to dump addresses and routes: %r", ex)
+        finally:
+            if not self._stop_monitor:
+                self._schedule_redump()
 
     def _monitor(self):
         ip = IPRSocket()
@@ -83,7 +216,9 @@ class Sys(object):
                 'RTM_DELROUTE',
                 'RTM_NEWROUTE',
             ]:
-                self.get_new_system_state(f"{event} netlink event")
+                self._netlink_event(event, msg[0])
+            elif event in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                self._link_event(event, msg[0])
             elif event == 'RTM_NEWNEIGH':
                 # this happens often, so we don't even debug log it
                 pass
@@ -99,40 +234,250 @@ class Sys(object):
         self._monitor_thread = None
         ip.close()
 
-    @property
-    def idx_to_link_name(self):
-        return {
-            L['index']: dict(L['attrs'])['IFLA_IFNAME']
-            for L in self.ipr.get_links()
-        }
+    def _netlink_event(self, event, msg):
+        """
+        Handles an address or route event from the monitor, by updating the
+        model of addresses and routes, and refreshing the system state if
+        the event (rather than a change we made) changed it.
+        """
+        self._count('received')
+        if self._addrs is None:
+            # there is no system state to compare the event with yet
+            self._count('refreshes')
+            self.get_new_system_state(f"{event} netlink event")
+            return
+        own = self._is_own_change(event, msg)
+        if not self._model_event(event, msg):
+            self._count('unchanged')
+        elif own:
+            self._count('suppressed')
+        else:
+            self._schedule_refresh(event)
 
-    def _get_all_addrs(self):
-        links = self.idx_to_link_name
-        addrs = self.ipr.get_addr()
-        for a in addrs:
-            addr = ip_address(dict(a['attrs'])['IFA_ADDRESS'])
-            iface = links[a['index']]
-            yield addr, a, iface
+    def _count(self, name):
+        with self._refresh_lock:
+            self._netlink_event_counts[name] += 1
 
-    def _get_system_state(self):
-        "WIP"
+    def netlink_event_stats(self):
+        """
+        Returns the counts of the netlink address and route events which
+        were received, and of what was done about them.
+        """
+        with self._refresh_lock:
+            return dict(self._netlink_event_counts)
+
+    def _schedule_refresh(self, event):
+        with self._refresh_lock:
+            self._refresh_events.append(event)
+            if self._refresh_timer is not None:
+                self._netlink_event_counts['coalesced'] += 1
+                return
+            delay = self.organize.prefs.netlink_debounce
+            if delay > 0:
+                self._refresh_timer = threading.Timer(delay, self._refresh)
+                self._refresh_timer.daemon = True
+                self._refresh_timer.start()
+                return
+        self._refresh()
+
+    def _refresh(self):
+        with self._refresh_lock:
+            events, self._refresh_events = self._refresh_events, []
+            self._refresh_timer = None
+            self._netlink_event_counts['refreshes'] += 1
+            # forget the changes whose events were lost
+            now = time.monotonic()
+            self._own_changes = {
+                k: v for k, v in self._own_changes.items() if v >= now
+            }
+        self.get_new_system_state(
+            f"{events[0]} netlink event"
+            + (f" and {len(events) - 1} more" if len(events) > 1 else "")
+        )
+
+    def _change_key(self, event, msg):
+        if event in ('RTM_NEWADDR', 'RTM_DELADDR'):
+            return self._addr_key(msg)
+        dst = "%s/%s" % (msg.get_attr('RTA_DST'), msg['dst_len'])
+        return msg.get_attr('RTA_TABLE'), str(ip_network(dst, strict=False))
 
-        gateways = list(
-            set(
-                r.get_attrs('RTA_GATEWAY')[0]
-                for r in self.ipr.get_routes()
-                if r.get_attrs('RTA_GATEWAY')
+    def _is_own_change(self, event, msg):
+        if event in ('RTM_NEWROUTE', 'RTM_DELROUTE') and not msg.get_attr(
+            'RTA_DST'
+        ):
+            return False
+        with self._refresh_lock:
+            deadline = self._own_changes.pop(
+                (event, self._change_key(event, msg)), None
             )
+        return deadline is not None and deadline >= time.monotonic()
+
+    def _make_change(self, event, key, function, *args, **kwargs):
+        """
+        Calls function to make a change to the system, which the monitor will
+        see as an event with the given key (see _change_key), so that the
+        monitor knows that we caused the event.
+        """
+        with self._refresh_lock:
+            self._own_changes[event, key] = (
+                time.monotonic() + OWN_CHANGE_TIMEOUT
+            )
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            with self._refresh_lock:
+                self._own_changes.pop((event, key), None)
+            raise
+
+    def _load_links(self):
+        self._set_links(
+            {
+                L['index']: L.get_attr('IFLA_IFNAME')
+                for L in self.ipr.get_links()
+            }
         )
 
+    def _set_links(self, names):
+        # the link table is guarded by the model lock, as the projection of
+        # the model reads it while the monitor changes it
+        with self._model_lock:
+            self._link_indexes = {name: index for index, name in names.items()}
+            self._link_names = names
+
+    def _link_event(self, event, msg):
+        with self._model_lock:
+            if self._link_names is None:
+                return
+            index = msg['index']
+            old = self._link_names.pop(index, None)
+            if old is not None:
+                self._link_indexes.pop(old, None)
+            if event == 'RTM_NEWLINK':
+                name = msg.get_attr('IFLA_IFNAME')
+                self._link_names[index] = name
+                self._link_indexes[name] = index
+
+    @property
+    def idx_to_link_name(self):
+        with self._model_lock:
+            if self._link_names is None:
+                self._load_links()
+            return dict(self._link_names)
+
+    def link_index(self, name):
+        """
+        Returns the index of the named link, or None if there is no such
+        link. Links which are not in the link table, such as ones which we
+        have just created, are looked up and added to it.
+        """
+        with self._model_lock:
+            if self._link_names is None:
+                self._load_links()
+            index = self._link_indexes.get(name)
+        if index is None:
+            found = self.ipr.link_lookup(ifname=name)
+            if found:
+                index = found[0]
+                with self._model_lock:
+                    self._link_names[index] = name
+                    self._link_indexes[name] = index
+        return index
+
+    @staticmethod
+    def _addr_key(msg):
+        return msg['index'], ip_address(msg.get_attr('IFA_ADDRESS'))
+
+    @staticmethod
+    def _route_key(msg):
+        return (
+            msg['family'],
+            msg.get_attr('RTA_TABLE'),
+            msg.get_attr('RTA_DST'),
+            msg['dst_len'],
+            msg.get_attr('RTA_PRIORITY'),
+            msg.get_attr('RTA_OIF'),
+        )
+
+    def _load_model(self):
+        """
+        Dumps the addresses and routes, replacing the model of them which is
+        otherwise kept up to date by the monitor.
+        """
+        addrs = {
+            self._addr_key(a): a['prefixlen'] for a in self.ipr.get_addr()
+        }
+        gateways = self._dump_gateways()
+        with self._model_lock:
+            if self._addrs is not None and (
+                addrs != self._addrs or gateways != self._gateways
+            ):
+                self.log.info(
+                    "netlink events had not kept addresses and routes up to "
+                    "date; replacing them with a new dump"
+                )
+            if addrs != self._addrs:
+                self._addrs = addrs
+            if gateways != self._gateways:
+                self._gateways = gateways
+            self._model_time = time.monotonic()
+
+    def _dump_gateways(self):
+        return {
+            self._route_key(r): r.get_attr('RTA_GATEWAY')
+            for r in self.ipr.get_routes()
+            if r.get_attr('RTA_GATEWAY')
+        }
+
+    def _model_event(self, event, msg):
+        """
+        Updates the model of addresses and routes with an event from the
+        monitor. Returns True if the parts of the system state which are
+        derived from them may have changed.
+        """
+        with self._model_lock:
+            if self._addrs is None:
+                return True
+            if (
+                time.monotonic() - self._model_time
+                > _SYSTEM_STATE_REDUMP_INTERVAL
+            ):
+                self._load_model()
+            elif event == 'RTM_NEWADDR':
+                self._addrs[self._addr_key(msg)] = msg['prefixlen']
+            elif event == 'RTM_DELADDR':
+                self._addrs.pop(self._addr_key(msg), None)
+                # the kernel doesn't send RTM_DELROUTE for the IPv4 routes
+                # which it flushes when their source address goes away
+                self._gateways = self._dump_gateways()
+            elif not msg.get_attr('RTA_GATEWAY'):
+                # eg, the routes which we add for our peers
+                return False
+            elif event == 'RTM_NEWROUTE':
+                self._gateways[self._route_key(msg)] = msg.get_attr(
+                    'RTA_GATEWAY'
+                )
+            else:
+                self._gateways.pop(self._route_key(msg), None)
+            return self._project() != self._projection
+
+    def _project(self):
+        """
+        Returns the parts of the system state which are derived from the
+        addresses and routes, from the model of them.
+        """
         current_subnets = {}
         current_interfaces = {}
 
-        addrs = list(self._get_all_addrs())
+        links = self.idx_to_link_name
+        if any(index not in links for index, addr in self._addrs):
+            # the table is out of date (eg, there is no monitor running)
+            self._load_links()
+            links = self.idx_to_link_name
 
-        has_v6 = any(addr for addr in addrs if addr[0].version == 6)
+        has_v6 = any(addr.version == 6 for index, addr in self._addrs)
 
-        for addr, a, iface in addrs:
+        for (index, addr), prefixlen in self._addrs.items():
+            iface = links[index]
             if addr.version == 4 and not self.organize.v4_enabled:
                 continue
             if addr.version == 6 and not self.organize.v6_enabled:
@@ -144,91 +489,343 @@ class Sys(object):
                 ]
             ):
                 continue
-            this_subnet = ip_network(
-                "%s/%s" % (addr, a['prefixlen']), strict=False
-            )
-            if not any(
-                addr in subnet
-                for subnet in self.organize.prefs.subnets_forbidden
-            ):
+            this_subnet = ip_network("%s/%s" % (addr, prefixlen), strict=False)
+            if addr not in self.organize.prefs.subnets_forbidden_matcher:
                 current_subnets.setdefault(this_subnet, []).append(addr)
                 current_interfaces.setdefault(iface, []).append(addr)
 
         current_subnets[_VULA_ULA_SUBNET] = [self.organize.prefs.primary_ip]
 
+        gateways = sorted(
+            set(map(ip_address, self._gateways.values())),
+            key=lambda gw: (gw.version, gw),
+        )
+
         return current_subnets, current_interfaces, gateways, has_v6
 
+    def _get_system_state(self):
+        """
+        Returns the current subnets, interfaces, gateways, and whether we have
+        IPv6 addresses, from the model of the addresses and routes (which is
+        dumped if it is missing or old).
+        """
+        with self._model_lock:
+            if (
+                self._addrs is None
+                or time.monotonic() - self._model_time
+                > _SYSTEM_STATE_REDUMP_INTERVAL
+            ):
+                self._load_model()
+            self._projection = self._project()
+            return self._projection
+
     def get_new_system_state(self, reason=None):
         return self.organize.get_new_system_state(reason)
 
-    def link_add(self, name, kind, dryrun=False):
-        existing = self.ipr.get_links(ifname=name)
-        if existing and (
-            dict(existing[0].get_attr('IFLA_LINKINFO')['attrs'])[
-                'IFLA_INFO_KIND'
-            ]
-            == kind
-        ):
-            self.log.debug(f"{kind} link {name!r} exists")
-            return []
-        elif not dryrun:
-            self.ipr.link("add", kind=kind, ifname=name)
-            self.ipr.link(
-                "set",
-                ifname=name,
-                IFLA_AF_SPEC={
-                    "attrs": [
-                        (
-                            'AF_INET6',
-                            {
-                                "attrs": [
-                                    (
-                                        'IFLA_INET6_ADDR_GEN_MODE',
-                                        _IN6_ADDR_GEN_MODE_NONE,
-                                    )
-                                ]
-                            },
-                        )
-                    ]
-                },
-            )
-            self.ipr.link("set", ifname=name, state='up')
-        return [
-            f"ip link add name {name} type {kind}",
-            "ip link set dev {name} addrgenmode none",
-        ]
+    def _snapshot(self):
+        snapshot = KernelSnapshot(self.ipr, self.wgi)
+        self._set_links(
+            {index: name for name, index in snapshot.links.items()}
+        )
+        return snapshot
+
+    def reconcile(self, dryrun=False):
+        """
+        Reconciles the system with organize's state. This takes one snapshot
+        of the kernel's state, plans the operations which are needed to make
+        it match the state organize wants, and applies them (unless dryrun).
+
+        Returns the list of operations which were (or would be) done. The
+        number of operations and of WireGuard netlink round trips which the
+        sync took are kept in last_sync.
+        """
+        round_trips = self.wgi.round_trips
+        res = self._apply(self._plan(self._snapshot()), dryrun)
+        self.last_sync = dict(
+            dryrun=dryrun,
+            operations=len(res),
+            wireguard_round_trips=self.wgi.round_trips - round_trips,
+        )
+        return res
 
-    def sync_interfaces(self, dryrun=False):
+    def _plan(self, snapshot):
+        """
+        Returns the ordered list of operations which are needed to make the
+        system as described by snapshot match organize's state, as
+        (description, function) pairs.
+
+        Interfaces and ip rules come first, then the WireGuard peers are
+        removed and configured (together), then stale routes are removed, and
+        then the enabled peers' missing routes are added. The function is None
+        for errors which were found while planning, which are only reported.
+        """
         return (
-            self.wgi.sync_interface(
-                private_key=str(self.organize._keys.wg_Curve25519_sec_key),
-                listen_port=self.organize.port,
-                fwmark=self.organize.fwmark,
-                dryrun=dryrun,
-            )
-            + self.link_add(_DUMMY_INTERFACE, kind="dummy")
-            + self.addr_add(
-                self.organize.prefs.primary_ip,
-                _DUMMY_INTERFACE,
-                mask=128,
-                dryrun=dryrun,
-            )
+            self._plan_interfaces(snapshot)
+            + self._plan_iprules(snapshot)
+            + self._plan_wg_peers(snapshot)
+            + self._plan_route_removals(snapshot)
+            + self._plan_routes(snapshot)
         )
 
-    def addr_add(self, addr, dev, mask, dryrun=False):
+    def _apply(self, ops, dryrun):
         res = []
-        if not [
-            a
-            for _addr, a, _iface in self._get_all_addrs()
-            if addr == _addr and dev == _iface
-        ]:
-            res.append(f"ip addr add {addr}/{mask} dev {dev}")
-            if not dryrun:
-                oif = self.ipr.link_lookup(ifname=dev)[0]
-                self.log.info("[#] %s", str(res[-1]))
-                self.ipr.addr("add", index=oif, address=str(addr), mask=mask)
+        for description, function in ops:
+            res.append(description)
+            if dryrun or function is None:
+                continue
+            self.log.info("[#] %s", description)
+            try:
+                function()
+            except Exception as ex:
+                self.log.error("Failed to %s: %r", description, ex)
+                res.append(repr(ex))
         return res
 
+    def _plan_interfaces(self, snapshot):
+        ops = []
+        name = self.wg_name
+        if name not in snapshot.links:
+            ops.append(
+                (
+                    "ip link add %s type wireguard" % (name,),
+                    partial(
+                        self.ipr.link, 'add', ifname=name, kind="wireguard"
+                    ),
+                )
+            )
+        if name not in snapshot.links_up:
+            ops.append(
+                (
+                    "ip link set up %s" % (name,),
+                    partial(self.ipr.link, 'set', ifname=name, state='up'),
+                )
+            )
+        config = dict(
+            private_key=str(
+                self.organize._keys.wg_Curve25519_sec_key
+            ).encode(),
+            listen_port=self.organize.port,
+            fwmark=self.organize.fwmark,
+        )
+        todo = {k: v for k, v in config.items() if snapshot.wg.get(k) != v}
+        if todo:
+            shown = dict(todo)
+            if 'private_key' in shown:
+                shown['private_key'] = '<redacted private key>'
+            ops.append(
+                (
+                    "WireGuard.set(%r, **%r)" % (name, shown),
+                    partial(self.wgi.set, **todo),
+                )
+            )
+        if snapshot.link_kinds.get(_DUMMY_INTERFACE) != "dummy":
+            ops.append(
+                (
+                    f"ip link add name {_DUMMY_INTERFACE} type dummy\n"
+                    f"ip link set dev {_DUMMY_INTERFACE} addrgenmode none",
+                    partial(self._dummy_link_add, _DUMMY_INTERFACE),
+                )
+            )
+        primary_ip = self.organize.prefs.primary_ip
+        if (primary_ip, _DUMMY_INTERFACE) not in snapshot.addrs:
+            ops.append(
+                (
+                    f"ip addr add {primary_ip}/128 dev {_DUMMY_INTERFACE}",
+                    partial(
+                        self._addr_add,
+                        primary_ip,
+                        _DUMMY_INTERFACE,
+                        mask=128,
+                    ),
+                )
+            )
+        return ops
+
+    def _dummy_link_add(self, name):
+        self.ipr.link("add", kind="dummy", ifname=name)
+        self.ipr.link(
+            "set",
+            ifname=name,
+            IFLA_AF_SPEC={
+                "attrs": [
+                    (
+                        'AF_INET6',
+                        {
+                            "attrs": [
+                                (
+                                    'IFLA_INET6_ADDR_GEN_MODE',
+                                    _IN6_ADDR_GEN_MODE_NONE,
+                                )
+                            ]
+                        },
+                    )
+                ]
+            },
+        )
+        self.ipr.link("set", ifname=name, state='up')
+
+    def _addr_add(self, addr, dev, mask):
+        index = self.link_index(dev)
+        self._make_change(
+            'RTM_NEWADDR',
+            (index, ip_address(addr)),
+            self.ipr.addr,
+            "add",
+            index=index,
+            address=str(addr),
+            mask=mask,
+        )
+
+    def _route_add(self, dest, table, src):
+        self._make_change(
+            'RTM_NEWROUTE',
+            (table, str(dest)),
+            self.ipr.route,
+            "add",
+            dst=str(dest),
+            oif=self.link_index(self.wg_name),
+            table=table,
+            scope='link',
+            prefsrc=str(src) if src else None,
+        )
+
+    def _route_del(self, table, dst, scope):
+        self._make_change(
+            'RTM_DELROUTE',
+            (table, str(ip_network(dst))),
+            self.ipr.route,
+            'del',
+            table=table,
+            dst=dst,
+            scope=scope,
+        )
+
+    def _plan_iprules(self, snapshot):
+        ops = []
+        table = self.organize.table
+        mark = self.organize.fwmark
+        priority = self.organize.ip_rule_priority
+        for family, version in IP_VERSION.items():
+            rule = (table, mark, priority, FIB_RULE_INVERT)
+            if rule in snapshot.rules[family]:
+                continue
+            ops.append(
+                (
+                    f"ip -{version} rule add not from all fwmark 0x{mark:x} "
+                    f"lookup {table}",
+                    partial(
+                        self.ipr.rule,
+                        'add',
+                        table=table,
+                        priority=priority,
+                        fwmark=mark,
+                        family=family,
+                        flags=FIB_RULE_INVERT,
+                    ),
+                )
+            )
+        return ops
+
+    def _plan_removals(self, snapshot):
+        return self._plan_wg_peers(snapshot, configure=False) + (
+            self._plan_route_removals(snapshot)
+        )
+
+    def _plan_wg_peers(self, snapshot, configure=True):
+        """
+        Plans the removal of stale WireGuard peers and (if configure) the
+        configuration of the enabled peers, as one operation which sets all of
+        them together.
+        """
+        lines = []
+        peers = []
+        errors = []
+        enabled = self.organize.peers.limit(enabled=True)
+        enabled_pks = {str(peer.descriptor.pk) for peer in enabled.values()}
+        for pk in snapshot.wg_peers:
+            if pk not in enabled_pks:
+                lines.append(f"wg set {self.wg_name} peer {pk} remove")
+                peers.append(dict(public_key=pk, remove=True))
+        if configure:
+            for peer in enabled.values():
+                try:
+                    config = peer.wg_config(
+                        self.organize.ctidh_dh(peer.descriptor.c)
+                    )
+                    changes, config = self.wgi.peerconfig_changes(
+                        config, snapshot.wg_peers.get(config['public_key'])
+                    )
+                except Exception as ex:
+                    self.log.error(
+                        "Failed to sync peer %s: %r", peer.name_and_id, ex
+                    )
+                    errors.append((repr(ex), None))
+                    continue
+                if config is not None:
+                    lines.extend(changes)
+                    peers.append(config)
+        if not peers:
+            return errors
+        return errors + [
+            ("\n".join(lines), partial(self.wgi.set_peers, peers))
+        ]
+
+    def _plan_route_removals(self, snapshot):
+        ops = []
+        enabled = self.organize.peers.limit(enabled=True)
+        expected = {
+            (self.organize.table, str(dst))
+            for peer in enabled.values()
+            for dst in peer.routes
+        }
+        if self.organize.peers.limit(use_as_gateway=True, enabled=True):
+            expected.update(
+                (_LINUX_MAIN_ROUTING_TABLE, dst) for dst in _GW_ROUTES
+            )
+        for (table, dst), scope in snapshot.routes.items():
+            if (table, dst) in expected:
+                continue
+            if table != self.organize.table and not (
+                table == _LINUX_MAIN_ROUTING_TABLE and dst in _GW_ROUTES
+            ):
+                continue
+            ops.append(
+                (
+                    # the scope name is strictly cosmetic; the printed "ip
+                    # route" command is runnable with the scope as an integer
+                    # too
+                    "ip route del {dst} table {table} scope {scope}".format(
+                        dst=dst, table=table, scope=SCOPES.get(scope, scope)
+                    ),
+                    partial(self._route_del, table, dst, scope),
+                )
+            )
+        return ops
+
+    def _plan_routes(self, snapshot):
+        ops = []
+        planned_routes = set()
+        for peer in self.organize.peers.limit(enabled=True).values():
+            routes = [(self.organize.table, dst) for dst in peer.routes]
+            if peer.use_as_gateway:
+                routes += [(_LINUX_MAIN_ROUTING_TABLE, d) for d in _GW_ROUTES]
+            for table, dest in routes:
+                dest = ip_network(dest)
+                key = (table, str(dest))
+                if key in snapshot.routes or key in planned_routes:
+                    continue
+                planned_routes.add(key)
+                src = self._route_src(dest)
+                ops.append(
+                    (
+                        f"ip route add {dest} dev {self.wg_name} proto "
+                        f"static scope link%s table {table}"
+                        % (f" src {src}" if src else ""),
+                        partial(self._route_add, dest, table, src),
+                    )
+                )
+        return ops
+
     def sync_peer(self, vk: str, dryrun: bool = False):
         """
         Syncs peer's wg config and routes. Returns a string.
@@ -263,44 +860,6 @@ class Sys(object):
         result = filter(None, res)
         return "\n".join(result)
 
-    def sync_iprules(self, dryrun=False):
-        routing_table = self.organize.table
-        mark = self.organize.fwmark
-        priority = self.organize.ip_rule_priority
-        not_flag = 0x02
-        res = []
-        ip_version = {AddressFamily.AF_INET: "4", AddressFamily.AF_INET6: "6"}
-        for family in ip_version.keys():
-            existing_rule = [
-                rule
-                for rule in self.ipr.get_rules(family=family)
-                if dict(rule['attrs'])['FRA_TABLE'] == routing_table
-                and dict(rule['attrs'])['FRA_FWMARK'] == mark
-                and dict(rule['attrs'])['FRA_PRIORITY'] == priority
-                and rule['header']['flags'] == not_flag
-            ]
-            if existing_rule:
-                self.log.debug(
-                    "Found expected existing rule: (%s)", existing_rule
-                )
-            else:
-                if not dryrun:
-                    self.ipr.rule(
-                        'add',
-                        table=routing_table,
-                        priority=priority,
-                        fwmark=mark,
-                        family=family,
-                        flags=not_flag,
-                    )
-                res.append(
-                    "ip -{af} rule add not from all fwmark 0x{mark:x} "
-                    "lookup {table}".format(
-                        af=ip_version[family], mark=mark, table=routing_table
-                    )
-                )
-        return res
-
     def remove_wg_peer(self, pk, dryrun=False):
         return self.wgi.apply_peerconfig(
             dict(public_key=pk, remove=True), dryrun
@@ -321,7 +880,13 @@ class Sys(object):
         res = []
         for route in self.get_route_entries(dests, table, dev):
             if not dryrun:
-                self.ipr.route("del", **route)
+                self._make_change(
+                    'RTM_DELROUTE',
+                    (route['table'], str(ip_network(route['dst']))),
+                    self.ipr.route,
+                    "del",
+                    **route,
+                )
             res.append(
                 "ip route del {dst} dev {dev} table {table}".format(
                     dst=route['dst'],
@@ -343,7 +908,7 @@ class Sys(object):
         """
         current_routes = self.ipr.get_routes()
         if dev:
-            oif = self.ipr.link_lookup(ifname=dev)[0]
+            oif = self.link_index(dev)
         # flatten attrs list to dict (api allows duplicate keys - but we don't)
         [r.update(attrs=dict(r['attrs'])) for r in current_routes]
         # install dst key with cidr notation
@@ -374,97 +939,16 @@ class Sys(object):
         actions from the event engine should remove the specific things that we
         know need to be removed, and then this method will actually only be
         used to remove rogue entries.
-        """
-        routing_table = self.organize.table
-        res = []
-        enabled_pks = [
-            str(peer.descriptor.pk)
-            for peer in self.organize.peers.limit(enabled=True).values()
-        ]
-        for peer in self.wgi.peers:
-            if peer['public_key'] not in enabled_pks:
-                if not dryrun:
-                    res.append(self.remove_wg_peer(peer['public_key'], dryrun))
-                    self.log.info(
-                        "Removing unexpected peer pk: (%s)", peer['public_key']
-                    )
-                res.append(
-                    "wg set {interface} peer {pk} remove".format(
-                        interface=self.wg_name, pk=peer['public_key']
-                    )
-                )
-        expected_routes = [
-            str(dst)
-            for peer in self.organize.peers.limit(enabled=True).values()
-            for dst in peer.routes
-        ]
 
-        current_routes = self.ipr.get_routes()
-        [r.update(attrs=dict(r['attrs'])) for r in current_routes]
-        our_current_routes = [
-            r
-            for r in current_routes
-            if r['attrs']['RTA_TABLE'] == self.organize.table
-        ]
-        for route in our_current_routes:
-            dst = route['attrs']['RTA_DST'] + "/" + str(route['dst_len'])
-            if dst not in expected_routes:
-                scope = route['scope']
-                if not dryrun:
-                    self.log.info("Removing unexpected route: (%s)", dst)
-                    try:
-                        self.ipr.route(
-                            'del',
-                            table=routing_table,
-                            dst=str(dst),
-                            scope=scope,
-                        )
-                    except Exception as e:
-                        raise Exception(
-                            f"{e} on ip route del {dst} table {routing_table}"
-                            f" scope {scope}"
-                        )
-                if scope in SCOPES:
-                    # this is strictly cosmetic
-                    # the printed "ip route" command is runnable with the scope
-                    # as an integer too
-                    scope = SCOPES[scope]
-                res.append(
-                    "ip route del {dst} table {table} scope {scope}".format(
-                        dst=dst, table=routing_table, scope=scope
-                    )
-                )
-        if not self.organize.peers.limit(use_as_gateway=True, enabled=True):
-            default_routes = [
-                r
-                for r in current_routes
-                if r['attrs'].get('RTA_TABLE') == _LINUX_MAIN_ROUTING_TABLE
-                and f"{r['attrs'].get('RTA_DST')}/{r.get('dst_len')}"
-                in _GW_ROUTES
-            ]
-            for route in default_routes:
-                dst = route['attrs']['RTA_DST'] + "/" + str(route['dst_len'])
-                scope = route['scope']
-                if not dryrun:
-                    self.log.info("Removing unexpected route: (%s)", dst)
-                    self.ipr.route(
-                        'del',
-                        table=_LINUX_MAIN_ROUTING_TABLE,
-                        dst=str(dst),
-                        scope=scope,
-                    )
-                if scope in SCOPES:
-                    # this is strictly cosmetic
-                    # the printed "ip route" command is runnable with the scope
-                    # as an integer too
-                    scope = SCOPES[scope]
-                res.append(
-                    "ip route del {dst} table {table} scope {scope}".format(
-                        dst=dst, table=_LINUX_MAIN_ROUTING_TABLE, scope=scope
-                    )
-                )
-
-        return res
+        Removals only concern the WireGuard peers and the routes in our own
+        table and the main table, so only those are dumped.
+        """
+        snapshot = KernelSnapshot(
+            self.ipr,
+            self.wgi,
+            tables=(self.organize.table, _LINUX_MAIN_ROUTING_TABLE),
+        )
+        return self._apply(self._plan_removals(snapshot), dryrun)
 
     def sync_routes(self, dests, table, dryrun=False):
         """
@@ -474,30 +958,12 @@ class Sys(object):
         res = []
         self.log.debug("looking for routes for: %r", dests)
 
-        oif_idx = self.ipr.link_lookup(ifname=self.wg_name)
-
-        system_state = self.organize.state.system_state
+        oif_idx = self.link_index(self.wg_name)
 
         for dest in map(ip_network, dests):
             routes = self.ipr.route("show", dst=str(dest), table=table)
             if not routes:
-                src = None
-                for net in system_state.current_subnets:
-                    # note: current_subnets is consulted to find a source
-                    # address but NOT consulted regarding the destination.
-                    # (for pinned peers, we want to add IPs from
-                    # non-current subnets here; they only need to be in a
-                    # current subnet the first time they're seen)
-                    if dest.version == net.version and dest.subnet_of(net):
-                        src = system_state.current_subnets[net][0]
-                        # select the first local IP we have in the first
-                        # subnet. (it would be more correct to use the
-                        # longest-prefix-matching subnet... but not
-                        # bothering with that for now.)
-                        break
-                        # further note: this current_subnets logic
-                        # doesn't belong here at all; will refactor
-                        # this into system state soon.
+                src = self._route_src(dest)
                 res.append(
                     f"ip route add {dest} dev {self.wg_name} proto "
                     f"static scope link%s table {table}"
@@ -505,7 +971,10 @@ class Sys(object):
                 )
                 if not dryrun:
                     self.log.info("[#] %s", str(res[-1]))
-                    self.ipr.route(
+                    self._make_change(
+                        'RTM_NEWROUTE',
+                        (table, str(dest)),
+                        self.ipr.route,
                         "add",
                         dst=str(dest),
                         oif=oif_idx,
@@ -518,3 +987,19 @@ class Sys(object):
                     self.log.debug("found existing route for %s", dest)
 
         return "\n".join(res)
+
+    def _route_src(self, dest):
+        """
+        Returns the source address for a route to dest, or None.
+        """
+        system_state = self.organize.state.system_state
+        # note: current_subnets is consulted to find a source address but NOT
+        # consulted regarding the destination. (for pinned peers, we want to
+        # add IPs from non-current subnets here; they only need to be in a
+        # current subnet the first time they're seen)
+        net = system_state.current_subnets_matcher.longest_match(dest)
+        if net is not None:
+            # select the first local IP we have in the longest-prefix-matching
+            # subnet.
+            return system_state.current_subnets[net][0]
+        return None
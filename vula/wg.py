@@ -15,12 +15,19 @@ from base64 import b64decode, b64encode  # noqa: F401
 from datetime import timedelta
 from ipaddress import ip_address, ip_network
 from logging import Logger, getLogger
+from socket import AF_INET, AF_INET6
 from typing import Tuple, Self
 
 import click
 from pyroute2 import IPRoute
 from pyroute2 import WireGuard as PyRoute2WireGuard
+from pyroute2.netlink import NLM_F_ACK, NLM_F_REQUEST
 from pyroute2.netlink import nla as netlink_atom
+from pyroute2.netlink.generic.wireguard import (
+    WG_CMD_SET_DEVICE,
+    WG_GENL_VERSION,
+    wgmsg,
+)
 from schema import And, Optional, Or, Schema, Use
 
 from .common import (
@@ -36,6 +43,83 @@ from .common import (
 )
 
 
+# the most bytes of peer attributes which are sent in one WireGuard set
+# message. the kernel reads the peers from one nested attribute, whose length
+# is 16 bits, so peers are split into messages well below that.
+_WG_SET_MESSAGE_SIZE = 32768
+
+
+def _peer_message_size(peer) -> int:
+    """
+    Returns an upper bound of the encoded size of a peer's attributes.
+    """
+    return 128 + 48 * len(peer.get('allowed_ips', ()))
+
+
+# from the kernel's include/uapi/linux/wireguard.h. (pyroute2 0.5 defines
+# WGPEER_F_REMOVE_ME as 0, which does not remove the peer.)
+_WGPEER_F_REMOVE_ME = 1
+
+
+def _peer_attrs(peer) -> list:
+    """
+    Returns the netlink attributes which configure a peer, as pyroute2's
+    WireGuard.set makes them from the same peer dict.
+    """
+    attrs = [['WGPEER_A_PUBLIC_KEY', peer['public_key']]]
+    if peer.get('remove'):
+        attrs.append(['WGPEER_A_FLAGS', _WGPEER_F_REMOVE_ME])
+        return attrs
+    if 'endpoint_addr' in peer and 'endpoint_port' in peer:
+        attrs.append(
+            [
+                'WGPEER_A_ENDPOINT',
+                dict(addr=peer['endpoint_addr'], port=peer['endpoint_port']),
+            ]
+        )
+    if 'preshared_key' in peer:
+        attrs.append(['WGPEER_A_PRESHARED_KEY', peer['preshared_key']])
+    if 'persistent_keepalive' in peer:
+        attrs.append(
+            [
+                'WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL',
+                peer['persistent_keepalive'],
+            ]
+        )
+    attrs.append(['WGPEER_A_FLAGS', 0])
+    if 'allowed_ips' in peer:
+        allowed_ips = []
+        for net in map(ip_network, peer['allowed_ips']):
+            family = AF_INET if net.version == 4 else AF_INET6
+            allowed_ips.append(
+                dict(
+                    attrs=[
+                        ['WGALLOWEDIP_A_FAMILY', family],
+                        ['WGALLOWEDIP_A_IPADDR', net.network_address.packed],
+                        ['WGALLOWEDIP_A_CIDR_MASK', net.prefixlen],
+                    ]
+                )
+            )
+        attrs.append(['WGPEER_A_ALLOWEDIPS', allowed_ips])
+    return attrs
+
+
+def _set_peers_message(interface, peers) -> wgmsg:
+    """
+    Returns a WireGuard set message which configures several peers, which is
+    sent with the socket's nlm_request (so that this works with any pyroute2
+    version, without its private methods).
+    """
+    msg = wgmsg()
+    msg['cmd'] = WG_CMD_SET_DEVICE
+    msg['version'] = WG_GENL_VERSION
+    msg['attrs'].append(['WGDEVICE_A_IFNAME', interface])
+    msg['attrs'].append(
+        ['WGDEVICE_A_PEERS', [dict(attrs=_peer_attrs(p)) for p in peers]]
+    )
+    return msg
+
+
 def _wg_interface_list():
     """
     This returns a list of names of current WireGuard interfaces.
@@ -274,6 +358,8 @@ class Interface(attrdict, yamlrepr_hl):
             ipr = IPRoute()
         self._if_index = None
         self._ipr = ipr
+        # the number of WireGuard netlink requests which have been made
+        self.round_trips = 0
         self.query()
 
     @property
@@ -357,6 +443,7 @@ class Interface(attrdict, yamlrepr_hl):
         """
         self.clear()
         self.log.debug("Fetching interface info for %s", self.name)
+        self.round_trips += 1
         try:
             res: Tuple = self._wg.info(self.name)
         except Exception as ex:
@@ -378,10 +465,39 @@ class Interface(attrdict, yamlrepr_hl):
 
     def set(self, **kwargs):
         self.log.debug("Calling WireGuard.set(%r, **%r)", self.name, kwargs)
+        self.round_trips += 1
         res = self._wg.set(self.name, **kwargs)
         self.log.debug("WireGuard.set(%r, **%r) -> %r", self.name, kwargs, res)
         return res
 
+    def set_peers(self, peers: list) -> int:
+        """
+        Configures several peers, with as few messages as the kernel allows.
+        Returns the number of messages which were sent.
+        """
+        batches: list[list] = []
+        size = _WG_SET_MESSAGE_SIZE
+        for peer in peers:
+            peer_size = _peer_message_size(peer)
+            if size + peer_size > _WG_SET_MESSAGE_SIZE:
+                batches.append([])
+                size = 0
+            batches[-1].append(peer)
+            size += peer_size
+        for batch in batches:
+            self.log.debug(
+                "Calling WireGuard.set(%r) with %d peers",
+                self.name,
+                len(batch),
+            )
+            self.round_trips += 1
+            self._wg.nlm_request(
+                _set_peers_message(self.name, batch),
+                msg_type=self._wg.prid,
+                msg_flags=NLM_F_REQUEST | NLM_F_ACK,
+            )
+        return len(batches)
+
     def apply_peerconfig(self, new: attrdict, dryrun: bool = False) -> str:
         """
         This sets only the keys that have changed, and returns a list of the
@@ -390,7 +506,48 @@ class Interface(attrdict, yamlrepr_hl):
         this does that.
         """
         self.query()
-        cur = self._peers_by_pubkey.get(new["public_key"])
+        res, new = self.peerconfig_changes(
+            new, self._peers_by_pubkey.get(new["public_key"])
+        )
+        if new is not None:
+            for line in res:
+                self.log.info("[#] %s", line)
+            if not dryrun:
+                self.set(peer=new)
+        return "\n".join(filter(None, res))
+
+    def apply_peerconfigs(self, configs: list, dryrun: bool = False) -> str:
+        """
+        Like apply_peerconfig, for several peers, with one query of the
+        interface and with the peers which need to be set sent together (see
+        set_peers).
+        """
+        self.query()
+        peers = self._peers_by_pubkey
+        res: list[str] = []
+        todo = []
+        for config in configs:
+            lines, config = self.peerconfig_changes(
+                config, peers.get(config["public_key"])
+            )
+            res.extend(lines)
+            if config is not None:
+                todo.append(config)
+        for line in res:
+            self.log.info("[#] %s", line)
+        if todo and not dryrun:
+            self.set_peers(todo)
+        return "\n".join(filter(None, res))
+
+    def peerconfig_changes(
+        self, new: attrdict, cur: Optional[dict]
+    ) -> Tuple[list[str], Optional[attrdict]]:
+        """
+        Compares a peer config with the peer's current config (or None, if the
+        peer is not configured), without querying the interface. Returns the
+        list of lines describing what needs to be done, and the (reduced)
+        peer config to pass to set, which is None if nothing needs to be set.
+        """
         res: list[str] = []
         if cur:
             if new.get('remove'):
@@ -430,9 +587,10 @@ class Interface(attrdict, yamlrepr_hl):
                 new['endpoint_addr'] = cur['endpoint_addr']
         else:
             if new.get('remove'):
-                return "# can't remove non-existent wireguard peer %s" % (
-                    new['public_key'],
-                )
+                return [
+                    "# can't remove non-existent wireguard peer %s"
+                    % (new['public_key'],)
+                ], None
 
         if (
             cur
@@ -441,54 +599,45 @@ class Interface(attrdict, yamlrepr_hl):
         ):
             # pyroute2/wg bug workaround
             self.log.debug("apply_peerconfig: no wg update necessary")
+            return res, None
 
+        if cur:
+            res.append(
+                '# reconfigure wireguard peer %s' % (new['public_key'],)
+            )
         else:
-            if cur:
-                res.append(
-                    '# reconfigure wireguard peer %s' % (new['public_key'],)
-                )
-            else:
-                res.append(
-                    '# configure new wireguard peer %s' % (new['public_key'],)
-                )
-
             res.append(
-                "vula wg set {interface} peer {pk} "
-                "{remove}{endpoint}{args}{allowed_ips}".format(
-                    remove="remove " if new.get('remove') else "",
-                    endpoint=(
-                        "endpoint %s:%s "
-                        % (new['endpoint_addr'], new['endpoint_port'])
-                        if (
-                            new.get('endpoint_addr')
-                            and new.get('endpoint_port')
-                        )
-                        else ''
-                    ),
-                    args="".join(
-                        f"{k}"
-                        f" {'<redacted psk>' if k == 'preshared_key' else v} "
-                        for k, v in new.items()
-                        if k in ('persistent_keepalive', 'preshared_key')
-                    ),
-                    allowed_ips=(
-                        'allowed-ips %s '
-                        % ",".join(ip for ip in new.get('allowed_ips', ()))
-                        if 'allowed_ips' in new
-                        else ""
-                    ),
-                    interface=self.name,
-                    pk=new['public_key'],
-                )
+                '# configure new wireguard peer %s' % (new['public_key'],)
             )
 
-            for line in res:
-                self.log.info("[#] %s", line)
-
-            if not dryrun:
-                self.set(peer=new)
+        res.append(
+            "vula wg set {interface} peer {pk} "
+            "{remove}{endpoint}{args}{allowed_ips}".format(
+                remove="remove " if new.get('remove') else "",
+                endpoint=(
+                    "endpoint %s:%s "
+                    % (new['endpoint_addr'], new['endpoint_port'])
+                    if (new.get('endpoint_addr') and new.get('endpoint_port'))
+                    else ''
+                ),
+                args="".join(
+                    f"{k}"
+                    f" {'<redacted psk>' if k == 'preshared_key' else v} "
+                    for k, v in new.items()
+                    if k in ('persistent_keepalive', 'preshared_key')
+                ),
+                allowed_ips=(
+                    'allowed-ips %s '
+                    % ",".join(ip for ip in new.get('allowed_ips', ()))
+                    if 'allowed_ips' in new
+                    else ""
+                ),
+                interface=self.name,
+                pk=new['public_key'],
+            )
+        )
 
-        return "\n".join(filter(None, res))
+        return res, new
 
     @property
     def peers(self):